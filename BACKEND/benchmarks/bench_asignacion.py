@@ -0,0 +1,178 @@
+# bench_asignacion.py - Asignación en lote de líneas pendientes (POST /solicitudes/asignacion) a gran escala
+#
+# Uso: python benchmarks/bench_asignacion.py [--lineas 100000] [--puntos 500] [--cobertura 0.6]
+#
+# Siembra solicitudes PENDIENTE con líneas parcialmente reservadas y disponibilidad suficiente para
+# cubrir `cobertura` de lo pendiente. Mide la simulación (dry_run) y la asignación real, y comprueba
+# el libro: lo debitado de cada punto es lo asignado, ningún punto queda negativo, la prioridad por
+# fecha se respeta, no sobra disponibilidad en puntos con líneas pendientes y consumo_diario suma lo
+# mismo que los detalles. Usa una base SQLite temporal.
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+DB_FILE = os.path.join(tempfile.mkdtemp(prefix="aquagest-asignacion-"), "asignacion.db")
+os.environ.setdefault("DATABASE_URL", f"sqlite+aiosqlite:///{DB_FILE}")
+os.environ.setdefault("AUTH_SECRET_KEY", "benchmark")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import insert, select, func
+import main
+
+
+async def seed(args, rng):
+    async with main.SessionLocal() as db:
+        await db.execute(insert(main.PuntoSuministro), [
+            {"codigo_punto": f"ASG-P{i:05}", "estado": "ACTIVO", "direccion": f"Punto {i}", "capacidad": 10 ** 9}
+            for i in range(args.puntos)
+        ])
+        puntos = (await db.execute(
+            select(main.PuntoSuministro.id_punto).where(main.PuntoSuministro.codigo_punto.like("ASG-P%"))
+        )).scalars().all()
+
+        pendiente = defaultdict(Decimal)
+        base = datetime.utcnow() - timedelta(days=30)
+        solicitudes = args.lineas // args.detalles
+        for start in range(0, solicitudes, 2000):
+            lote = range(start, min(solicitudes, start + 2000))
+            await db.execute(insert(main.Solicitud), [
+                {
+                    "codigo_solicitud": f"ASG-S{i:07}",
+                    "tipo_solicitud": "SUMINISTRO",
+                    "id_usuario_solicitante": 1,
+                    "fecha_solicitud": base + timedelta(seconds=rng.randint(0, 30 * 86400)),
+                    "estado": "PENDIENTE"
+                } for i in lote
+            ])
+            ids = (await db.execute(
+                select(main.Solicitud.id_solicitud)
+                .where(main.Solicitud.codigo_solicitud.in_([f"ASG-S{i:07}" for i in lote]))
+            )).scalars().all()
+            detalles = []
+            for id_solicitud in ids:
+                for _ in range(args.detalles):
+                    solicitada = Decimal(rng.randint(10, 100))
+                    reservada = Decimal(rng.randint(0, int(solicitada) - 1))
+                    id_punto = rng.choice(puntos)
+                    pendiente[id_punto] += solicitada - reservada
+                    detalles.append({
+                        "id_solicitud": id_solicitud, "id_punto": id_punto,
+                        "cantidad_solicitada": solicitada, "cantidad_reservada": reservada
+                    })
+            await db.execute(insert(main.DetalleSolicitud), detalles)
+        await db.execute(insert(main.Disponibilidad), [
+            {
+                "id_punto": id_punto, "estado_disponibilidad": "DISPONIBLE",
+                "cantidad_disponible": (pendiente[id_punto] * Decimal(args.cobertura)).quantize(Decimal("0.01"))
+            } for id_punto in puntos
+        ])
+        await db.commit()
+    # El acumulado de consumo refleja lo sembrado antes de asignar
+    async with main.SessionLocal() as db:
+        await main.ConsumoRepository(db).rebuild()
+
+
+async def snapshot():
+    async with main.SessionLocal() as db:
+        disponible = dict((await db.execute(
+            select(main.Disponibilidad.id_punto, main.Disponibilidad.cantidad_disponible)
+        )).all())
+        reservado = dict((await db.execute(
+            select(main.DetalleSolicitud.id_punto, func.sum(main.DetalleSolicitud.cantidad_reservada))
+            .group_by(main.DetalleSolicitud.id_punto)
+        )).all())
+        consumo = dict((await db.execute(
+            select(main.ConsumoDiario.id_punto, func.sum(main.ConsumoDiario.litros_reservados))
+            .group_by(main.ConsumoDiario.id_punto)
+        )).all())
+    return disponible, reservado, consumo
+
+
+def prioridad_respetada(lineas, asignaciones):
+    """En cada punto las líneas asignadas son un prefijo del orden de prioridad y todas salvo la
+    última quedan completas."""
+    asignado = {linea.id_detalle: cantidad for linea, cantidad in asignaciones}
+    cortado = set()
+    for linea in lineas:
+        cantidad = asignado.get(linea.id_detalle, Decimal(0))
+        if linea.id_punto in cortado and cantidad:
+            return False
+        if cantidad < Decimal(linea.pendiente):
+            cortado.add(linea.id_punto)
+    return True
+
+
+async def main_async(args):
+    rng = random.Random(args.seed)
+    await main.init_db()
+    start = time.perf_counter()
+    await seed(args, rng)
+    print(f"Siembra de {args.lineas} líneas en {args.puntos} puntos: {time.perf_counter() - start:.1f}s")
+
+    antes = await snapshot()
+    async with main.SessionLocal() as db:
+        start = time.perf_counter()
+        simulacion = await main.AsignacionRepository(db).asignar_pendientes(dry_run=True)
+        dry_run_s = time.perf_counter() - start
+    async with main.SessionLocal() as db:
+        repo = main.AsignacionRepository(db)
+        start = time.perf_counter()
+        lineas = (await db.execute(repo.pending_query())).all()
+        disponibles = await repo.disponibles()
+        lectura_s = time.perf_counter() - start
+        start = time.perf_counter()
+        asignaciones, _ = repo.calcular(lineas, disponibles)
+        calculo_s = time.perf_counter() - start
+        prioridad_ok = prioridad_respetada(lineas, asignaciones)
+        await db.rollback()
+    async with main.SessionLocal() as db:
+        start = time.perf_counter()
+        resultado = await main.AsignacionRepository(db).asignar_pendientes()
+        aplicar_s = time.perf_counter() - start
+    despues = await snapshot()
+
+    print(f"  líneas pendientes {resultado['lineas_pendientes']}, asignadas {resultado['lineas_asignadas']} "
+          f"({resultado['lineas_completas']} completas), litros {resultado['litros_asignados']:.0f} "
+          f"de {resultado['litros_pendientes']:.0f}")
+    print(f"  lectura {lectura_s * 1000:.0f} ms, cálculo {calculo_s * 1000:.0f} ms, "
+          f"dry_run {dry_run_s * 1000:.0f} ms, asignación aplicada {aplicar_s * 1000:.0f} ms")
+
+    errores = []
+    if simulacion["litros_asignados"] != resultado["litros_asignados"]:
+        errores.append("la simulación no coincide con la asignación aplicada")
+    for id_punto, disponible in antes[0].items():
+        debitado = Decimal(disponible) - Decimal(despues[0][id_punto])
+        asignado = Decimal(despues[1].get(id_punto, 0)) - Decimal(antes[1].get(id_punto, 0))
+        if Decimal(despues[0][id_punto]) < 0 or debitado != asignado:
+            errores.append(f"punto {id_punto}: debitado {debitado} != asignado {asignado}")
+        if Decimal(despues[2].get(id_punto, 0)) != Decimal(despues[1].get(id_punto, 0)):
+            errores.append(f"punto {id_punto}: consumo_diario no cuadra con los detalles")
+    if not prioridad_ok:
+        errores.append("una línea más reciente recibió disponibilidad antes que otra anterior del mismo punto")
+    async with main.SessionLocal() as db:
+        puntos_con_pendientes = {linea.id_punto for linea in (await db.execute(main.AsignacionRepository.pending_query())).all()}
+    for id_punto in puntos_con_pendientes:
+        if Decimal(despues[0].get(id_punto, 0)) > 0:
+            errores.append(f"punto {id_punto}: queda disponibilidad con líneas pendientes")
+    for error in errores[:10]:
+        print(f"❌ {error}")
+    await main.database.dispose()
+    print("✅ Libro consistente" if not errores else f"❌ {len(errores)} inconsistencias")
+    return not errores
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lineas", type=int, default=100000)
+    parser.add_argument("--detalles", type=int, default=2, help="líneas por solicitud")
+    parser.add_argument("--puntos", type=int, default=500)
+    parser.add_argument("--cobertura", type=float, default=0.6, help="fracción de lo pendiente que cubre la disponibilidad")
+    parser.add_argument("--seed", type=int, default=7)
+    sys.exit(0 if asyncio.run(main_async(parser.parse_args())) else 1)
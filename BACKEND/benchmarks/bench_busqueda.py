@@ -0,0 +1,113 @@
+# bench_busqueda.py - Latencia de /buscar con un índice de millones de términos
+#
+# Uso: python benchmarks/bench_busqueda.py [--consultas 100000] [--solicitudes 100000] [--busquedas 500]
+#
+# Siembra consultas con texto aleatorio en castellano (con tildes) y solicitudes con código, construye
+# el índice con BusquedaRepository.rebuild() y mide búsquedas de uno y dos términos, exactos y por
+# prefijo, contra la base (SQLite temporal o DATABASE_URL). Mide también lo que añade reindexar una
+# solicitud a su transacción.
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+DB_FILE = os.path.join(tempfile.mkdtemp(prefix="aquagest-busqueda-"), "busqueda.db")
+os.environ.setdefault("DATABASE_URL", f"sqlite+aiosqlite:///{DB_FILE}")
+os.environ.setdefault("AUTH_SECRET_KEY", "benchmark")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import insert, select, func
+import main
+
+PALABRAS = (
+    "fuga tubería presión caudal camión cisterna depósito válvula contador avería corte suministro "
+    "vecinos calle avenida plaza barrio urgente revisión análisis cloro turbidez factura lectura "
+    "mantenimiento emergencia hospital colegio riego incendio bomba arqueta acometida rotura "
+    "alcantarilla sequía restricción horario reparto litros garrafa potable depuradora"
+).split()
+CALLES = ["Mayor", "Real", "del Sol", "de la Paz", "San Martín", "Ñuñoa", "Castellana", "Alcalá", "Príncipe"]
+
+
+async def seed(args, rng):
+    async with main.SessionLocal() as db:
+        for start in range(0, args.consultas, 5000):
+            await db.execute(insert(main.Consulta), [
+                {
+                    "descripcion_consulta": " ".join(rng.choices(PALABRAS, k=5)) + f" calle {rng.choice(CALLES)}",
+                    "respuesta": " ".join(rng.choices(PALABRAS, k=rng.randint(5, 12))) if rng.random() < 0.7 else None,
+                    "usuarios_id_usuario": 1
+                } for _ in range(start, min(args.consultas, start + 5000))
+            ])
+        for start in range(0, args.solicitudes, 5000):
+            await db.execute(insert(main.Solicitud), [
+                {
+                    "codigo_solicitud": f"SOL-{i:07}",
+                    "tipo_solicitud": rng.choice(["SUMINISTRO", "EMERGENCIA", "MANTENIMIENTO"]),
+                    "id_usuario_solicitante": 1,
+                    "estado": "PENDIENTE"
+                } for i in range(start, min(args.solicitudes, start + 5000))
+            ])
+        await db.commit()
+
+
+def consultas_de_prueba(args, rng):
+    normalizar = main.BusquedaRepository.normalizar
+    casos = {
+        "1 término exacto": lambda: rng.choice(PALABRAS),
+        "1 prefijo": lambda: normalizar(rng.choice(PALABRAS))[:4],
+        "2 términos": lambda: " ".join(rng.sample(PALABRAS, 2)),
+        "código": lambda: f"SOL-{rng.randrange(args.solicitudes):07}"[:-2],
+    }
+    return {nombre: [genera() for _ in range(args.busquedas)] for nombre, genera in casos.items()}
+
+
+async def main_async(args):
+    rng = random.Random(args.seed)
+    await main.init_db()
+    start = time.perf_counter()
+    await seed(args, rng)
+    print(f"Siembra: {args.consultas} consultas y {args.solicitudes} solicitudes en {time.perf_counter() - start:.1f}s")
+
+    async with main.SessionLocal() as db:
+        start = time.perf_counter()
+        await main.BusquedaRepository(db).rebuild()
+        rebuild_s = time.perf_counter() - start
+        terminos = await db.scalar(select(func.count()).select_from(main.BusquedaTermino))
+    print(f"Índice: {terminos} filas de términos, reconstruido en {rebuild_s:.1f}s")
+
+    tipos = ["solicitudes", "consultas", "puntos"]
+    print(f"{'búsqueda':<18} {'p50_ms':>8} {'p95_ms':>8} {'resultados':>11}")
+    for nombre, consultas in consultas_de_prueba(args, rng).items():
+        tiempos, resultados = [], []
+        async with main.SessionLocal() as db:
+            repo = main.BusquedaRepository(db)
+            for q in consultas:
+                start = time.perf_counter()
+                _, items = await repo.buscar(q, tipos, 20)
+                tiempos.append(time.perf_counter() - start)
+                resultados.append(len(items))
+        tiempos.sort()
+        print(f"{nombre:<18} {statistics.median(tiempos) * 1000:>8.2f} {tiempos[int(len(tiempos) * 0.95)] * 1000:>8.2f} "
+              f"{statistics.mean(resultados):>11.1f}")
+
+    async with main.SessionLocal() as db:
+        ids = (await db.execute(select(main.Solicitud.id_solicitud).limit(args.busquedas))).scalars().all()
+        start = time.perf_counter()
+        for id_solicitud in ids:
+            await main.BusquedaRepository(db).indexar("solicitudes", [id_solicitud])
+        await db.commit()
+        print(f"Reindexar una solicitud: {(time.perf_counter() - start) / len(ids) * 1000:.2f} ms")
+    await main.database.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--consultas", type=int, default=100000)
+    parser.add_argument("--solicitudes", type=int, default=100000)
+    parser.add_argument("--busquedas", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=7)
+    asyncio.run(main_async(parser.parse_args()))
@@ -0,0 +1,116 @@
+# bench_cercanos.py - Latencia de /puntos-suministro/cercanos con decenas de miles de puntos
+#
+# Uso: python benchmarks/bench_cercanos.py [--puntos 50000] [--consultas 2000] [--cantidad 50]
+#
+# Siembra puntos aleatorios en una caja de ~800 km (base SQLite temporal), mide la carga inicial del
+# índice, la búsqueda en memoria y la petición completa por la API, y comprueba los resultados contra
+# un recorrido exhaustivo de todos los puntos.
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+DB_FILE = os.path.join(tempfile.mkdtemp(prefix="aquagest-cercanos-"), "cercanos.db")
+os.environ.setdefault("DATABASE_URL", f"sqlite+aiosqlite:///{DB_FILE}")
+os.environ.setdefault("AUTH_SECRET_KEY", "benchmark")
+# Un solo cliente genera toda la carga: sin límite por cliente
+os.environ.setdefault("RATE_LIMIT_RATE", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+from sqlalchemy import insert, select
+import main
+
+
+async def seed(args, rng):
+    async with main.SessionLocal() as db:
+        for start in range(0, args.puntos, 5000):
+            await db.execute(insert(main.PuntoSuministro), [
+                {
+                    "codigo_punto": f"GEO-{i:06}",
+                    "estado": "ACTIVO" if i % 10 else "INACTIVO",
+                    "direccion": f"Punto {i}",
+                    "capacidad": 100,
+                    "latitud": round(rng.uniform(36.0, 43.5), 6),
+                    "longitud": round(rng.uniform(-9.0, 3.0), 6)
+                } for i in range(start, min(args.puntos, start + 5000))
+            ])
+        ids = (await db.execute(
+            select(main.PuntoSuministro.id_punto).where(main.PuntoSuministro.codigo_punto.like("GEO-%"))
+        )).scalars().all()
+        await db.execute(insert(main.Disponibilidad), [
+            {"id_punto": id_punto, "estado_disponibilidad": "DISPONIBLE", "cantidad_disponible": rng.randint(0, 100)}
+            for id_punto in ids
+        ])
+        await db.commit()
+
+
+def exhaustivo(index, lat, lon, k, cantidad):
+    return [
+        id_punto for _, id_punto in sorted(
+            (index.distancia_km(lat, lon, p["latitud"], p["longitud"]), p["id_punto"])
+            for p in index.puntos.values() if p["cantidad_disponible"] >= cantidad
+        )[:k]
+    ]
+
+
+def resumen(nombre, tiempos):
+    tiempos = sorted(tiempos)
+    p95 = tiempos[int(len(tiempos) * 0.95)]
+    print(f"  {nombre:<18} p50 {statistics.median(tiempos) * 1e6:>9.1f} µs   p95 {p95 * 1e6:>9.1f} µs")
+
+
+async def main_async(args):
+    rng = random.Random(args.seed)
+    await main.init_db()
+    await seed(args, rng)
+    index = main.puntos_index
+
+    start = time.perf_counter()
+    await index.ensure_fresh()
+    print(f"{len(index.puntos)} puntos indexados, carga inicial {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    consultas = [(rng.uniform(36.0, 43.5), rng.uniform(-9.0, 3.0)) for _ in range(args.consultas)]
+    memoria = []
+    for lat, lon in consultas:
+        start = time.perf_counter()
+        index.nearest(lat, lon, args.k, args.cantidad)
+        memoria.append(time.perf_counter() - start)
+
+    for lat, lon in consultas[:args.verificar]:
+        obtenidos = [entry["id_punto"] for _, entry in index.nearest(lat, lon, args.k, args.cantidad)]
+        if obtenidos != exhaustivo(index, lat, lon, args.k, args.cantidad):
+            print(f"❌ Resultado distinto del recorrido exhaustivo en ({lat}, {lon})")
+            return False
+
+    api = []
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://cercanos") as client:
+        for lat, lon in consultas:
+            params = {"lat": lat, "lon": lon, "cantidad": args.cantidad, "k": args.k}
+            start = time.perf_counter()
+            response = await client.get("/puntos-suministro/cercanos", params=params)
+            api.append(time.perf_counter() - start)
+            assert response.status_code == 200, response.text
+    await main.database.dispose()
+
+    print(f"{args.consultas} consultas, k={args.k}, cantidad>={args.cantidad}")
+    resumen("índice", memoria)
+    resumen("petición API", api)
+    print(f"✅ {args.verificar} consultas coinciden con el recorrido exhaustivo")
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--puntos", type=int, default=50000)
+    parser.add_argument("--consultas", type=int, default=2000)
+    parser.add_argument("--cantidad", type=float, default=50)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--verificar", type=int, default=200, help="consultas comprobadas contra el recorrido exhaustivo")
+    parser.add_argument("--seed", type=int, default=7)
+    sys.exit(0 if asyncio.run(main_async(parser.parse_args())) else 1)
@@ -0,0 +1,112 @@
+# bench_login.py - Throughput de /auth/login con el hash de contraseñas en el pool vs. en el event loop
+#
+# Uso: python benchmarks/bench_login.py [--logins 200] [--concurrency 32] [--users 20]
+#
+# Usa una base SQLite temporal; no necesita MySQL.
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+DB_FILE = os.path.join(tempfile.mkdtemp(prefix="aquagest-bench-"), "bench.db")
+os.environ.setdefault("DATABASE_URL", f"sqlite+aiosqlite:///{DB_FILE}")
+os.environ.setdefault("AUTH_SECRET_KEY", "benchmark")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+import main
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+async def seed_users(client, users):
+    for i in range(users):
+        await client.post("/usuarios/registro", json={
+            "nombre": f"Bench {i}",
+            "email": f"bench{i}@aquagest.local",
+            "password": f"clave-{i}"
+        })
+
+
+async def run(client, logins, concurrency, users):
+    latencies = []
+    loop_lags = []
+    semaphore = asyncio.Semaphore(concurrency)
+    done = asyncio.Event()
+
+    async def login(i):
+        async with semaphore:
+            start = time.perf_counter()
+            response = await client.post("/auth/login", data={
+                "email": f"bench{i % users}@aquagest.local",
+                "password": f"clave-{i % users}"
+            })
+            latencies.append(time.perf_counter() - start)
+            assert response.status_code == 200, response.text
+
+    # Retraso del event loop: cuánto se pasa un sleep de 10 ms mientras se hacen logins.
+    # Es lo que esperaría cualquier otra petición atendida por el mismo worker.
+    async def monitor_loop():
+        while not done.is_set():
+            start = time.perf_counter()
+            await asyncio.sleep(0.01)
+            loop_lags.append(time.perf_counter() - start - 0.01)
+
+    monitor = asyncio.create_task(monitor_loop())
+    start = time.perf_counter()
+    await asyncio.gather(*(login(i) for i in range(logins)))
+    elapsed = time.perf_counter() - start
+    done.set()
+    await monitor
+
+    return {
+        "logins_por_segundo": round(logins / elapsed, 1),
+        "login_p50_ms": round(statistics.median(latencies) * 1000, 1),
+        "login_p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "retraso_loop_p95_ms": round(percentile(loop_lags, 95) * 1000, 1),
+        "retraso_loop_max_ms": round(max(loop_lags) * 1000, 1)
+    }
+
+
+async def main_async(args):
+    await main.init_db()
+    await main.startup_event()
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        await seed_users(client, args.users)
+        # Primera pasada: migra todas las contraseñas al hash actual
+        await run(client, args.users, args.concurrency, args.users)
+
+        results = {"pool": await run(client, args.logins, args.concurrency, args.users)}
+
+        # Mismo trabajo ejecutado dentro del event loop, como haría un hash "inline"
+        pooled_verify = main.password_hasher.verify
+
+        async def inline_verify(password, stored):
+            return main.password_hasher.verify_sync(password, stored)
+
+        main.password_hasher.verify = inline_verify
+        try:
+            results["inline"] = await run(client, args.logins, args.concurrency, args.users)
+        finally:
+            main.password_hasher.verify = pooled_verify
+    await main.shutdown_event()
+
+    print(f"\nscrypt n={main.password_hasher.n} r={main.password_hasher.r} p={main.password_hasher.p}, "
+          f"{main.password_hasher.workers} hilos, {args.logins} logins, concurrencia {args.concurrency}")
+    for mode, result in results.items():
+        print(f"  {mode:<7}", "  ".join(f"{k}={v}" for k, v in result.items()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--users", type=int, default=20)
+    asyncio.run(main_async(parser.parse_args()))
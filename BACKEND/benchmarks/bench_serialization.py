@@ -0,0 +1,85 @@
+# bench_serialization.py - Carga + serialización de solicitudes: entidades ORM con jsonable_encoder vs. columnas con modelo Pydantic
+#
+# Uso: python benchmarks/bench_serialization.py [--rows 10000 100000] [--repeat 3]
+#
+# Usa una base SQLite temporal; no necesita MySQL. "antes" reproduce lo que hacía FastAPI sin
+# response_model (select(Solicitud) + jsonable_encoder + json.dumps); "después" es el camino actual
+# (select de SOLICITUD_COLUMNAS + SolicitudPage serializado por pydantic-core).
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+DB_FILE = os.path.join(tempfile.mkdtemp(prefix="aquagest-serial-"), "serial.db")
+os.environ.setdefault("DATABASE_URL", f"sqlite+aiosqlite:///{DB_FILE}")
+os.environ.setdefault("AUTH_SECRET_KEY", "benchmark")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import select, insert, delete
+import main
+
+
+async def seed(rows):
+    async with main.SessionLocal() as db:
+        await db.execute(delete(main.Solicitud).where(main.Solicitud.codigo_solicitud.like("SER-%")))
+        base = datetime.now()
+        for start in range(0, rows, 5000):
+            await db.execute(insert(main.Solicitud), [
+                {
+                    "codigo_solicitud": f"SER-{i:07}",
+                    "tipo_solicitud": "SUMINISTRO",
+                    "id_usuario_solicitante": 1,
+                    "fecha_solicitud": base - timedelta(seconds=i),
+                    "estado": "PENDIENTE"
+                } for i in range(start, min(rows, start + 5000))
+            ])
+        await db.commit()
+
+
+async def antes(rows):
+    async with main.SessionLocal() as db:
+        start = time.perf_counter()
+        items = (await db.execute(select(main.Solicitud).limit(rows))).scalars().all()
+        loaded = time.perf_counter()
+        body = json.dumps(jsonable_encoder({"items": items, "next_cursor": None})).encode()
+        return loaded - start, time.perf_counter() - loaded, len(body)
+
+
+async def despues(rows):
+    async with main.SessionLocal() as db:
+        start = time.perf_counter()
+        items = (await db.execute(select(*main.SOLICITUD_COLUMNAS).limit(rows))).all()
+        loaded = time.perf_counter()
+        body = main.SolicitudPage(items=items, next_cursor=None).model_dump_json().encode()
+        return loaded - start, time.perf_counter() - loaded, len(body)
+
+
+async def main_async(args):
+    await main.create_tables()
+    async with main.SessionLocal() as db:
+        await main.create_sample_data(db)
+    print(f"{'filas':>8}  {'modo':<8} {'carga_ms':>9} {'serializa_ms':>13} {'total_ms':>9} {'bytes':>10}")
+    for rows in args.rows:
+        await seed(rows)
+        for name, run in (("antes", antes), ("después", despues)):
+            best = None
+            for _ in range(args.repeat):
+                result = await run(rows)
+                if best is None or sum(result[:2]) < sum(best[:2]):
+                    best = result
+            load, serialize, size = best
+            print(f"{rows:>8}  {name:<8} {load * 1000:>9.1f} {serialize * 1000:>13.1f} "
+                  f"{(load + serialize) * 1000:>9.1f} {size:>10}")
+    await main.engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--repeat", type=int, default=3)
+    asyncio.run(main_async(parser.parse_args()))
@@ -0,0 +1,84 @@
+# bench_startup.py - Tiempo de arranque de un worker: import de main, create_app y primera petición
+#
+# Uso: python benchmarks/bench_startup.py [--runs 10]
+#
+# Cada medición es un proceso Python nuevo, como un worker recién lanzado. Compara el arranque actual
+# (esquema preparado antes con init-db) con INIT_DB_ON_STARTUP=1, que repite migraciones y datos de
+# ejemplo en cada arranque como hacía antes el evento de startup. Usa una base SQLite temporal.
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def child():
+    """Se ejecuta en el proceso hijo: mide cada fase y escribe los tiempos en JSON por stdout."""
+    import httpx
+
+    start = time.perf_counter()
+    sys.path.insert(0, BACKEND_DIR)
+    import main
+    imported = time.perf_counter()
+    app = main.create_app()
+    created = time.perf_counter()
+
+    async def first_request():
+        async with app.router.lifespan_context(app):
+            started = time.perf_counter()
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://startup") as client:
+                response = await client.get("/puntos-suministro")
+                assert response.status_code == 200, response.text
+            return started, time.perf_counter()
+
+    started, answered = asyncio.run(first_request())
+    print(json.dumps({
+        "import_ms": (imported - start) * 1000,
+        "create_app_ms": (created - imported) * 1000,
+        "startup_ms": (started - created) * 1000,
+        "primera_peticion_ms": (answered - started) * 1000,
+        "total_ms": (answered - start) * 1000,
+    }))
+
+
+def run_child(env):
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child"],
+        env=env, capture_output=True, text=True, check=True, cwd=BACKEND_DIR
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main_parent(args):
+    db_file = os.path.join(tempfile.mkdtemp(prefix="aquagest-startup-"), "startup.db")
+    env = dict(os.environ)
+    env.setdefault("DATABASE_URL", f"sqlite+aiosqlite:///{db_file}")
+    env.setdefault("AUTH_SECRET_KEY", "benchmark")
+    env["INIT_DB_ON_STARTUP"] = "0"
+    subprocess.run([sys.executable, "main.py", "init-db"], env=env, check=True, cwd=BACKEND_DIR,
+                   stdout=subprocess.DEVNULL)
+
+    modes = {"init-db aparte": env, "INIT_DB_ON_STARTUP=1": dict(env, INIT_DB_ON_STARTUP="1")}
+    print(f"{args.runs} arranques por modo (mediana, ms)")
+    print(f"  {'modo':<22} {'import':>8} {'create_app':>11} {'startup':>8} {'1ª petición':>12} {'total':>8}")
+    for mode, mode_env in modes.items():
+        runs = [run_child(mode_env) for _ in range(args.runs)]
+        median = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+        print(f"  {mode:<22} {median['import_ms']:>8.1f} {median['create_app_ms']:>11.1f} "
+              f"{median['startup_ms']:>8.1f} {median['primera_peticion_ms']:>12.1f} {median['total_ms']:>8.1f}")
+
+
+if __name__ == "__main__":
+    if "--child" in sys.argv:
+        child()
+    else:
+        parser = argparse.ArgumentParser()
+        parser.add_argument("--runs", type=int, default=10)
+        main_parent(parser.parse_args())
@@ -0,0 +1,133 @@
+# check_query_plans.py - EXPLAIN de las consultas de los repositorios; falla si alguna recorre la tabla completa
+#
+# Uso:
+#   python benchmarks/check_query_plans.py              # SQLite temporal con todas las migraciones
+#   DATABASE_URL=mysql+aiomysql://... python benchmarks/check_query_plans.py
+#
+# Con MySQL conviene ejecutarlo sobre una base con datos representativos: con tablas casi vacías
+# el optimizador puede preferir un recorrido completo aunque exista el índice.
+import asyncio
+import os
+import re
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+if "DATABASE_URL" not in os.environ:
+    DB_FILE = os.path.join(tempfile.mkdtemp(prefix="aquagest-plans-"), "plans.db")
+    os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{DB_FILE}"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import select, update, func
+import main
+from main import (
+    Usuario, Solicitud, DetalleSolicitud, PuntoSuministro, Disponibilidad, Consulta, ConsumoDiario, BusquedaTermino,
+    SolicitudRepository, PuntoSuministroRepository, ConsumoRepository, AsignacionRepository, BusquedaRepository, PuntosCercanosIndex, encode_cursor
+)
+
+
+def repository_queries(dialect_name):
+    """(nombre, sentencia, permite_recorrido_completo) para cada consulta de los repositorios."""
+    hoy = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    cursor = encode_cursor({"fecha": hoy.isoformat(), "id": 1000})
+    return [
+        ("UsuarioRepository.get_by_email", select(Usuario).where(Usuario.email == "usuario@aquagest.local"), False),
+        ("UsuarioRepository.existing_emails",
+         select(Usuario.email).where(Usuario.email.in_(["a@aquagest.local", "b@aquagest.local"])), False),
+        # Sin filtros recorre el índice (fecha_solicitud, id_solicitud) en orden y se detiene en el LIMIT
+        ("SolicitudRepository.get_page", SolicitudRepository.page_query(50), True),
+        ("SolicitudRepository.get_page (cursor)", SolicitudRepository.page_query(50, cursor), False),
+        ("SolicitudRepository.get_page (usuario)", SolicitudRepository.page_query(50, user_id=1), False),
+        ("SolicitudRepository.get_page (usuario + cursor)", SolicitudRepository.page_query(50, cursor, user_id=1), False),
+        ("SolicitudRepository.get_page (estado)", SolicitudRepository.page_query(50, estado="PENDIENTE"), False),
+        ("SolicitudRepository.get_page (asesor)", SolicitudRepository.page_query(50, id_asesor=2), False),
+        ("SolicitudRepository.get_page (sin fecha)", SolicitudRepository.page_query(50, sin_fecha=True), False),
+        ("SolicitudRepository.get_page (sin fecha + cursor)",
+         SolicitudRepository.page_query(50, encode_cursor({"fecha": None, "id": 1000}), sin_fecha=True), False),
+        ("SolicitudRepository.existing_codigos",
+         select(Solicitud.codigo_solicitud).where(Solicitud.codigo_solicitud.in_(["SOL-00001", "SOL-00002"])), False),
+        ("SolicitudRepository.cancel (reservas)",
+         select(DetalleSolicitud.id_punto, func.sum(DetalleSolicitud.cantidad_reservada),
+                func.sum(DetalleSolicitud.cantidad_solicitada))
+         .where(DetalleSolicitud.id_solicitud == 1).group_by(DetalleSolicitud.id_punto), False),
+        ("ConsumoRepository.get_range", ConsumoRepository.range_query(hoy.date() - timedelta(days=30), hoy.date()), False),
+        ("ConsumoRepository.get_range (punto)",
+         ConsumoRepository.range_query(hoy.date() - timedelta(days=30), hoy.date(), 1), False),
+        ("ConsumoRepository.purge_empty",
+         select(ConsumoDiario.id_consumo).where(ConsumoDiario.fecha == hoy.date(), ConsumoDiario.id_punto.in_([1, 2]),
+                                                ConsumoDiario.solicitudes <= 0), False),
+        ("PuntoSuministroRepository.get_page", PuntoSuministroRepository.page_query(100), True),
+        ("PuntoSuministroRepository.get_page (cursor)",
+         PuntoSuministroRepository.page_query(100, encode_cursor({"id": 100})), False),
+        ("PuntoSuministroRepository.get_page (estado)", PuntoSuministroRepository.page_query(100, estado="ACTIVO"), False),
+        ("AsignacionRepository.pending_query", AsignacionRepository.pending_query(), False),
+        ("BusquedaRepository.search_query",
+         BusquedaRepository.search_query(["calle", "mayor"], ["solicitudes", "consultas", "puntos"], 20, dialect_name), False),
+        ("BusquedaRepository.reindexar (borrado)",
+         select(BusquedaTermino.id_termino).where(BusquedaTermino.tipo == "solicitudes", BusquedaTermino.id_entidad.in_([1, 2])), False),
+        ("PuntosCercanosIndex.load_query (puntos)", PuntosCercanosIndex.load_query([1, 2]), False),
+        ("DisponibilidadRepository.snapshot",
+         select(Disponibilidad.id_punto, Disponibilidad.cantidad_disponible).where(Disponibilidad.id_punto.in_([1, 2])), False),
+        ("DisponibilidadRepository.debitar",
+         update(Disponibilidad).where(Disponibilidad.id_punto == 1, Disponibilidad.cantidad_disponible >= 5)
+         .values(cantidad_disponible=Disponibilidad.cantidad_disponible - 5), False),
+        ("dashboard: puntos_activos",
+         select(func.count()).select_from(PuntoSuministro).where(PuntoSuministro.estado == "ACTIVO"), False),
+        ("dashboard: solicitudes_hoy",
+         select(func.count()).select_from(Solicitud).where(Solicitud.fecha_solicitud >= hoy), False),
+        ("consultas por estado",
+         select(Consulta).where(Consulta.estado_consulta == "PENDIENTE", Consulta.fecha_consulta >= hoy - timedelta(days=30)), False),
+        # Los totales del dashboard cuentan la tabla entera por definición
+        ("dashboard: total_solicitudes", select(func.count()).select_from(Solicitud), True),
+    ]
+
+
+def explain_sql(dialect_name):
+    return "EXPLAIN QUERY PLAN " if dialect_name == "sqlite" else "EXPLAIN "
+
+
+def table_scans(dialect_name, rows):
+    """Tablas recorridas completas (la tabla o un índice entero) según el plan devuelto por EXPLAIN."""
+    if dialect_name == "sqlite":
+        # "SCAN tabla" o "SCAN tabla USING INDEX ..." recorren todo; "SEARCH" usa el índice para filtrar
+        return [m.group(1) for row in rows if (m := re.match(r"SCAN (\w+)", row[-1].strip()))]
+    # MySQL: access type ALL (tabla completa) o index (índice completo)
+    return [row._mapping["table"] for row in rows if row._mapping.get("type") in ("ALL", "index")]
+
+
+def run_explain(conn, statement):
+    compiled = statement.compile(dialect=conn.dialect, compile_kwargs={"render_postcompile": True})
+    if compiled.positional:
+        params = tuple(compiled.params[name] for name in compiled.positiontup)
+    else:
+        params = compiled.params
+    return conn.exec_driver_sql(explain_sql(conn.dialect.name) + compiled.string, params).fetchall()
+
+
+def check(conn):
+    failures = 0
+    for name, statement, allow_scan in repository_queries(conn.dialect.name):
+        rows = run_explain(conn, statement)
+        scans = table_scans(conn.dialect.name, rows)
+        if scans and not allow_scan:
+            failures += 1
+            print(f"❌ {name}: recorrido completo de {', '.join(scans)}")
+            for row in rows:
+                print(f"      {tuple(row)}")
+        else:
+            print(f"✅ {name}" + (" (recorrido completo permitido)" if scans else ""))
+    return failures
+
+
+async def main_async():
+    if main.engine.dialect.name == "sqlite":
+        await main.run_migrations()
+    async with main.engine.connect() as conn:
+        failures = await conn.run_sync(check)
+    await main.engine.dispose()
+    print(f"\n{failures} consultas con recorrido completo" if failures else "\nTodas las consultas usan índices")
+    return failures == 0
+
+
+if __name__ == "__main__":
+    sys.exit(0 if asyncio.run(main_async()) else 1)
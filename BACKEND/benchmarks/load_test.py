@@ -0,0 +1,277 @@
+# load_test.py - Carga concurrente contra la API con datos sembrados; resultados en JSON para comparar entre versiones
+#
+# Uso:
+#   python benchmarks/load_test.py [--usuarios 200] [--puntos 50] [--solicitudes 5000] [--requests 2000] [--concurrency 32]
+#   python benchmarks/load_test.py --output resultados/hoy.json --compare resultados/ayer.json
+#
+# Usa una base SQLite temporal (o DATABASE_URL si está definida) y llama a la app en proceso con
+# httpx.ASGITransport, así que mide la API y la base de datos sin la red de por medio. Con la misma
+# semilla y los mismos volúmenes, la secuencia de peticiones es idéntica entre ejecuciones.
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+if "DATABASE_URL" not in os.environ:
+    DB_FILE = os.path.join(tempfile.mkdtemp(prefix="aquagest-load-"), "load.db")
+    # SQLite serializa las escrituras: un timeout amplio evita "database is locked" con concurrencia alta
+    os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{DB_FILE}?timeout=30"
+os.environ.setdefault("AUTH_SECRET_KEY", "load-test")
+# Un solo cliente genera toda la carga: sin límite por cliente
+os.environ.setdefault("RATE_LIMIT_RATE", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+from sqlalchemy import insert, select
+import main
+
+PASSWORD = "carga-1234"
+
+# Peso de cada endpoint en la mezcla de tráfico
+ENDPOINTS = {
+    "POST /auth/login": 2,
+    "GET /solicitudes": 5,
+    "POST /solicitudes": 2,
+    "GET /dashboard/stats": 4,
+    "POST /reportes/generar": 1,
+}
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+async def seed(args):
+    """Inserta los volúmenes pedidos con inserts en bloque (todas las cuentas comparten contraseña)."""
+    rng = random.Random(args.seed)
+    password_hash = main.password_hasher.hash_sync(PASSWORD)
+    async with main.SessionLocal() as db:
+        await db.execute(insert(main.PuntoSuministro), [
+            {
+                "codigo_punto": f"CARGA-P{i:05}",
+                "estado": "ACTIVO" if i % 10 else "INACTIVO",
+                "direccion": f"Calle de carga {i}",
+                "capacidad": Decimal("100000.00")
+            } for i in range(args.puntos)
+        ])
+        puntos = (await db.execute(
+            select(main.PuntoSuministro.id_punto).where(main.PuntoSuministro.codigo_punto.like("CARGA-P%"))
+        )).scalars().all()
+        await db.execute(insert(main.Disponibilidad), [
+            {"id_punto": id_punto, "estado_disponibilidad": "DISPONIBLE", "cantidad_disponible": Decimal("100000.00")}
+            for id_punto in puntos
+        ])
+
+        await db.execute(insert(main.Usuario), [
+            {
+                "nombre": f"Carga {i}",
+                "apellidos": "Benchmark",
+                "email": f"carga{i}@aquagest.local",
+                "tipo_usuario": "ASESOR" if i % 20 == 0 else "USUARIO",
+                "password": password_hash
+            } for i in range(args.usuarios)
+        ])
+        usuarios = (await db.execute(
+            select(main.Usuario.id_usuario).where(main.Usuario.email.like("carga%@aquagest.local"))
+        )).scalars().all()
+
+        ahora = datetime.now()
+        for start in range(0, args.solicitudes, 1000):
+            lote = range(start, min(args.solicitudes, start + 1000))
+            await db.execute(insert(main.Solicitud), [
+                {
+                    "codigo_solicitud": f"CARGA-S{i:07}",
+                    "tipo_solicitud": rng.choice(["SUMINISTRO", "EMERGENCIA", "MANTENIMIENTO"]),
+                    "id_usuario_solicitante": rng.choice(usuarios),
+                    "fecha_solicitud": ahora - timedelta(minutes=rng.randint(0, 60 * 24 * 90)),
+                    "estado": rng.choice(["PENDIENTE", "PENDIENTE", "APROBADA", "CANCELADA"])
+                } for i in lote
+            ])
+            ids = (await db.execute(
+                select(main.Solicitud.id_solicitud)
+                .where(main.Solicitud.codigo_solicitud.in_([f"CARGA-S{i:07}" for i in lote]))
+            )).scalars().all()
+            detalles = []
+            for id_solicitud in ids:
+                for _ in range(args.detalles):
+                    cantidad = Decimal(rng.randint(1, 50))
+                    detalles.append({
+                        "id_solicitud": id_solicitud,
+                        "id_punto": rng.choice(puntos),
+                        "cantidad_solicitada": cantidad,
+                        "cantidad_reservada": cantidad
+                    })
+            if detalles:
+                await db.execute(insert(main.DetalleSolicitud), detalles)
+        await db.commit()
+    return usuarios, puntos
+
+
+async def login(client, i):
+    return await client.post("/auth/login", data={"email": f"carga{i}@aquagest.local", "password": PASSWORD})
+
+
+async def run_traffic(client, args, tokens, puntos):
+    rng = random.Random(args.seed + 1)
+    names = list(ENDPOINTS)
+    plan = rng.choices(names, weights=[ENDPOINTS[name] for name in names], k=args.requests)
+    results = {name: {"latencias": [], "errores": 0} for name in names}
+    semaphore = asyncio.Semaphore(args.concurrency)
+    secuencia = iter(range(args.requests))
+
+    async def request(name, i):
+        user = i % args.usuarios
+        headers = {"Authorization": f"Bearer {tokens[user % len(tokens)]}"}
+        if name == "POST /auth/login":
+            return await login(client, user)
+        if name == "GET /solicitudes":
+            return await client.get("/solicitudes", params={"limit": 50}, headers=headers)
+        if name == "POST /solicitudes":
+            return await client.post("/solicitudes", headers=headers, json={
+                "codigo_solicitud": f"CARGA-N{args.seed}-{next(secuencia):07}",
+                "tipo_solicitud": "SUMINISTRO",
+                "detalles": [{"id_punto": puntos[i % len(puntos)], "cantidad_solicitada": 1}]
+            })
+        if name == "GET /dashboard/stats":
+            return await client.get("/dashboard/stats")
+        # Los reportes son solo para el personal: carga0 es ASESOR
+        return await client.post("/reportes/generar", headers={"Authorization": f"Bearer {tokens[0]}"},
+                                 data={"tipo_reporte": "solicitudes", "formato": args.formato_reporte})
+
+    async def timed(name, i):
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                response = await request(name, i)
+                ok = response.status_code < 400
+            except Exception:
+                ok = False
+            results[name]["latencias"].append(time.perf_counter() - start)
+            results[name]["errores"] += 0 if ok else 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(timed(name, i) for i, name in enumerate(plan)))
+    elapsed = time.perf_counter() - start
+
+    resumen = {}
+    for name, result in results.items():
+        latencias = result["latencias"]
+        if not latencias:
+            continue
+        resumen[name] = {
+            "peticiones": len(latencias),
+            "errores": result["errores"],
+            "por_segundo": round(len(latencias) / elapsed, 1),
+            "p50_ms": round(percentile(latencias, 50) * 1000, 2),
+            "p95_ms": round(percentile(latencias, 95) * 1000, 2),
+            "p99_ms": round(percentile(latencias, 99) * 1000, 2),
+        }
+    todas = [latencia for result in results.values() for latencia in result["latencias"]]
+    resumen["total"] = {
+        "peticiones": len(todas),
+        "errores": sum(result["errores"] for result in results.values()),
+        "por_segundo": round(len(todas) / elapsed, 1),
+        "p50_ms": round(percentile(todas, 50) * 1000, 2),
+        "p95_ms": round(percentile(todas, 95) * 1000, 2),
+        "p99_ms": round(percentile(todas, 99) * 1000, 2),
+    }
+    return resumen, elapsed
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(actual, anterior_path):
+    with open(anterior_path) as f:
+        data = json.load(f)
+    anterior = data["endpoints"]
+    print(f"\nComparación con {anterior_path} (commit {data.get('commit') or '?'}, {data.get('fecha')}):")
+    for name, result in actual.items():
+        previo = anterior.get(name)
+        if not previo:
+            continue
+        delta_rps = (result["por_segundo"] - previo["por_segundo"]) / previo["por_segundo"] * 100 if previo["por_segundo"] else 0
+        delta_p95 = (result["p95_ms"] - previo["p95_ms"]) / previo["p95_ms"] * 100 if previo["p95_ms"] else 0
+        print(f"  {name:<24} req/s {previo['por_segundo']:>8} -> {result['por_segundo']:<8} ({delta_rps:+.1f}%)  "
+              f"p95 {previo['p95_ms']:>8} -> {result['p95_ms']:<8} ({delta_p95:+.1f}%)")
+
+
+async def main_async(args):
+    await main.init_db()
+    await main.startup_event()
+    seed_start = time.perf_counter()
+    usuarios, puntos = await seed(args)
+    seed_seconds = time.perf_counter() - seed_start
+    main.dashboard_cache.invalidate()
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://load", timeout=None) as client:
+        # Un token por usuario (hasta 50); también calienta el pool y los hashes
+        tokens = []
+        for i in range(min(args.usuarios, 50)):
+            response = await login(client, i)
+            tokens.append(response.json()["access_token"])
+        queries_before = main.metrics_registry.db_queries["total"]
+        resumen, elapsed = await run_traffic(client, args, tokens, puntos)
+        queries = main.metrics_registry.db_queries["total"] - queries_before
+    await main.shutdown_event()
+
+    report = {
+        "fecha": datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "base_de_datos": main.engine.dialect.name,
+        "parametros": vars(args),
+        "siembra_s": round(seed_seconds, 2),
+        "duracion_s": round(elapsed, 2),
+        "consultas_sql": queries,
+        "endpoints": resumen,
+    }
+    output = args.output or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "results", f"load_{datetime.now():%Y%m%d_%H%M%S}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+
+    print(f"\n{args.requests} peticiones en {elapsed:.2f}s, concurrencia {args.concurrency}, "
+          f"{queries} consultas SQL ({report['base_de_datos']})")
+    print(f"  {'endpoint':<24} {'req/s':>8} {'p50_ms':>8} {'p95_ms':>8} {'p99_ms':>8} {'errores':>8}")
+    for name, result in resumen.items():
+        print(f"  {name:<24} {result['por_segundo']:>8} {result['p50_ms']:>8} {result['p95_ms']:>8} "
+              f"{result['p99_ms']:>8} {result['errores']:>8}")
+    print(f"\nResultados guardados en {output}")
+    if args.compare:
+        compare(resumen, args.compare)
+    return resumen["total"]["errores"] == 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--usuarios", type=int, default=200)
+    parser.add_argument("--puntos", type=int, default=50)
+    parser.add_argument("--solicitudes", type=int, default=5000)
+    parser.add_argument("--detalles", type=int, default=2, help="detalles por solicitud sembrada")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--formato-reporte", default="ndjson", choices=["json", "ndjson", "csv"])
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--output", help="fichero JSON de resultados (por defecto benchmarks/results/load_<fecha>.json)")
+    parser.add_argument("--compare", help="JSON de una ejecución anterior para mostrar la diferencia")
+    sys.exit(0 if asyncio.run(main_async(parser.parse_args())) else 1)
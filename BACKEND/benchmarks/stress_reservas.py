@@ -0,0 +1,98 @@
+# stress_reservas.py - Muchas solicitudes concurrentes contra un mismo punto de suministro
+#
+# Uso: python benchmarks/stress_reservas.py [--requests 300] [--concurrency 50] [--disponible 1000]
+#
+# Comprueba que la disponibilidad nunca queda negativa y que el libro cuadra:
+# disponible_inicial - disponible_final == suma de lo reservado por solicitudes no canceladas, y que el
+# acumulado consumo_diario del punto suma lo mismo. Termina con código 1 si alguna condición falla.
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+from decimal import Decimal
+
+DB_FILE = os.path.join(tempfile.mkdtemp(prefix="aquagest-stress-"), "stress.db")
+os.environ.setdefault("DATABASE_URL", f"sqlite+aiosqlite:///{DB_FILE}")
+os.environ.setdefault("AUTH_SECRET_KEY", "stress")
+# Un solo cliente genera toda la carga: sin límite por cliente
+os.environ.setdefault("RATE_LIMIT_RATE", "0")
+os.environ.setdefault("PASSWORD_SCRYPT_N", "1024")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+from sqlalchemy import select, update, func
+import main
+
+
+async def ledger(id_punto):
+    async with main.SessionLocal() as db:
+        disponible = await db.scalar(
+            select(main.Disponibilidad.cantidad_disponible).where(main.Disponibilidad.id_punto == id_punto)
+        )
+        reservado = await db.scalar(
+            select(func.coalesce(func.sum(main.DetalleSolicitud.cantidad_reservada), 0))
+            .join(main.Solicitud, main.Solicitud.id_solicitud == main.DetalleSolicitud.id_solicitud)
+            .where(main.DetalleSolicitud.id_punto == id_punto, main.Solicitud.estado != "CANCELADA")
+        )
+        acumulado = await db.scalar(
+            select(func.coalesce(func.sum(main.ConsumoDiario.litros_reservados), 0))
+            .where(main.ConsumoDiario.id_punto == id_punto)
+        )
+        return Decimal(disponible), Decimal(reservado), Decimal(acumulado)
+
+
+async def main_async(args):
+    await main.init_db()
+    await main.startup_event()
+    id_punto = 1
+    inicial = Decimal(args.disponible).quantize(Decimal("0.01"))
+    async with main.SessionLocal() as db:
+        await db.execute(
+            update(main.Disponibilidad).where(main.Disponibilidad.id_punto == id_punto).values(cantidad_disponible=inicial)
+        )
+        await db.commit()
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://stress") as client:
+        await client.post("/usuarios/registro", json={"nombre": "Stress", "email": "stress@aquagest.local", "password": "stress"})
+        login = await client.post("/auth/login", data={"email": "stress@aquagest.local", "password": "stress"})
+        headers = {"Authorization": f"Bearer {login.json()['access_token']}"}
+
+        semaphore = asyncio.Semaphore(args.concurrency)
+        estados = {}
+        rng = random.Random(args.seed)
+
+        async def solicitar(i):
+            async with semaphore:
+                response = await client.post("/solicitudes", headers=headers, json={
+                    "codigo_solicitud": f"STRESS-{i:06}",
+                    "tipo_solicitud": "SUMINISTRO",
+                    "permitir_parcial": rng.random() < 0.3,
+                    "detalles": [{"id_punto": id_punto, "cantidad_solicitada": rng.randint(1, 25)}]
+                })
+                estados[response.status_code] = estados.get(response.status_code, 0) + 1
+                # Algunas se cancelan enseguida, compitiendo con las reservas en curso
+                if response.status_code == 200 and rng.random() < 0.2:
+                    cancel = await client.post(f"/solicitudes/{response.json()['solicitud_id']}/cancelar", headers=headers)
+                    estados["canceladas"] = estados.get("canceladas", 0) + (cancel.status_code == 200)
+
+        await asyncio.gather(*(solicitar(i) for i in range(args.requests)))
+    await main.shutdown_event()
+
+    disponible, reservado, acumulado = await ledger(id_punto)
+    ok = disponible >= 0 and inicial - disponible == reservado == acumulado
+    print(f"\nrespuestas: {estados}")
+    print(f"disponible inicial={inicial} final={disponible} reservado={reservado} consumo_diario={acumulado}")
+    print("✅ Libro consistente" if ok else "❌ Libro inconsistente")
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--disponible", type=float, default=1000)
+    parser.add_argument("--seed", type=int, default=7)
+    sys.exit(0 if asyncio.run(main_async(parser.parse_args())) else 1)
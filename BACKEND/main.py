@@ -1,24 +1,46 @@
 # main.py - Backend completo para AquaGest
-from fastapi import FastAPI, Depends, HTTPException, Form
+from fastapi import FastAPI, APIRouter, Depends, HTTPException, Form, Query, Request, Header
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Numeric, Text, text
-from sqlalchemy.orm import declarative_base, sessionmaker, Session
-from pydantic import BaseModel
+from fastapi.responses import StreamingResponse, Response, FileResponse, JSONResponse
+from sqlalchemy import Column, Integer, String, Date, DateTime, Numeric, Text, ForeignKey, Index, MetaData, Table, text, select, func, or_, insert, update, delete, bindparam, case
+from sqlalchemy import inspect as sql_inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy import event
+from sqlalchemy.dialects import mysql, sqlite
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.orm import declarative_base, Session
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from pydantic import BaseModel, ConfigDict
 from typing import Optional, List
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from decimal import Decimal, InvalidOperation
+import asyncio
+import base64
+import argparse
+import collections
+import contextlib
+import contextvars
+import csv
+import gzip
+import hashlib
+import hmac
+import inspect
+import io
+import json
+import math
+import multiprocessing
 import os
+import re
+import secrets
+import time
+import unicodedata
 from dotenv import load_dotenv
 
-# Configuración de PyMySQL para trabajar con SQLAlchemy
-import pymysql
-pymysql.install_as_MySQLdb()
-
 # Cargar variables de entorno
 load_dotenv()
 
-print("🔧 Iniciando AquaGest...")
-print("🔧 Cargando configuración...")
-
 # Configuración de la base de datos
 DB_HOST = os.getenv('DB_HOST', 'localhost')
 DB_PORT = os.getenv('DB_PORT', '3306')
@@ -26,84 +48,422 @@ DB_NAME = os.getenv('DB_NAME', 'sistema_suministro')
 DB_USER = os.getenv('DB_USER', 'root')
 DB_PASSWORD = os.getenv('DB_PASSWORD', 'root')
 
-DATABASE_URL = f"mysql+pymysql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+# Driver asíncrono (aiomysql) para no bloquear el event loop en las rutas async.
+# DATABASE_URL permite apuntar a otra base, p. ej. "sqlite+aiosqlite:///./aquagest.db" para pruebas locales.
+DATABASE_URL = os.getenv(
+    'DATABASE_URL',
+    f"mysql+aiomysql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+)
+
+# Pool de conexiones: DB_CONNECTION_BUDGET es el total que admite la base para esta aplicación y
+# se reparte entre los WEB_WORKERS procesos (el lanzador de producción fija WEB_WORKERS)
+WEB_WORKERS = int(os.getenv('WEB_WORKERS', '1'))
+DB_CONNECTION_BUDGET = int(os.getenv('DB_CONNECTION_BUDGET', '100'))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '1800'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '30'))
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', '1') == '1'
+
+def pool_settings(workers: Optional[int] = None, budget: Optional[int] = None):
+    """Opciones de pool de cada worker. DB_POOL_SIZE / DB_MAX_OVERFLOW fijan los valores a mano."""
+    workers = max(1, workers or WEB_WORKERS)
+    per_worker = max(1, (budget or DB_CONNECTION_BUDGET) // workers)
+    # 3/4 del reparto como conexiones fijas y el resto como overflow para picos
+    pool_size = int(os.getenv('DB_POOL_SIZE', max(1, per_worker - per_worker // 4)))
+    max_overflow = int(os.getenv('DB_MAX_OVERFLOW', max(0, per_worker - pool_size)))
+    return {
+        "pool_size": pool_size,
+        "max_overflow": max_overflow,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_pre_ping": DB_POOL_PRE_PING
+    }
 
-print(f"🔗 Conectando a: {DB_HOST}:{DB_PORT}/{DB_NAME}")
-print(f"👤 Usuario: {DB_USER}")
+# Réplicas de solo lectura (opcionales), p. ej. "mysql+aiomysql://.../db,mysql+aiomysql://.../db"
+DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+# Tras escribir, las lecturas de ese cliente van a la primaria durante este tiempo (read-your-writes).
+# El cliente lo lleva (cabecera X-Ultima-Escritura o cookie ultima_escritura), así que vale aunque la
+# siguiente petición vaya a otro worker
+REPLICA_STICKY_SECONDS = float(os.getenv('REPLICA_STICKY_SECONDS', '5'))
+REPLICA_HEALTH_INTERVAL = float(os.getenv('REPLICA_HEALTH_INTERVAL', '10'))
+REPLICA_HEALTH_TIMEOUT = float(os.getenv('REPLICA_HEALTH_TIMEOUT', '2'))
 
-try:
-    engine = create_engine(DATABASE_URL, echo=False)
-    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-    Base = declarative_base()
-    print("✅ Configuración de base de datos lista")
-except Exception as e:
-    print(f"❌ Error configurando base de datos: {e}")
-    print("💡 Verifica que MySQL esté corriendo y las credenciales sean correctas")
-    exit(1)
+def engine_options(url: str):
+    # SQLite (pruebas y benchmarks) no tiene límite de conexiones que repartir
+    if make_url(url).get_backend_name() == "sqlite":
+        return {}
+    return pool_settings()
+
+Base = declarative_base()
 
 # === PATRONES DE DISEÑO ===
 
 # Patrón 1: Singleton para configuración de BD
 class DatabaseConfig:
+    """El engine y la fábrica de sesiones se crean en el primer uso, no al importar el módulo:
+    importar main (workers, scripts, benchmarks) no abre conexiones.
+    """
     _instance = None
     
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super(DatabaseConfig, cls).__new__(cls)
-            cls._instance.engine = engine
-            cls._instance.session_local = SessionLocal
+            cls._instance._engine = None
+            cls._instance._session_local = None
+            cls._instance._replicas = None
         return cls._instance
+    
+    @property
+    def engine(self):
+        if self._engine is None:
+            url = make_url(DATABASE_URL)
+            print(f"🔗 Conectando a: {url.get_backend_name()}://{url.host or ''}/{url.database or ''}")
+            self._engine = create_async_engine(DATABASE_URL, echo=False, **engine_options(DATABASE_URL))
+            # expire_on_commit=False: tras el commit no hay lazy-loads implícitos (no permitidos en modo async)
+            self._session_local = async_sessionmaker(
+                self._engine, class_=AsyncSession, autoflush=False, expire_on_commit=False
+            )
+            metrics_registry.track_pool("principal", self._engine)
+        return self._engine
+    
+    @property
+    def session_local(self):
+        if self._session_local is None:
+            self.engine
+        return self._session_local
+    
+    @property
+    def replicas(self):
+        if self._replicas is None:
+            self._replicas = ReplicaRouter(DATABASE_REPLICA_URLS, REPLICA_STICKY_SECONDS)
+        return self._replicas
+    
+    def read_session(self, *sticky_keys, ultima_escritura: Optional[float] = None):
+        """Sesión para consultas de solo lectura: una réplica sana, o la primaria si no hay ninguna,
+        si alguna de `sticky_keys` escribió hace poco o si el cliente escribió en `ultima_escritura`."""
+        session_local = self.replicas.pick(sticky_keys, ultima_escritura)
+        return (session_local or self.session_local)()
+    
+    async def dispose(self):
+        if self._engine is not None:
+            await self._engine.dispose()
+        if self._replicas is not None:
+            await self._replicas.dispose()
+
+database = DatabaseConfig()
+
+def __getattr__(name):
+    # main.engine y main.SessionLocal siguen disponibles para scripts; se crean al primer acceso
+    if name == "engine":
+        return database.engine
+    if name == "SessionLocal":
+        return database.session_local
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # Patrón 2: Factory para crear reportes
 class ReportFactory:
-    @staticmethod
-    def create_report(report_type: str, data: list):
-        reports = {
-            "solicitudes": {
-                "tipo": "📋 Reporte de Solicitudes",
-                "descripcion": "Listado completo de solicitudes de agua"
-            },
-            "usuarios": {
-                "tipo": "👥 Reporte de Usuarios", 
-                "descripcion": "Listado de usuarios del sistema"
-            },
-            "puntos": {
-                "tipo": "📍 Reporte de Puntos de Suministro",
-                "descripcion": "Listado de puntos de distribución"
-            }
+    reports = {
+        "solicitudes": {
+            "tipo": "📋 Reporte de Solicitudes",
+            "descripcion": "Listado completo de solicitudes de agua"
+        },
+        "usuarios": {
+            "tipo": "👥 Reporte de Usuarios", 
+            "descripcion": "Listado de usuarios del sistema"
+        },
+        "puntos": {
+            "tipo": "📍 Reporte de Puntos de Suministro",
+            "descripcion": "Listado de puntos de distribución"
         }
-        
-        report_info = reports.get(report_type, {"tipo": "📄 Reporte", "descripcion": ""})
+    }
+    
+    @staticmethod
+    def create_header(report_type: str):
+        report_info = ReportFactory.reports.get(report_type, {"tipo": "📄 Reporte", "descripcion": ""})
         
         return {
             "tipo": report_info["tipo"],
             "descripcion": report_info["descripcion"],
-            "datos": data,
             "fecha_generacion": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "total_registros": len(data),
             "sistema": "AquaGest v1.0"
         }
+    
+    @staticmethod
+    def create_report(report_type: str, data: list):
+        header = ReportFactory.create_header(report_type)
+        
+        return {
+            "tipo": header["tipo"],
+            "descripcion": header["descripcion"],
+            "datos": data,
+            "fecha_generacion": header["fecha_generacion"],
+            "total_registros": len(data),
+            "sistema": header["sistema"]
+        }
+    
+    @staticmethod
+    async def stream_report(report_type: str, rows, formato: str = "ndjson", chunk_size: int = 500):
+        """Genera el reporte por partes: cabecera, filas por lotes y línea final con total_registros.
+        
+        `rows` es un iterador asíncrono de dicts; nunca se materializa la tabla completa.
+        """
+        header = ReportFactory.create_header(report_type)
+        total = 0
+        
+        if formato == "csv":
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow([f"# tipo: {header['tipo']}", f"fecha_generacion: {header['fecha_generacion']}"])
+            columns = None
+            async for row in rows:
+                if columns is None:
+                    columns = list(row.keys())
+                    writer.writerow(columns)
+                writer.writerow([row[c] for c in columns])
+                total += 1
+                if total % chunk_size == 0:
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+            writer.writerow([f"# total_registros: {total}"])
+            yield buffer.getvalue()
+        else:
+            yield json.dumps(header, ensure_ascii=False) + "\n"
+            lines = []
+            async for row in rows:
+                lines.append(json.dumps(row, ensure_ascii=False))
+                total += 1
+                if len(lines) >= chunk_size:
+                    yield "\n".join(lines) + "\n"
+                    lines = []
+            if lines:
+                yield "\n".join(lines) + "\n"
+            yield json.dumps({"total_registros": total}) + "\n"
 
 # Patrón 3: Observer para notificaciones
 class NotificationManager:
-    def __init__(self):
+    """Historial acotado (ring buffer) y entrega a los observadores en una tarea de fondo.
+    
+    Los observadores pueden ser funciones normales o corutinas. Los registrados con
+    inline=True se ejecutan dentro de notify() y deben ser baratos (p. ej. invalidar una caché).
+    """
+    
+    DROP_POLICIES = ("drop_oldest", "drop_newest")
+    
+    def __init__(self, max_notifications: int = 1000, queue_size: int = 10000, drop_policy: str = "drop_oldest"):
+        if drop_policy not in self.DROP_POLICIES:
+            raise ValueError(f"Política de descarte no válida: {drop_policy}")
         self.observers = []
-        self.notifications = []
+        self.inline_observers = []
+        self.notifications = collections.deque(maxlen=max_notifications)
+        self.queue_size = queue_size
+        self.drop_policy = drop_policy
+        self._queue = None
+        self._worker = None
+        self._last_id = 0
+        # Notificación que se está entregando; los observadores pueden leer su id y timestamp
+        self.current = None
+        self.stats = {
+            "encoladas": 0,
+            "entregadas": 0,
+            "descartadas": 0,
+            "errores_observador": 0,
+            "latencia_total_ms": 0.0,
+            "latencia_max_ms": 0.0
+        }
     
-    def add_observer(self, observer_func):
-        self.observers.append(observer_func)
+    def add_observer(self, observer_func, inline: bool = False):
+        if inline:
+            self.inline_observers.append(observer_func)
+        else:
+            self.observers.append(observer_func)
     
     def notify(self, event_type: str, data: dict):
+        self._last_id += 1
         notification = {
+            "id": self._last_id,
             "tipo": event_type,
             "datos": data,
             "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         }
         self.notifications.append(notification)
         
-        # Notificar a todos los observadores
-        for observer in self.observers:
+        for observer in self.inline_observers:
             observer(event_type, data)
+        
+        if self._queue is None:
+            # Sin dispatcher activo (fuera del ciclo de vida de la app): entrega directa
+            self.current = notification
+            for observer in self.observers:
+                result = observer(event_type, data)
+                if inspect.isawaitable(result):
+                    asyncio.ensure_future(result)
+            return
+        
+        item = (notification, time.perf_counter())
+        try:
+            self._queue.put_nowait(item)
+        except asyncio.QueueFull:
+            self.stats["descartadas"] += 1
+            if self.drop_policy == "drop_newest":
+                return
+            self._queue.get_nowait()
+            self._queue.task_done()
+            self._queue.put_nowait(item)
+        self.stats["encoladas"] += 1
+    
+    async def start(self):
+        if self._worker is None:
+            self._queue = asyncio.Queue(maxsize=self.queue_size)
+            self._worker = asyncio.create_task(self._dispatch())
+    
+    async def stop(self, timeout: float = 5.0):
+        """Entrega lo pendiente (hasta `timeout` segundos) y detiene el dispatcher."""
+        if self._worker is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            print(f"⚠️ {self._queue.qsize()} notificaciones sin entregar al detener")
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        self._worker = None
+        self._queue = None
+    
+    async def _dispatch(self):
+        while True:
+            notification, enqueued_at = await self._queue.get()
+            self.current = notification
+            try:
+                for observer in self.observers:
+                    try:
+                        result = observer(notification["tipo"], notification["datos"])
+                        if inspect.isawaitable(result):
+                            await result
+                    except Exception as e:
+                        self.stats["errores_observador"] += 1
+                        print(f"⚠️ Error en observador {getattr(observer, '__name__', observer)}: {e}")
+                latency_ms = (time.perf_counter() - enqueued_at) * 1000
+                self.stats["entregadas"] += 1
+                self.stats["latencia_total_ms"] += latency_ms
+                self.stats["latencia_max_ms"] = max(self.stats["latencia_max_ms"], latency_ms)
+            finally:
+                self._queue.task_done()
+    
+    def notifications_since(self, last_id: int):
+        """Notificaciones del historial posteriores a last_id (para reanudar un stream)."""
+        return [n for n in self.notifications if n["id"] > last_id]
+    
+    def queue_depth(self):
+        return self._queue.qsize() if self._queue is not None else 0
+    
+    def metrics(self):
+        entregadas = self.stats["entregadas"]
+        return {
+            "cola_pendiente": self.queue_depth(),
+            "cola_capacidad": self.queue_size,
+            "historial": len(self.notifications),
+            "politica_descarte": self.drop_policy,
+            "encoladas": self.stats["encoladas"],
+            "entregadas": entregadas,
+            "descartadas": self.stats["descartadas"],
+            "errores_observador": self.stats["errores_observador"],
+            "latencia_media_ms": round(self.stats["latencia_total_ms"] / entregadas, 3) if entregadas else 0.0,
+            "latencia_max_ms": round(self.stats["latencia_max_ms"], 3)
+        }
+
+# Difusión de notificaciones a clientes conectados por Server-Sent Events
+class EventSubscriber:
+    def __init__(self, tipos: set, queue_size: int, user_id: Optional[int] = None):
+        self.tipos = tipos
+        # user_id None = personal (ve todos los eventos); un USUARIO solo ve los suyos
+        self.user_id = user_id
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.overflow = False
+    
+    def accepts(self, event_type: str, data: dict):
+        if self.tipos and event_type not in self.tipos:
+            return False
+        return self.user_id is None or data.get("usuario_id", data.get("user_id")) == self.user_id
+
+class EventBroadcaster:
+    """Observador de NotificationManager que reparte cada evento a los suscriptores SSE.
+    
+    Cada evento se serializa una sola vez y todos los suscriptores reciben el mismo objeto bytes.
+    Un suscriptor que no consume a tiempo se desconecta; al reconectar reanuda con Last-Event-ID.
+    Los datos personales (DATOS_PRIVADOS) nunca salen en los frames.
+    """
+    
+    DATOS_PRIVADOS = {"email", "telefono", "password"}
+    
+    def __init__(self, notification_manager: "NotificationManager", subscriber_queue_size: int = 1000):
+        self.notification_manager = notification_manager
+        self.subscriber_queue_size = subscriber_queue_size
+        self.subscribers = set()
+    
+    @staticmethod
+    def encode(notification: dict) -> bytes:
+        datos = {k: v for k, v in notification["datos"].items() if k not in EventBroadcaster.DATOS_PRIVADOS}
+        payload = json.dumps(
+            {"datos": datos, "timestamp": notification["timestamp"]},
+            ensure_ascii=False, default=str
+        )
+        return f"id: {notification['id']}\nevent: {notification['tipo']}\ndata: {payload}\n\n".encode()
+    
+    def __call__(self, event_type: str, data: dict):
+        notification = self.notification_manager.current
+        if not self.subscribers or notification is None:
+            return
+        frame = (notification["id"], self.encode(notification))
+        for subscriber in list(self.subscribers):
+            if not subscriber.accepts(event_type, data):
+                continue
+            try:
+                subscriber.queue.put_nowait(frame)
+            except asyncio.QueueFull:
+                subscriber.overflow = True
+                self.subscribers.discard(subscriber)
+    
+    def subscribe(self, tipos: Optional[set] = None, user_id: Optional[int] = None):
+        subscriber = EventSubscriber(tipos or set(), self.subscriber_queue_size, user_id)
+        self.subscribers.add(subscriber)
+        return subscriber
+    
+    def unsubscribe(self, subscriber: EventSubscriber):
+        self.subscribers.discard(subscriber)
+    
+    def replay(self, subscriber: EventSubscriber, last_event_id: int):
+        return [
+            (n["id"], self.encode(n))
+            for n in self.notification_manager.notifications_since(last_event_id)
+            if subscriber.accepts(n["tipo"], n["datos"])
+        ]
+    
+    async def stream(self, tipos: Optional[set], user_id: Optional[int], last_event_id: Optional[int],
+                     keepalive: float = 15.0):
+        # La suscripción se crea al empezar a iterar: si el cliente se va antes, no queda registrada
+        last_sent = 0
+        subscriber = self.subscribe(tipos, user_id)
+        try:
+            if last_event_id is not None:
+                for event_id, frame in self.replay(subscriber, last_event_id):
+                    last_sent = event_id
+                    yield frame
+            while not subscriber.overflow:
+                try:
+                    event_id, frame = await asyncio.wait_for(subscriber.queue.get(), keepalive)
+                except asyncio.TimeoutError:
+                    yield b": keepalive\n\n"
+                    continue
+                # Lo ya enviado en la reanudación puede llegar también por la cola
+                if event_id <= last_sent:
+                    continue
+                last_sent = event_id
+                yield frame
+        finally:
+            self.unsubscribe(subscriber)
 
 # Patrón 4: Strategy para validación
 class ValidationStrategy:
@@ -134,38 +494,1871 @@ class ValidationStrategy:
         
         return True, "Solicitud válida"
 
+# Paginación por cursor (keyset): el cursor codifica la clave de la última fila entregada
+def encode_cursor(values: dict) -> str:
+    raw = json.dumps(values, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> dict:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except Exception:
+        raise ValueError("Cursor inválido")
+    if not isinstance(values, dict):
+        raise ValueError("Cursor inválido")
+    return values
+
 # Patrón 5: Repository para acceso a datos
 class BaseRepository:
-    def __init__(self, db: Session):
+    def __init__(self, db: AsyncSession):
         self.db = db
 
 class UsuarioRepository(BaseRepository):
-    def create(self, usuario_data: dict):
-        usuario = Usuario(**usuario_data)
+    @staticmethod
+    def normalize_email(email: Optional[str]) -> str:
+        """Forma canónica del email: registro, login e importación comparan siempre en minúsculas."""
+        return (email or "").strip().lower()
+    
+    async def create(self, usuario_data: dict):
+        usuario = Usuario(**{**usuario_data, "email": self.normalize_email(usuario_data.get("email"))})
         self.db.add(usuario)
-        self.db.commit()
-        self.db.refresh(usuario)
+        await self.db.commit()
+        await self.db.refresh(usuario)
         return usuario
     
-    def get_by_email(self, email: str):
-        return self.db.query(Usuario).filter(Usuario.email == email).first()
+    async def get_by_email(self, email: str):
+        result = await self.db.execute(select(Usuario).where(Usuario.email == self.normalize_email(email)))
+        return result.scalars().first()
+    
+    async def update_password(self, usuario: "Usuario", password_hash: str):
+        await self.db.execute(
+            update(Usuario).where(Usuario.id_usuario == usuario.id_usuario).values(password=password_hash)
+        )
+        await self.db.commit()
+        usuario.password = password_hash
     
-    def get_all(self):
-        return self.db.query(Usuario).all()
+    async def existing_emails(self, emails: List[str]):
+        emails = [self.normalize_email(email) for email in emails]
+        result = await self.db.execute(select(Usuario.email).where(Usuario.email.in_(emails)))
+        return set(result.scalars().all())
+    
+    async def create_many(self, usuarios: List[dict]):
+        """Inserta un lote de usuarios en una transacción; devuelve (creados, {emails duplicados})."""
+        usuarios = [{**usuario, "email": self.normalize_email(usuario.get("email"))} for usuario in usuarios]
+        try:
+            await self.db.execute(insert(Usuario), usuarios)
+            await self.db.commit()
+            return len(usuarios), set()
+        except IntegrityError:
+            # Algún email fue registrado en paralelo: se reintenta fila a fila
+            await self.db.rollback()
+            creados, duplicados = 0, set()
+            for usuario in usuarios:
+                try:
+                    await self.db.execute(insert(Usuario), [usuario])
+                    await self.db.commit()
+                    creados += 1
+                except IntegrityError:
+                    await self.db.rollback()
+                    duplicados.add(usuario["email"])
+            return creados, duplicados
 
 class SolicitudRepository(BaseRepository):
-    def create(self, solicitud_data: dict):
-        solicitud = Solicitud(**solicitud_data)
-        self.db.add(solicitud)
-        self.db.commit()
-        self.db.refresh(solicitud)
-        return solicitud
+    BATCH_CHUNK_SIZE = 500
+    
+    async def create_with_detalles(self, solicitud_data: dict, detalles: List[dict], permitir_parcial: bool = False):
+        """Crea la solicitud, reserva la disponibilidad de cada punto e inserta los detalles en una transacción.
+        
+        Devuelve (solicitud, detalles con cantidad_reservada) o lanza DisponibilidadInsuficiente.
+        """
+        disponibilidad_repo = DisponibilidadRepository(self.db)
+        try:
+            for _ in range(DisponibilidadRepository.MAX_REINTENTOS):
+                disponibles = await disponibilidad_repo.snapshot({d["id_punto"] for d in detalles})
+                (resultado,), debitos = DisponibilidadRepository.asignar([(detalles, permitir_parcial)], disponibles)
+                if resultado["faltantes"]:
+                    raise DisponibilidadInsuficiente(resultado["faltantes"])
+                
+                solicitud = Solicitud(**{"fecha_solicitud": datetime.utcnow(), **solicitud_data})
+                self.db.add(solicitud)
+                await self.db.flush()
+                if not await disponibilidad_repo.debitar(debitos):
+                    # Otra solicitud consumió la disponibilidad entre la lectura y el UPDATE
+                    await self.db.rollback()
+                    continue
+                if resultado["detalles"]:
+                    await self.db.execute(insert(DetalleSolicitud), [
+                        {**detalle, "id_solicitud": solicitud.id_solicitud} for detalle in resultado["detalles"]
+                    ])
+                await BusquedaRepository(self.db).indexar("solicitudes", [solicitud.id_solicitud])
+                await ConsumoRepository(self.db).acumular(
+                    ConsumoRepository.deltas([(solicitud.fecha_solicitud, resultado["detalles"])])
+                )
+                await self.db.commit()
+                return solicitud, resultado["detalles"]
+            raise DisponibilidadInsuficiente({}, "❌ Demasiada concurrencia sobre los puntos solicitados, reintente")
+        except Exception:
+            await self.db.rollback()
+            raise
+    
+    async def existing_codigos(self, codigos: List[str]):
+        existentes = set()
+        for i in range(0, len(codigos), self.BATCH_CHUNK_SIZE):
+            chunk = codigos[i:i + self.BATCH_CHUNK_SIZE]
+            result = await self.db.execute(
+                select(Solicitud.codigo_solicitud).where(Solicitud.codigo_solicitud.in_(chunk))
+            )
+            existentes.update(result.scalars().all())
+        return existentes
+    
+    async def create_many(self, items: List[tuple]):
+        """Inserta (solicitud_data, detalles, permitir_parcial) por lotes, una transacción por lote.
+        
+        Devuelve ({codigo: id_solicitud} creados, {codigos duplicados}, {codigo: faltantes} sin disponibilidad).
+        """
+        creadas, duplicadas, sin_disponibilidad = {}, set(), {}
+        for i in range(0, len(items), self.BATCH_CHUNK_SIZE):
+            chunk = items[i:i + self.BATCH_CHUNK_SIZE]
+            try:
+                ids, rechazadas = await self._insert_chunk(chunk)
+                await self.db.commit()
+                creadas.update(ids)
+                sin_disponibilidad.update(rechazadas)
+            except IntegrityError:
+                # Otro proceso insertó alguno de los códigos entre la verificación y el insert:
+                # se reintenta el lote fila a fila para aislar los duplicados
+                await self.db.rollback()
+                for item in chunk:
+                    try:
+                        ids, rechazadas = await self._insert_chunk([item])
+                        await self.db.commit()
+                        creadas.update(ids)
+                        sin_disponibilidad.update(rechazadas)
+                    except IntegrityError:
+                        await self.db.rollback()
+                        # Solo la clave única del código es un duplicado; cualquier otra violación se propaga
+                        if not await self.existing_codigos([item[0]["codigo_solicitud"]]):
+                            raise
+                        duplicadas.add(item[0]["codigo_solicitud"])
+            except DisponibilidadInsuficiente as e:
+                await self.db.rollback()
+                for solicitud_data, _, _ in chunk:
+                    sin_disponibilidad[solicitud_data["codigo_solicitud"]] = e.faltantes
+        return creadas, duplicadas, sin_disponibilidad
+    
+    async def _insert_chunk(self, chunk: List[tuple]):
+        disponibilidad_repo = DisponibilidadRepository(self.db)
+        puntos = {detalle["id_punto"] for _, detalles, _ in chunk for detalle in detalles}
+        for _ in range(DisponibilidadRepository.MAX_REINTENTOS):
+            disponibles = await disponibilidad_repo.snapshot(puntos)
+            resultados, debitos = DisponibilidadRepository.asignar(
+                [(detalles, permitir_parcial) for _, detalles, permitir_parcial in chunk], disponibles
+            )
+            if await disponibilidad_repo.debitar(debitos):
+                break
+            await self.db.rollback()
+        else:
+            raise DisponibilidadInsuficiente({}, "❌ Demasiada concurrencia sobre los puntos solicitados, reintente")
+        
+        # La fecha se fija aquí para que el acumulado de consumo use la misma que la fila insertada
+        ahora = datetime.utcnow()
+        aceptadas = [
+            ({"fecha_solicitud": ahora, **data}, r["detalles"])
+            for (data, _, _), r in zip(chunk, resultados) if not r["faltantes"]
+        ]
+        rechazadas = {data["codigo_solicitud"]: r["faltantes"] for (data, _, _), r in zip(chunk, resultados) if r["faltantes"]}
+        if not aceptadas:
+            return {}, rechazadas
+        
+        await self.db.execute(insert(Solicitud), [solicitud_data for solicitud_data, _ in aceptadas])
+        # MySQL no soporta RETURNING: se recuperan los ids por el código único
+        codigos = [solicitud_data["codigo_solicitud"] for solicitud_data, _ in aceptadas]
+        result = await self.db.execute(
+            select(Solicitud.codigo_solicitud, Solicitud.id_solicitud).where(Solicitud.codigo_solicitud.in_(codigos))
+        )
+        ids = dict(result.all())
+        detalles = [
+            {**detalle, "id_solicitud": ids[solicitud_data["codigo_solicitud"]]}
+            for solicitud_data, item_detalles in aceptadas
+            for detalle in item_detalles
+        ]
+        if detalles:
+            await self.db.execute(insert(DetalleSolicitud), detalles)
+        await BusquedaRepository(self.db).indexar("solicitudes", list(ids.values()))
+        await ConsumoRepository(self.db).acumular(ConsumoRepository.deltas(
+            (solicitud_data["fecha_solicitud"], item_detalles) for solicitud_data, item_detalles in aceptadas
+        ))
+        return ids, rechazadas
+    
+    async def cancel(self, id_solicitud: int):
+        """Cancela la solicitud y devuelve lo reservado a cada punto. False si ya estaba cancelada."""
+        try:
+            # El UPDATE condicional garantiza que la liberación ocurre una sola vez
+            result = await self.db.execute(
+                update(Solicitud)
+                .where(Solicitud.id_solicitud == id_solicitud, Solicitud.estado != "CANCELADA")
+                .values(estado="CANCELADA")
+            )
+            if result.rowcount != 1:
+                await self.db.rollback()
+                return False
+            reservas = (await self.db.execute(
+                select(
+                    DetalleSolicitud.id_punto,
+                    func.sum(DetalleSolicitud.cantidad_reservada),
+                    func.sum(DetalleSolicitud.cantidad_solicitada)
+                )
+                .where(DetalleSolicitud.id_solicitud == id_solicitud)
+                .group_by(DetalleSolicitud.id_punto)
+            )).all()
+            await DisponibilidadRepository(self.db).acreditar({id_punto: reservado for id_punto, reservado, _ in reservas})
+            # Las solicitudes canceladas no cuentan en el consumo
+            fecha = await self.db.scalar(select(Solicitud.fecha_solicitud).where(Solicitud.id_solicitud == id_solicitud))
+            if fecha is not None:
+                consumo_repo = ConsumoRepository(self.db)
+                await consumo_repo.acumular({
+                    (id_punto, fecha.date()): (-Decimal(solicitado), -Decimal(reservado), -1)
+                    for id_punto, reservado, solicitado in reservas
+                })
+                await consumo_repo.purge_empty(fecha.date(), [id_punto for id_punto, _, _ in reservas])
+            await self.db.commit()
+            return True
+        except Exception:
+            await self.db.rollback()
+            raise
+    
+    async def get_page(self, limit: int, cursor: Optional[str] = None, **filtros):
+        """Página de solicitudes, más recientes primero, ordenada por (fecha_solicitud, id_solicitud).
+        
+        Las solicitudes sin fecha van al final, en un segundo tramo ordenado por id.
+        """
+        items = []
+        en_tramo_sin_fecha = cursor is not None and self.decode_page_cursor(cursor)[0] is None
+        if not en_tramo_sin_fecha:
+            items = (await self.db.execute(self.page_query(limit, cursor, **filtros))).all()
+        if len(items) <= limit:
+            # Se completa la página con el tramo sin fecha (desde el principio si aún no se había llegado)
+            query = self.page_query(limit - len(items), cursor if en_tramo_sin_fecha else None,
+                                    sin_fecha=True, **filtros)
+            items += (await self.db.execute(query)).all()
+        next_cursor = None
+        if len(items) > limit:
+            items = items[:limit]
+            last = items[-1]
+            fecha = last.fecha_solicitud.isoformat() if last.fecha_solicitud is not None else None
+            next_cursor = encode_cursor({"fecha": fecha, "id": last.id_solicitud})
+        return items, next_cursor
+    
+    @staticmethod
+    def decode_page_cursor(cursor: str):
+        """Devuelve (fecha, id) del cursor; fecha es None en el tramo de solicitudes sin fecha."""
+        last = decode_cursor(cursor)
+        try:
+            last_fecha = datetime.fromisoformat(last["fecha"]) if last["fecha"] is not None else None
+            last_id = int(last["id"])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError("Cursor inválido")
+        return last_fecha, last_id
+    
+    @staticmethod
+    def page_query(limit: int, cursor: Optional[str] = None, user_id: Optional[int] = None,
+                   tipo: Optional[str] = None, desde: Optional[datetime] = None,
+                   hasta: Optional[datetime] = None, id_asesor: Optional[int] = None,
+                   estado: Optional[str] = None, sin_fecha: bool = False):
+        # Solo las columnas de SolicitudOut: filas ligeras en lugar de entidades del ORM
+        query = select(*SOLICITUD_COLUMNAS)
+        if user_id is not None:
+            query = query.where(Solicitud.id_usuario_solicitante == user_id)
+        if tipo:
+            query = query.where(Solicitud.tipo_solicitud == tipo)
+        if desde:
+            query = query.where(Solicitud.fecha_solicitud >= desde)
+        if hasta:
+            query = query.where(Solicitud.fecha_solicitud <= hasta)
+        if id_asesor is not None:
+            query = query.where(Solicitud.id_asesor == id_asesor)
+        if estado:
+            query = query.where(Solicitud.estado == estado)
+        last_fecha, last_id = SolicitudRepository.decode_page_cursor(cursor) if cursor else (None, None)
+        if sin_fecha:
+            # Cada tramo es un rango del índice (fecha_solicitud, id_solicitud): un OR con IS NULL no lo sería
+            query = query.where(Solicitud.fecha_solicitud.is_(None))
+            if last_id is not None:
+                query = query.where(Solicitud.id_solicitud < last_id)
+            return query.order_by(Solicitud.id_solicitud.desc()).limit(limit + 1)
+        query = query.where(Solicitud.fecha_solicitud.is_not(None))
+        if cursor:
+            # La condición redundante fecha <= last_fecha permite buscar por rango en el índice
+            query = query.where(
+                Solicitud.fecha_solicitud <= last_fecha,
+                or_(Solicitud.fecha_solicitud < last_fecha, Solicitud.id_solicitud < last_id)
+            )
+        return query.order_by(Solicitud.fecha_solicitud.desc(), Solicitud.id_solicitud.desc()).limit(limit + 1)
+
+class DisponibilidadInsuficiente(Exception):
+    def __init__(self, faltantes: dict, message: str = "❌ Disponibilidad insuficiente en los puntos solicitados"):
+        super().__init__(message)
+        self.faltantes = faltantes
+
+class DisponibilidadRepository(BaseRepository):
+    """Libro de disponibilidad por punto (una fila de Disponibilidad por id_punto).
+    
+    Las reservas usan UPDATE condicional (`cantidad_disponible >= x`): la base de datos decide
+    atómicamente y no se mantiene ningún bloqueo mientras se ejecuta código Python.
+    """
+    
+    MAX_REINTENTOS = 5
+    
+    async def snapshot(self, puntos: set):
+        if not puntos:
+            return {}
+        result = await self.db.execute(
+            select(Disponibilidad.id_punto, Disponibilidad.cantidad_disponible)
+            .where(Disponibilidad.id_punto.in_(puntos))
+        )
+        return {id_punto: Decimal(cantidad) for id_punto, cantidad in result.all()}
+    
+    @staticmethod
+    def asignar(items: List[tuple], disponibles: dict):
+        """Asigna en orden cada (detalles, permitir_parcial) contra `disponibles`.
+        
+        Devuelve (resultados por item, débitos totales por punto). Un item sin parcial se acepta
+        entero o se rechaza con sus faltantes; con parcial recibe lo que quede en cada punto.
+        """
+        restante = dict(disponibles)
+        resultados, debitos = [], collections.defaultdict(Decimal)
+        for detalles, permitir_parcial in items:
+            if permitir_parcial:
+                asignados = []
+                for detalle in detalles:
+                    reservado = max(Decimal(0), min(detalle["cantidad_solicitada"], restante.get(detalle["id_punto"], Decimal(0))))
+                    restante[detalle["id_punto"]] = restante.get(detalle["id_punto"], Decimal(0)) - reservado
+                    asignados.append({**detalle, "cantidad_reservada": reservado})
+                if detalles and not any(d["cantidad_reservada"] for d in asignados):
+                    for detalle in asignados:
+                        restante[detalle["id_punto"]] += detalle["cantidad_reservada"]
+                    resultados.append({"detalles": [], "faltantes": {d["id_punto"]: float(d["cantidad_solicitada"]) for d in detalles}})
+                    continue
+            else:
+                pedido = collections.defaultdict(Decimal)
+                for detalle in detalles:
+                    pedido[detalle["id_punto"]] += detalle["cantidad_solicitada"]
+                faltantes = {
+                    id_punto: float(cantidad - restante.get(id_punto, Decimal(0)))
+                    for id_punto, cantidad in pedido.items()
+                    if cantidad > restante.get(id_punto, Decimal(0))
+                }
+                if faltantes:
+                    resultados.append({"detalles": [], "faltantes": faltantes})
+                    continue
+                for id_punto, cantidad in pedido.items():
+                    restante[id_punto] -= cantidad
+                asignados = [{**detalle, "cantidad_reservada": detalle["cantidad_solicitada"]} for detalle in detalles]
+            for detalle in asignados:
+                debitos[detalle["id_punto"]] += detalle["cantidad_reservada"]
+            resultados.append({"detalles": asignados, "faltantes": {}})
+        return resultados, dict(debitos)
+    
+    def _marcar(self, puntos):
+        # El índice de puntos cercanos recarga solo estos puntos tras el commit
+        self.db.info.setdefault("puntos_modificados", set()).update(puntos)
+    
+    async def debitar(self, debitos: dict):
+        self._marcar(debitos)
+        # Orden fijo por id_punto para que dos transacciones no se bloqueen mutuamente
+        for id_punto in sorted(debitos):
+            cantidad = debitos[id_punto]
+            if cantidad <= 0:
+                continue
+            result = await self.db.execute(
+                update(Disponibilidad)
+                .where(Disponibilidad.id_punto == id_punto, Disponibilidad.cantidad_disponible >= cantidad)
+                .values(cantidad_disponible=Disponibilidad.cantidad_disponible - cantidad)
+            )
+            if result.rowcount != 1:
+                return False
+        return True
+    
+    async def acreditar(self, creditos: dict):
+        self._marcar(creditos)
+        for id_punto in sorted(creditos):
+            cantidad = creditos[id_punto]
+            if not cantidad:
+                continue
+            await self.db.execute(
+                update(Disponibilidad)
+                .where(Disponibilidad.id_punto == id_punto)
+                .values(cantidad_disponible=Disponibilidad.cantidad_disponible + cantidad)
+            )
+
+class ConsumoRepository(BaseRepository):
+    """Acumulado diario por punto (consumo_diario), actualizado en la misma transacción que crea o
+    cancela las solicitudes. Solo cuenta solicitudes no canceladas; rebuild() lo recalcula entero.
+    """
+    
+    @staticmethod
+    def deltas(solicitudes):
+        """{(id_punto, día): (litros solicitados, litros reservados, nº de solicitudes)} de (fecha, detalles)."""
+        acumulado = {}
+        for fecha, detalles in solicitudes:
+            dia = fecha.date()
+            puntos = set()
+            for detalle in detalles:
+                key = (detalle["id_punto"], dia)
+                solicitado, reservado, n = acumulado.get(key, (Decimal(0), Decimal(0), 0))
+                acumulado[key] = (
+                    solicitado + Decimal(detalle["cantidad_solicitada"]),
+                    reservado + Decimal(detalle.get("cantidad_reservada", 0)),
+                    n if key in puntos else n + 1
+                )
+                puntos.add(key)
+        return acumulado
+    
+    async def acumular(self, deltas: dict):
+        """Suma los deltas con un upsert (INSERT ... ON DUPLICATE KEY / ON CONFLICT) ejecutado como executemany.
+        
+        La sentencia no depende del número de filas, así que se compila una vez y queda en la caché;
+        el driver agrupa las filas en INSERT multi-fila.
+        """
+        if not deltas:
+            return
+        # Orden fijo de claves: dos transacciones nunca bloquean las mismas filas en orden inverso
+        rows = [
+            {"id_punto": id_punto, "fecha": dia, "litros_solicitados": solicitado,
+             "litros_reservados": reservado, "solicitudes": n}
+            for (id_punto, dia), (solicitado, reservado, n) in sorted(deltas.items())
+        ]
+        dialect = self.db.get_bind().dialect.name
+        if dialect == "mysql":
+            statement = mysql.insert(ConsumoDiario)
+            nuevos = statement.inserted
+            statement = statement.on_duplicate_key_update(
+                litros_solicitados=ConsumoDiario.litros_solicitados + nuevos.litros_solicitados,
+                litros_reservados=ConsumoDiario.litros_reservados + nuevos.litros_reservados,
+                solicitudes=ConsumoDiario.solicitudes + nuevos.solicitudes
+            )
+        else:
+            statement = sqlite.insert(ConsumoDiario)
+            nuevos = statement.excluded
+            statement = statement.on_conflict_do_update(
+                index_elements=["id_punto", "fecha"],
+                set_={
+                    "litros_solicitados": ConsumoDiario.litros_solicitados + nuevos.litros_solicitados,
+                    "litros_reservados": ConsumoDiario.litros_reservados + nuevos.litros_reservados,
+                    "solicitudes": ConsumoDiario.solicitudes + nuevos.solicitudes
+                }
+            )
+        await self.db.execute(statement, rows)
+    
+    async def purge_empty(self, dia: date, puntos: List[int]):
+        # Sin solicitudes vivas la fila sobra (rebuild() tampoco la generaría)
+        if puntos:
+            await self.db.execute(
+                delete(ConsumoDiario)
+                .where(ConsumoDiario.fecha == dia, ConsumoDiario.id_punto.in_(puntos), ConsumoDiario.solicitudes <= 0)
+            )
+    
+    @staticmethod
+    def rebuild_statements():
+        """Recalcula el acumulado con un INSERT ... SELECT agrupado en la propia base de datos."""
+        dia = func.date(Solicitud.fecha_solicitud)
+        origen = (
+            select(
+                DetalleSolicitud.id_punto,
+                dia,
+                func.sum(DetalleSolicitud.cantidad_solicitada),
+                func.sum(DetalleSolicitud.cantidad_reservada),
+                func.count(func.distinct(DetalleSolicitud.id_solicitud))
+            )
+            .join(Solicitud, Solicitud.id_solicitud == DetalleSolicitud.id_solicitud)
+            .where(Solicitud.estado != "CANCELADA", Solicitud.fecha_solicitud.is_not(None))
+            .group_by(DetalleSolicitud.id_punto, dia)
+        )
+        return [
+            delete(ConsumoDiario),
+            insert(ConsumoDiario).from_select(
+                ["id_punto", "fecha", "litros_solicitados", "litros_reservados", "solicitudes"], origen
+            )
+        ]
+    
+    async def rebuild(self):
+        for statement in self.rebuild_statements():
+            await self.db.execute(statement)
+        await self.db.commit()
+    
+    @staticmethod
+    def range_query(desde: date, hasta: date, id_punto: Optional[int] = None):
+        query = (
+            select(
+                ConsumoDiario.id_punto,
+                PuntoSuministro.codigo_punto,
+                PuntoSuministro.capacidad,
+                ConsumoDiario.fecha,
+                ConsumoDiario.litros_solicitados,
+                ConsumoDiario.litros_reservados,
+                ConsumoDiario.solicitudes
+            )
+            .join(PuntoSuministro, PuntoSuministro.id_punto == ConsumoDiario.id_punto)
+            .where(ConsumoDiario.fecha >= desde, ConsumoDiario.fecha <= hasta)
+        )
+        if id_punto is not None:
+            query = query.where(ConsumoDiario.id_punto == id_punto)
+        return query.order_by(ConsumoDiario.id_punto, ConsumoDiario.fecha)
+    
+    async def get_range(self, desde: date, hasta: date, id_punto: Optional[int] = None):
+        return (await self.db.execute(self.range_query(desde, hasta, id_punto))).all()
+
+class AsignacionRepository(BaseRepository):
+    """Asignación en lote de las líneas pendientes (cantidad_reservada < cantidad_solicitada).
+    
+    Cada punto reparte su disponibilidad entre sus líneas por orden de antigüedad (fecha_solicitud,
+    id_solicitud, id_detalle): una línea solo recibe algo si todas las anteriores del mismo punto
+    quedaron cubiertas. Los puntos no ACTIVO no asignan nada.
+    """
+    
+    CHUNK_SIZE = 500
+    
+    @staticmethod
+    def pending_query():
+        return (
+            select(
+                DetalleSolicitud.id_detalle,
+                DetalleSolicitud.id_solicitud,
+                DetalleSolicitud.id_punto,
+                (DetalleSolicitud.cantidad_solicitada - DetalleSolicitud.cantidad_reservada).label("pendiente"),
+                Solicitud.fecha_solicitud
+            )
+            .join(Solicitud, Solicitud.id_solicitud == DetalleSolicitud.id_solicitud)
+            .where(Solicitud.estado == "PENDIENTE", DetalleSolicitud.cantidad_reservada < DetalleSolicitud.cantidad_solicitada)
+            .order_by(Solicitud.fecha_solicitud, Solicitud.id_solicitud, DetalleSolicitud.id_detalle)
+        )
+    
+    async def disponibles(self):
+        result = await self.db.execute(
+            select(Disponibilidad.id_punto, Disponibilidad.cantidad_disponible)
+            .join(PuntoSuministro, PuntoSuministro.id_punto == Disponibilidad.id_punto)
+            .where(PuntoSuministro.estado == "ACTIVO")
+        )
+        return {id_punto: Decimal(cantidad) for id_punto, cantidad in result.all()}
+    
+    @staticmethod
+    def calcular(lineas, disponibles: dict):
+        """Devuelve (asignaciones, débitos por punto) para `lineas` ya ordenadas por prioridad.
+        
+        Equivale, por punto, a min(pendiente, max(0, disponible - suma de los pendientes anteriores)).
+        """
+        restante = dict(disponibles)
+        asignaciones, debitos = [], collections.defaultdict(Decimal)
+        for linea in lineas:
+            libre = restante.get(linea.id_punto)
+            if not libre or libre <= 0:
+                continue
+            asignado = min(Decimal(linea.pendiente), libre)
+            restante[linea.id_punto] = libre - asignado
+            debitos[linea.id_punto] += asignado
+            asignaciones.append((linea, asignado))
+        return asignaciones, dict(debitos)
+    
+    async def _bloquear_solicitudes(self, ids: List[int]):
+        """UPDATE sin cambios sobre las solicitudes afectadas: las bloquea frente a una cancelación
+        concurrente y comprueba que siguen PENDIENTE."""
+        for i in range(0, len(ids), self.CHUNK_SIZE):
+            chunk = ids[i:i + self.CHUNK_SIZE]
+            result = await self.db.execute(
+                update(Solicitud)
+                .where(Solicitud.id_solicitud.in_(chunk), Solicitud.estado == "PENDIENTE")
+                .values(estado="PENDIENTE")
+            )
+            if result.rowcount != len(chunk):
+                return False
+        return True
+    
+    async def asignar_pendientes(self, dry_run: bool = False, muestra: int = 0):
+        """Calcula la asignación y, salvo en dry_run, la aplica en una transacción.
+        
+        Si otra transacción cambia la disponibilidad o cancela una solicitud entre la lectura y la
+        escritura, se deshace todo y se recalcula.
+        """
+        disponibilidad_repo = DisponibilidadRepository(self.db)
+        try:
+            for _ in range(DisponibilidadRepository.MAX_REINTENTOS):
+                lineas = (await self.db.execute(self.pending_query())).all()
+                disponibles = await self.disponibles()
+                asignaciones, debitos = self.calcular(lineas, disponibles)
+                resumen = self.resumen(lineas, disponibles, asignaciones, debitos, muestra)
+                if dry_run or not asignaciones:
+                    await self.db.rollback()
+                    return resumen
+                
+                if not await self._bloquear_solicitudes(sorted({linea.id_solicitud for linea, _ in asignaciones})):
+                    await self.db.rollback()
+                    continue
+                if not await disponibilidad_repo.debitar(debitos):
+                    await self.db.rollback()
+                    continue
+                detalle = DetalleSolicitud.__table__
+                await self.db.execute(
+                    update(detalle)
+                    .where(detalle.c.id_detalle == bindparam("b_id_detalle"))
+                    .values(cantidad_reservada=detalle.c.cantidad_reservada + bindparam("b_asignado")),
+                    [{"b_id_detalle": linea.id_detalle, "b_asignado": asignado} for linea, asignado in asignaciones]
+                )
+                consumo = collections.defaultdict(Decimal)
+                for linea, asignado in asignaciones:
+                    consumo[(linea.id_punto, linea.fecha_solicitud.date())] += asignado
+                await ConsumoRepository(self.db).acumular({
+                    key: (Decimal(0), reservado, 0) for key, reservado in consumo.items()
+                })
+                await self.db.commit()
+                return resumen
+            raise DisponibilidadInsuficiente({}, "❌ Demasiada concurrencia sobre los puntos, reintente la asignación")
+        except Exception:
+            await self.db.rollback()
+            raise
+    
+    @staticmethod
+    def resumen(lineas, disponibles: dict, asignaciones, debitos: dict, muestra: int = 0):
+        pendiente_por_punto = collections.defaultdict(Decimal)
+        for linea in lineas:
+            pendiente_por_punto[linea.id_punto] += Decimal(linea.pendiente)
+        completas = sum(1 for linea, asignado in asignaciones if asignado == Decimal(linea.pendiente))
+        return {
+            "lineas_pendientes": len(lineas),
+            "lineas_asignadas": len(asignaciones),
+            "lineas_completas": completas,
+            "solicitudes_afectadas": len({linea.id_solicitud for linea, _ in asignaciones}),
+            "litros_pendientes": float(sum(pendiente_por_punto.values())),
+            "litros_asignados": float(sum(debitos.values())),
+            "puntos": [
+                {
+                    "id_punto": id_punto,
+                    "pendiente": float(pendiente),
+                    "disponible": float(disponibles.get(id_punto, 0)),
+                    "asignado": float(debitos.get(id_punto, 0))
+                } for id_punto, pendiente in sorted(pendiente_por_punto.items())
+            ],
+            "asignaciones": [
+                {
+                    "id_detalle": linea.id_detalle,
+                    "id_solicitud": linea.id_solicitud,
+                    "id_punto": linea.id_punto,
+                    "pendiente": float(linea.pendiente),
+                    "asignado": float(asignado)
+                } for linea, asignado in asignaciones[:muestra]
+            ]
+        }
+
+class BusquedaRepository(BaseRepository):
+    """Índice invertido propio (busqueda_terminos) para solicitudes, consultas y puntos de suministro.
+    
+    Los textos se normalizan sin tildes ni mayúsculas y se parten en términos; cada término guarda
+    un peso según el campo. Las escrituras de la API reindexan sus entidades en la misma transacción;
+    lo escrito por otras vías se recoge con `python main.py rebuild-busqueda`.
+    """
+    
+    TERMINO_MAX = 64
+    MIN_PREFIJO = 2
+    MAX_TERMINOS_CONSULTA = 8
+    CHUNK_SIZE = 1000
+    STOPWORDS = {
+        "a", "al", "con", "de", "del", "el", "en", "es", "la", "las", "lo", "los", "o", "para", "por",
+        "que", "se", "sin", "su", "sus", "un", "una", "unos", "unas", "y"
+    }
+    
+    @staticmethod
+    def fuentes():
+        """tipo -> (modelo, clave primaria, [(campo, peso)], campo título, campo detalle)."""
+        return {
+            "solicitudes": (Solicitud, Solicitud.id_solicitud,
+                            [(Solicitud.codigo_solicitud, 5), (Solicitud.tipo_solicitud, 1)],
+                            Solicitud.codigo_solicitud, Solicitud.tipo_solicitud),
+            "consultas": (Consulta, Consulta.id_consulta,
+                          [(Consulta.descripcion_consulta, 2), (Consulta.respuesta, 1)],
+                          Consulta.descripcion_consulta, Consulta.respuesta),
+            "puntos": (PuntoSuministro, PuntoSuministro.id_punto,
+                       [(PuntoSuministro.codigo_punto, 5), (PuntoSuministro.direccion, 2)],
+                       PuntoSuministro.codigo_punto, PuntoSuministro.direccion),
+        }
+    
+    @staticmethod
+    def normalizar(texto: str):
+        # "Añil Ñandú" -> "anil nandu"
+        descompuesto = unicodedata.normalize("NFKD", texto.lower())
+        return "".join(c for c in descompuesto if not unicodedata.combining(c))
+    
+    @classmethod
+    def tokens(cls, texto: Optional[str]):
+        """Términos de un texto. Los códigos (SOL-00012) dan además el código compacto (sol00012)."""
+        if not texto:
+            return []
+        normalizado = cls.normalizar(texto)
+        terminos = re.findall(r"[a-z0-9]+", normalizado)
+        terminos += [m.replace("-", "").replace("_", "").replace("/", "").replace(".", "")
+                     for m in re.findall(r"[a-z0-9]+(?:[-_/.][a-z0-9]+)+", normalizado)]
+        return [t[:cls.TERMINO_MAX] for t in terminos if t not in cls.STOPWORDS]
+    
+    @classmethod
+    def terminos_consulta(cls, q: str):
+        """Términos de la búsqueda: los códigos se buscan compactos y los términos cortos se ignoran."""
+        normalizado = cls.normalizar(q)
+        codigos = re.findall(r"[a-z0-9]+(?:[-_/.][a-z0-9]+)+", normalizado)
+        resto = re.sub(r"[a-z0-9]+(?:[-_/.][a-z0-9]+)+", " ", normalizado)
+        terminos = [re.sub(r"[-_/.]", "", c) for c in codigos] + re.findall(r"[a-z0-9]+", resto)
+        vistos = []
+        for termino in terminos:
+            termino = termino[:cls.TERMINO_MAX]
+            if len(termino) >= cls.MIN_PREFIJO and termino not in cls.STOPWORDS and termino not in vistos:
+                vistos.append(termino)
+        return vistos[:cls.MAX_TERMINOS_CONSULTA]
+    
+    @classmethod
+    def filas_indice(cls, tipo: str, rows):
+        """Filas de busqueda_terminos para (id, campo1, campo2, ...) según los pesos de la fuente."""
+        pesos = [peso for _, peso in cls.fuentes()[tipo][2]]
+        filas = []
+        for row in rows:
+            acumulado = collections.Counter()
+            for valor, peso in zip(row[1:], pesos):
+                for termino in cls.tokens(valor):
+                    acumulado[termino] += peso
+            filas.extend(
+                {"termino": termino, "tipo": tipo, "id_entidad": row[0], "peso": peso}
+                for termino, peso in acumulado.items()
+            )
+        return filas
+    
+    @classmethod
+    def reindexar_sync(cls, conn, tipo: str, ids: Optional[List[int]] = None):
+        """Reindexa `ids` (o toda la fuente) con una conexión o sesión síncrona; lo usan la migración y run_sync."""
+        model, pk, campos, _, _ = cls.fuentes()[tipo]
+        columnas = [pk] + [campo for campo, _ in campos]
+        if ids is None:
+            conn.execute(delete(BusquedaTermino).where(BusquedaTermino.tipo == tipo))
+            ultimo = None
+            while True:
+                query = select(*columnas).order_by(pk).limit(cls.CHUNK_SIZE)
+                if ultimo is not None:
+                    query = query.where(pk > ultimo)
+                rows = conn.execute(query).all()
+                if not rows:
+                    break
+                filas = cls.filas_indice(tipo, rows)
+                if filas:
+                    conn.execute(insert(BusquedaTermino), filas)
+                ultimo = rows[-1][0]
+            return
+        for i in range(0, len(ids), cls.CHUNK_SIZE):
+            chunk = ids[i:i + cls.CHUNK_SIZE]
+            conn.execute(delete(BusquedaTermino).where(BusquedaTermino.tipo == tipo, BusquedaTermino.id_entidad.in_(chunk)))
+            filas = cls.filas_indice(tipo, conn.execute(select(*columnas).where(pk.in_(chunk))).all())
+            if filas:
+                conn.execute(insert(BusquedaTermino), filas)
+    
+    async def indexar(self, tipo: str, ids: List[int]):
+        """Reindexa las entidades dentro de la transacción en curso (no hace commit)."""
+        if ids:
+            await self.db.run_sync(lambda session: self.reindexar_sync(session, tipo, sorted(ids)))
+    
+    async def rebuild(self):
+        for tipo in self.fuentes():
+            await self.db.run_sync(lambda session, tipo=tipo: self.reindexar_sync(session, tipo))
+        await self.db.commit()
+    
+    @classmethod
+    def prefijo(cls, termino: str, dialect_name: str):
+        if dialect_name == "sqlite":
+            # LIKE en SQLite no distingue mayúsculas y no usa el índice BINARY: rango explícito.
+            # Los términos son [a-z0-9], así que todo lo que empieza por `termino` es menor que termino + "{"
+            return (BusquedaTermino.termino >= termino) & (BusquedaTermino.termino < termino + "{")
+        return BusquedaTermino.termino.like(f"{termino}%")
+    
+    @classmethod
+    def search_query(cls, terminos: List[str], tipos: List[str], limit: int, dialect_name: str = "mysql"):
+        """Entidades que contienen todos los términos (por prefijo), ordenadas por la suma de pesos.
+        
+        Una coincidencia exacta puntúa el doble que una por prefijo.
+        """
+        condiciones = [cls.prefijo(termino, dialect_name) for termino in terminos]
+        # Cada término se comprueba por separado: un mismo término indexado puede cubrir varios
+        # ("agua" cubre "ag" y "agua"), así que no basta con contar condiciones distintas
+        cubiertos = [func.max(case((condicion, 1), else_=0)) == 1 for condicion in condiciones]
+        exacta = case((BusquedaTermino.termino.in_(terminos), 2), else_=1)
+        puntuacion = func.sum(BusquedaTermino.peso * exacta).label("puntuacion")
+        return (
+            select(BusquedaTermino.tipo, BusquedaTermino.id_entidad, puntuacion)
+            .where(or_(*condiciones), BusquedaTermino.tipo.in_(tipos))
+            .group_by(BusquedaTermino.tipo, BusquedaTermino.id_entidad)
+            .having(*cubiertos)
+            .order_by(puntuacion.desc(), BusquedaTermino.tipo, BusquedaTermino.id_entidad)
+            .limit(limit)
+        )
+    
+    async def buscar(self, q: str, tipos: List[str], limit: int = 20):
+        terminos = self.terminos_consulta(q)
+        if not terminos:
+            return terminos, []
+        ranking = (await self.db.execute(
+            self.search_query(terminos, tipos, limit, self.db.get_bind().dialect.name)
+        )).all()
+        
+        # Título y detalle de cada resultado: una consulta por tipo
+        por_tipo = collections.defaultdict(list)
+        for tipo, id_entidad, _ in ranking:
+            por_tipo[tipo].append(id_entidad)
+        textos = {}
+        for tipo, ids in por_tipo.items():
+            _, pk, _, titulo, detalle = self.fuentes()[tipo]
+            for id_entidad, valor_titulo, valor_detalle in (await self.db.execute(
+                select(pk, titulo, detalle).where(pk.in_(ids))
+            )).all():
+                textos[(tipo, id_entidad)] = (valor_titulo, valor_detalle)
+        resultados = []
+        for tipo, id_entidad, puntuacion in ranking:
+            if (tipo, id_entidad) not in textos:
+                # Entidad borrada fuera de la API: el término queda huérfano hasta el próximo rebuild
+                continue
+            valor_titulo, valor_detalle = textos[(tipo, id_entidad)]
+            resultados.append({
+                "tipo": tipo,
+                "id": id_entidad,
+                "titulo": valor_titulo,
+                "detalle": valor_detalle[:200] if valor_detalle else None,
+                "puntuacion": int(puntuacion)
+            })
+        return terminos, resultados
+
+class PuntoSuministroRepository(BaseRepository):
+    CHUNK_SIZE = 500
+    
+    async def missing_ids(self, ids: set):
+        """Ids de `ids` que no existen en puntos_suministro, ordenados."""
+        ids = sorted(ids)
+        existentes = set()
+        for i in range(0, len(ids), self.CHUNK_SIZE):
+            result = await self.db.execute(
+                select(PuntoSuministro.id_punto).where(PuntoSuministro.id_punto.in_(ids[i:i + self.CHUNK_SIZE]))
+            )
+            existentes.update(result.scalars().all())
+        return [id_punto for id_punto in ids if id_punto not in existentes]
+    
+    async def get_page(self, limit: int, cursor: Optional[str] = None, estado: Optional[str] = None):
+        """Página de puntos de suministro ordenada por id_punto."""
+        query = self.page_query(limit, cursor, estado)
+        rows = (await self.db.execute(query)).all()
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor({"id": rows[-1][0].id_punto})
+        items = [
+            {
+                "id_punto": punto.id_punto,
+                "codigo_punto": punto.codigo_punto,
+                "estado": punto.estado,
+                "direccion": punto.direccion,
+                "capacidad": float(punto.capacidad),
+                "latitud": float(punto.latitud) if punto.latitud is not None else None,
+                "longitud": float(punto.longitud) if punto.longitud is not None else None,
+                "cantidad_disponible": float(cantidad) if cantidad is not None else None,
+                "estado_disponibilidad": estado_disponibilidad
+            } for punto, cantidad, estado_disponibilidad in rows
+        ]
+        return items, next_cursor
+    
+    @staticmethod
+    def page_query(limit: int, cursor: Optional[str] = None, estado: Optional[str] = None):
+        query = select(
+            PuntoSuministro,
+            Disponibilidad.cantidad_disponible,
+            Disponibilidad.estado_disponibilidad
+        ).outerjoin(Disponibilidad, Disponibilidad.id_punto == PuntoSuministro.id_punto)
+        if estado:
+            query = query.where(PuntoSuministro.estado == estado)
+        if cursor:
+            try:
+                last_id = int(decode_cursor(cursor)["id"])
+            except (KeyError, TypeError, ValueError):
+                raise ValueError("Cursor inválido")
+            query = query.where(PuntoSuministro.id_punto > last_id)
+        return query.order_by(PuntoSuministro.id_punto).limit(limit + 1)
+
+# Patrón 6: Caché TTL con coalescencia de peticiones (single-flight)
+class TTLCache:
+    def __init__(self, ttl_seconds: float):
+        self.ttl_seconds = ttl_seconds
+        self._value = None
+        self._expires_at = 0.0
+        self._generation = 0
+        self._lock = asyncio.Lock()
+    
+    def _fresh(self):
+        return self._value is not None and time.monotonic() < self._expires_at
+    
+    async def get_or_compute(self, compute):
+        if self._fresh():
+            return self._value
+        
+        # Solo una petición calcula; las concurrentes esperan y reutilizan el resultado
+        async with self._lock:
+            if self._fresh():
+                return self._value
+            generation = self._generation
+            value = await compute()
+            # Si hubo una invalidación mientras se calculaba, no se guarda un valor ya obsoleto
+            if generation == self._generation:
+                self._value = value
+                self._expires_at = time.monotonic() + self.ttl_seconds
+            return value
+    
+    def invalidate(self):
+        self._generation += 1
+        self._value = None
+        self._expires_at = 0.0
+
+# Caché de respuestas serializadas, validable con ETag / Last-Modified
+class ResponseCache:
+    """Guarda el cuerpo ya serializado por clave. El ETag es un hash del contenido, así que
+    coincide entre workers; invalidate() descarta todo y `ttl_seconds` acota cuánto puede
+    tardar en verse un cambio hecho por otro worker.
+    """
+    
+    def __init__(self, ttl_seconds: float, max_entries: int = 256):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._last_modified = {}
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None or time.monotonic() >= entry["expires_at"]:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
     
-    def get_all(self):
-        return self.db.query(Solicitud).all()
+    def put(self, key, body: bytes):
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        # Si el contenido no cambió se conserva la fecha original de modificación
+        previous = self._last_modified.get(key)
+        last_modified = previous[1] if previous and previous[0] == etag else datetime.now(timezone.utc).replace(microsecond=0)
+        self._last_modified[key] = (etag, last_modified)
+        entry = {
+            "body": body,
+            "etag": etag,
+            "last_modified": last_modified,
+            "expires_at": time.monotonic() + self.ttl_seconds
+        }
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            old_key, _ = self._entries.popitem(last=False)
+            self._last_modified.pop(old_key, None)
+        return entry
+    
+    def invalidate(self):
+        self._entries.clear()
+    
+    @staticmethod
+    def not_modified(request: Request, entry: dict):
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match is not None:
+            return entry["etag"] in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")] or if_none_match.strip() == "*"
+        if_modified_since = request.headers.get("if-modified-since")
+        if if_modified_since:
+            try:
+                return entry["last_modified"] <= parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                return False
+        return False
+    
+    @staticmethod
+    def response(request: Request, entry: dict):
+        headers = {
+            "ETag": entry["etag"],
+            "Last-Modified": format_datetime(entry["last_modified"], usegmt=True),
+            "Cache-Control": "no-cache"
+        }
+        if ResponseCache.not_modified(request, entry):
+            return Response(status_code=304, headers=headers)
+        return Response(content=entry["body"], media_type="application/json", headers=headers)
+
+# Seguimiento de escrituras confirmadas por tabla
+class ChangeTracker:
+    """Anota qué tablas escribe cada sesión y, tras el commit, avisa a los listeners de esas tablas.
+    
+    Cubre session.add() (after_flush) y las sentencias insert()/update()/delete() del ORM (do_orm_execute).
+    """
+    
+    def __init__(self):
+        self.listeners = []
+        self.commit_hooks = []
+        self.versions = collections.Counter()
+    
+    def add_listener(self, tables: set, callback):
+        self.listeners.append((set(tables), callback))
+    
+    def add_commit_hook(self, callback):
+        """callback(session, tablas) tras cada commit que escribió algo."""
+        self.commit_hooks.append(callback)
+    
+    def mark(self, session, table_name: str):
+        session.info.setdefault("tablas_modificadas", set()).add(table_name)
+    
+    def committed(self, session):
+        tables = session.info.pop("tablas_modificadas", None)
+        if not tables:
+            return
+        for table in tables:
+            self.versions[table] += 1
+        for watched, callback in self.listeners:
+            if watched & tables:
+                callback(tables & watched)
+        for callback in self.commit_hooks:
+            callback(session, tables)
+    
+    def discard(self, session):
+        session.info.pop("tablas_modificadas", None)
+    
+    def install(self, session_class):
+        @event.listens_for(session_class, "do_orm_execute")
+        def _orm_execute(orm_execute_state):
+            if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+                table = getattr(orm_execute_state.statement, "table", None)
+                if table is not None:
+                    self.mark(orm_execute_state.session, table.name)
+        
+        @event.listens_for(session_class, "after_flush")
+        def _after_flush(session, flush_context):
+            for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+                table = getattr(obj, "__table__", None)
+                if table is not None:
+                    self.mark(session, table.name)
+        
+        @event.listens_for(session_class, "after_commit")
+        def _after_commit(session):
+            self.committed(session)
+        
+        @event.listens_for(session_class, "after_rollback")
+        def _after_rollback(session):
+            self.discard(session)
+
+# Índice espacial de puntos de suministro
+class PuntosCercanosIndex:
+    """Rejilla uniforme en memoria (celdas de `cell_deg` grados) con los puntos ACTIVO con coordenadas.
+    
+    La búsqueda recorre anillos de celdas alrededor de la posición pedida y se detiene cuando la
+    distancia mínima al siguiente anillo supera la del k-ésimo candidato. Tras cada commit que toca
+    puntos o disponibilidad se recargan solo los puntos afectados; cada `max_age` segundos se recarga
+    todo para ver las escrituras de otros workers.
+    """
+    
+    RADIO_TIERRA_KM = 6371.0088
+    KM_POR_GRADO = math.pi * RADIO_TIERRA_KM / 180
+    
+    def __init__(self, cell_deg: float = 0.05, max_age: float = 60.0):
+        self.cell_deg = cell_deg
+        self.max_age = max_age
+        self.puntos = {}
+        self.celdas = collections.defaultdict(set)
+        # Extensión de la rejilla en celdas (min_i, max_i, min_j, max_j); solo crece hasta la recarga completa
+        self._extension = None
+        self._loaded_at = None
+        self._pending = set()
+        self._reload_all = False
+        self._lock = asyncio.Lock()
+        self._refresh_task = None
+    
+    def invalidate(self, puntos=None):
+        if puntos:
+            self._pending.update(puntos)
+        else:
+            self._reload_all = True
+    
+    def _celda(self, lat: float, lon: float):
+        return math.floor(lat / self.cell_deg), math.floor(lon / self.cell_deg)
+    
+    def _quitar(self, id_punto: int):
+        entry = self.puntos.pop(id_punto, None)
+        if entry is not None:
+            celda = self._celda(entry["latitud"], entry["longitud"])
+            self.celdas[celda].discard(id_punto)
+            if not self.celdas[celda]:
+                del self.celdas[celda]
+    
+    def _poner(self, row):
+        self._quitar(row.id_punto)
+        if row.estado != "ACTIVO" or row.latitud is None or row.longitud is None:
+            return
+        entry = {
+            "id_punto": row.id_punto,
+            "codigo_punto": row.codigo_punto,
+            "direccion": row.direccion,
+            "latitud": float(row.latitud),
+            "longitud": float(row.longitud),
+            "cantidad_disponible": float(row.cantidad_disponible or 0)
+        }
+        self.puntos[row.id_punto] = entry
+        i, j = self._celda(entry["latitud"], entry["longitud"])
+        self.celdas[(i, j)].add(row.id_punto)
+        if self._extension is None:
+            self._extension = (i, i, j, j)
+        else:
+            min_i, max_i, min_j, max_j = self._extension
+            self._extension = (min(min_i, i), max(max_i, i), min(min_j, j), max(max_j, j))
+    
+    @staticmethod
+    def load_query(puntos=None):
+        query = select(
+            PuntoSuministro.id_punto, PuntoSuministro.codigo_punto, PuntoSuministro.direccion,
+            PuntoSuministro.estado, PuntoSuministro.latitud, PuntoSuministro.longitud,
+            Disponibilidad.cantidad_disponible
+        ).outerjoin(Disponibilidad, Disponibilidad.id_punto == PuntoSuministro.id_punto)
+        if puntos is not None:
+            query = query.where(PuntoSuministro.id_punto.in_(puntos))
+        return query
+    
+    async def ensure_fresh(self):
+        """Aplica los cambios pendientes; solo abre una sesión si hay algo que recargar.
+        
+        La recarga periódica por antigüedad se lanza en segundo plano y mientras tanto se responde
+        con el índice actual.
+        """
+        if self._loaded_at is not None and not (self._reload_all or self._pending):
+            if time.monotonic() - self._loaded_at > self.max_age and not self._lock.locked():
+                self._refresh_task = asyncio.create_task(self._refresh())
+            return
+        await self._refresh()
+    
+    async def _refresh(self):
+        async with self._lock:
+            expired = self._loaded_at is None or time.monotonic() - self._loaded_at > self.max_age
+            async with database.session_local() as db:
+                if expired or self._reload_all:
+                    self._reload_all = False
+                    self._pending.clear()
+                    loaded_at = time.monotonic()
+                    rows = (await db.execute(self.load_query())).all()
+                    self.puntos, self.celdas, self._extension = {}, collections.defaultdict(set), None
+                    for row in rows:
+                        self._poner(row)
+                    self._loaded_at = loaded_at
+                elif self._pending:
+                    pending, self._pending = self._pending, set()
+                    rows = (await db.execute(self.load_query(pending))).all()
+                    for id_punto in pending - {row.id_punto for row in rows}:
+                        self._quitar(id_punto)
+                    for row in rows:
+                        self._poner(row)
+    
+    @classmethod
+    def distancia_km(cls, lat1: float, lon1: float, lat2: float, lon2: float):
+        # Haversine
+        p1, p2 = math.radians(lat1), math.radians(lat2)
+        a = math.sin((p2 - p1) / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2
+        return 2 * cls.RADIO_TIERRA_KM * math.asin(min(1.0, math.sqrt(a)))
+    
+    def nearest(self, lat: float, lon: float, k: int = 5, cantidad: float = 0, radio_km: Optional[float] = None):
+        """Los k puntos más cercanos con cantidad_disponible >= cantidad, como (distancia_km, entry)."""
+        if not self.puntos:
+            return []
+        ci, cj = self._celda(lat, lon)
+        # Anillo a partir del cual ya no quedan celdas con puntos
+        min_i, max_i, min_j, max_j = self._extension
+        max_ring = max(ci - min_i, max_i - ci, cj - min_j, max_j - cj, 0)
+        candidatos = []
+        for ring in range(max_ring + 1):
+            if ring:
+                # Los puntos de este anillo o más allá distan al menos ring - 1 celdas en latitud o longitud
+                lat_max = min(90.0, abs(lat) + (ring + 1) * self.cell_deg)
+                cota = (ring - 1) * self.cell_deg * self.KM_POR_GRADO * max(math.cos(math.radians(lat_max)), 0.0)
+                if radio_km is not None and cota > radio_km:
+                    break
+                if len(candidatos) >= k and cota > candidatos[k - 1][0]:
+                    break
+            for i in range(ci - ring, ci + ring + 1):
+                if abs(i - ci) == ring:
+                    columnas = range(cj - ring, cj + ring + 1)
+                else:
+                    columnas = (cj - ring, cj + ring)
+                for j in columnas:
+                    for id_punto in self.celdas.get((i, j), ()):
+                        entry = self.puntos[id_punto]
+                        if entry["cantidad_disponible"] < cantidad:
+                            continue
+                        distancia = self.distancia_km(lat, lon, entry["latitud"], entry["longitud"])
+                        if radio_km is None or distancia <= radio_km:
+                            candidatos.append((distancia, entry))
+            candidatos.sort(key=lambda c: c[0])
+            del candidatos[k:]
+        return candidatos
+    
+    def install(self, session_class):
+        # Altas y cambios hechos con session.add(); las UPDATE del repositorio marcan sus puntos directamente
+        @event.listens_for(session_class, "after_flush")
+        def _after_flush(session, flush_context):
+            for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+                if isinstance(obj, (PuntoSuministro, Disponibilidad)) and obj.id_punto is not None:
+                    session.info.setdefault("puntos_modificados", set()).add(obj.id_punto)
+    
+    def on_commit(self, session, tables):
+        puntos = session.info.pop("puntos_modificados", None)
+        if tables & {"puntos_suministro", "disponibilidad"}:
+            self.invalidate(puntos)
+
+# Reparto de lecturas entre réplicas
+ULTIMA_ESCRITURA_COOKIE = "ultima_escritura"
+# El frontend llama a la API desde otro origen y no envía cookies: guarda la cabecera y la reenvía
+ULTIMA_ESCRITURA_HEADER = "X-Ultima-Escritura"
+# Escrituras confirmadas durante la petición en curso (lo rellena mark_client_write)
+current_write_state = contextvars.ContextVar("current_write_state", default=None)
+
+class ReplicaRouter:
+    """Round-robin entre las réplicas sanas; sin réplicas sanas, las lecturas van a la primaria.
+    
+    Los engines se crean al primer uso. check_health() marca cada réplica según responda a SELECT 1.
+    mark_write(key) manda a la primaria las lecturas de `key` durante `sticky_seconds`, solo en este
+    proceso (cachés internas). Para los clientes, mark_client_write() hace que ReadYourWritesMiddleware
+    devuelva la cabecera X-Ultima-Escritura y la cookie ultima_escritura, y pick() recibe su valor en
+    las peticiones siguientes.
+    """
+    
+    def __init__(self, urls: List[str], sticky_seconds: float = 5.0):
+        self.urls = list(urls)
+        self.sticky_seconds = sticky_seconds
+        self._replicas = None
+        self._next = 0
+        self._recent_writes = {}
+        self.stats = collections.Counter()
+    
+    @property
+    def replicas(self):
+        if self._replicas is None:
+            self._replicas = []
+            for i, url in enumerate(self.urls, start=1):
+                engine = create_async_engine(url, echo=False, **engine_options(url))
+                self._replicas.append({
+                    "name": f"replica{i}",
+                    "engine": engine,
+                    "session_local": async_sessionmaker(engine, class_=AsyncSession, autoflush=False, expire_on_commit=False),
+                    "healthy": True
+                })
+                metrics_registry.track_pool(f"replica{i}", engine)
+        return self._replicas
+    
+    def mark_write(self, key):
+        if not self.urls or key is None:
+            return
+        now = time.monotonic()
+        if len(self._recent_writes) > 10000:
+            self._recent_writes = {k: until for k, until in self._recent_writes.items() if until > now}
+        self._recent_writes[key] = now + self.sticky_seconds
+    
+    def mark_client_write(self):
+        estado = current_write_state.get()
+        if self.urls and estado is not None:
+            estado["ultima_escritura"] = time.time()
+    
+    def is_sticky(self, keys, ultima_escritura: Optional[float] = None):
+        if ultima_escritura is not None and time.time() - ultima_escritura < self.sticky_seconds:
+            return True
+        now = time.monotonic()
+        return any(self._recent_writes.get(key, 0) > now for key in keys if key is not None)
+    
+    def pick(self, sticky_keys=(), ultima_escritura: Optional[float] = None):
+        if not self.urls:
+            return None
+        if self.is_sticky(sticky_keys, ultima_escritura):
+            self.stats["primaria_por_escritura"] += 1
+            return None
+        healthy = [replica for replica in self.replicas if replica["healthy"]]
+        if not healthy:
+            self.stats["primaria_sin_replicas"] += 1
+            return None
+        replica = healthy[self._next % len(healthy)]
+        self._next += 1
+        self.stats[replica["name"]] += 1
+        return replica["session_local"]
+    
+    async def check_health(self, timeout: float = 2.0):
+        for replica in self.replicas:
+            try:
+                async with asyncio.timeout(timeout):
+                    async with replica["engine"].connect() as conn:
+                        await conn.execute(text("SELECT 1"))
+                healthy = True
+            except Exception as e:
+                healthy = False
+                error = e
+            if healthy != replica["healthy"]:
+                print(f"✅ {replica['name']} disponible de nuevo" if healthy else f"⚠️ {replica['name']} fuera de servicio: {error}")
+            replica["healthy"] = healthy
+    
+    async def run_health_checks(self, interval: float, timeout: float):
+        while True:
+            await self.check_health(timeout)
+            await asyncio.sleep(interval)
+    
+    async def dispose(self):
+        for replica in self._replicas or []:
+            await replica["engine"].dispose()
+
+class ReadYourWritesMiddleware:
+    """Middleware ASGI: si la petición confirmó escrituras, devuelve la cabecera X-Ultima-Escritura
+    (para clientes que la reenvían) y la cookie ultima_escritura (para los que guardan cookies)."""
+    
+    def __init__(self, app, sticky_seconds: float):
+        self.app = app
+        self.max_age = max(1, math.ceil(sticky_seconds))
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        estado = {}
+        token = current_write_state.set(estado)
+        
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start" and "ultima_escritura" in estado:
+                valor = f"{estado['ultima_escritura']:.3f}"
+                cookie = f"{ULTIMA_ESCRITURA_COOKIE}={valor}; Max-Age={self.max_age}; Path=/; HttpOnly; SameSite=Lax"
+                message["headers"] = list(message.get("headers", [])) + [
+                    (ULTIMA_ESCRITURA_HEADER.lower().encode(), valor.encode()),
+                    (b"set-cookie", cookie.encode())
+                ]
+            await send(message)
+        
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            current_write_state.reset(token)
+
+# Métricas en formato Prometheus (sin dependencias externas)
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+    
+    def observe(self, value: float):
+        for i, upper in enumerate(self.buckets):
+            if value <= upper:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+    
+    def render(self, name: str, labels: str):
+        sep = "," if labels else ""
+        lines, acumulado = [], 0
+        for upper, count in zip(self.buckets, self.counts):
+            acumulado += count
+            le = "+Inf" if upper == math.inf else repr(upper)
+            lines.append(f'{name}_bucket{{{labels}{sep}le="{le}"}} {acumulado}')
+        suffix = f"{{{labels}}}" if labels else ""
+        lines.append(f"{name}_sum{suffix} {self.sum:.6f}")
+        lines.append(f"{name}_count{suffix} {self.count}")
+        return lines
+
+class RequestStats:
+    """Consultas SQL de la petición en curso (se guarda en un ContextVar)."""
+    
+    __slots__ = ("queries", "db_seconds", "statements")
+    
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.statements = collections.Counter()
+
+current_request_stats = contextvars.ContextVar("current_request_stats", default=None)
+
+class MetricsRegistry:
+    """Latencia por ruta, consultas y tiempo de BD por petición, N+1 y estado del pool de conexiones.
+    
+    Todo se actualiza desde el event loop (los hooks de SQLAlchemy corren en su greenlet), así que no
+    hace falta bloqueo.
+    """
+    
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+    POOL_WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+    
+    def __init__(self, n_plus_one_threshold: int = 20):
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.latency = {}
+        self.requests = collections.Counter()
+        self.queries_per_request = {}
+        self.db_queries = collections.Counter()
+        self.db_seconds = collections.defaultdict(float)
+        self.n_plus_one = collections.Counter()
+        self.pool_wait = Histogram(self.POOL_WAIT_BUCKETS)
+        self.pools = {}
+    
+    def observe_request(self, method: str, route: str, status: int, seconds: float, stats: RequestStats):
+        key = (method, route)
+        if key not in self.latency:
+            self.latency[key] = Histogram(self.LATENCY_BUCKETS)
+            self.queries_per_request[key] = Histogram(self.QUERY_BUCKETS)
+        self.latency[key].observe(seconds)
+        self.queries_per_request[key].observe(stats.queries)
+        self.requests[(method, route, status)] += 1
+        repetida = max(stats.statements.values(), default=0)
+        if repetida > self.n_plus_one_threshold:
+            self.n_plus_one[key] += 1
+            print(f"⚠️ Posible N+1 en {method} {route}: una misma consulta {repetida} veces ({stats.queries} en total)")
+    
+    def record_query(self, statement: str, seconds: float):
+        stats = current_request_stats.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.db_seconds += seconds
+            stats.statements[statement] += 1
+    
+    def track_pool(self, name: str, engine):
+        self.pools[name] = engine
+    
+    def install(self, session_class):
+        """Hooks de SQLAlchemy (para todos los engines): tiempo de cada sentencia y espera por una conexión."""
+        @event.listens_for(Engine, "before_cursor_execute")
+        def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            context._metrics_start = time.perf_counter()
+        
+        @event.listens_for(Engine, "after_cursor_execute")
+        def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            elapsed = time.perf_counter() - context._metrics_start
+            self.db_queries["total"] += 1
+            self.db_seconds["total"] += elapsed
+            self.record_query(statement, elapsed)
+        
+        # Espera por conexión: desde que la sesión necesita la BD hasta que el pool entrega una
+        def _pide_conexion(session):
+            if "_conexion_asignada" not in session.info:
+                session.info["_conexion_pedida"] = time.perf_counter()
+        
+        @event.listens_for(session_class, "after_transaction_create")
+        def _after_transaction_create(session, transaction):
+            if transaction.parent is None:
+                session.info.pop("_conexion_asignada", None)
+                _pide_conexion(session)
+        
+        @event.listens_for(session_class, "do_orm_execute")
+        def _do_orm_execute(orm_execute_state):
+            _pide_conexion(orm_execute_state.session)
+        
+        @event.listens_for(session_class, "before_flush")
+        def _before_flush(session, flush_context, instances):
+            _pide_conexion(session)
+        
+        @event.listens_for(session_class, "after_begin")
+        def _after_begin(session, transaction, connection):
+            inicio = session.info.pop("_conexion_pedida", None)
+            session.info["_conexion_asignada"] = True
+            if inicio is not None:
+                self.pool_wait.observe(time.perf_counter() - inicio)
+    
+    def pool_status(self):
+        status = {}
+        for pool_name, engine in self.pools.items():
+            pool = engine.sync_engine.pool
+            for name in ("size", "checkedin", "checkedout", "overflow"):
+                method = getattr(pool, name, None)
+                if callable(method):
+                    status[(name, pool_name)] = method()
+        return status
+    
+    def render(self):
+        lines = [
+            "# HELP aquagest_http_request_duration_seconds Latencia de las peticiones HTTP por ruta",
+            "# TYPE aquagest_http_request_duration_seconds histogram"
+        ]
+        for (method, route), histogram in sorted(self.latency.items()):
+            lines += histogram.render("aquagest_http_request_duration_seconds", f'method="{method}",route="{route}"')
+        lines += ["# HELP aquagest_http_requests_total Peticiones HTTP por ruta y estado",
+                  "# TYPE aquagest_http_requests_total counter"]
+        for (method, route, status), count in sorted(self.requests.items()):
+            lines.append(f'aquagest_http_requests_total{{method="{method}",route="{route}",status="{status}"}} {count}')
+        lines += ["# HELP aquagest_db_queries_per_request Consultas SQL por petición",
+                  "# TYPE aquagest_db_queries_per_request histogram"]
+        for (method, route), histogram in sorted(self.queries_per_request.items()):
+            lines += histogram.render("aquagest_db_queries_per_request", f'method="{method}",route="{route}"')
+        lines += ["# HELP aquagest_db_n_plus_one_total Peticiones que repitieron una misma consulta más del umbral",
+                  "# TYPE aquagest_db_n_plus_one_total counter"]
+        for (method, route), count in sorted(self.n_plus_one.items()):
+            lines.append(f'aquagest_db_n_plus_one_total{{method="{method}",route="{route}"}} {count}')
+        lines += ["# HELP aquagest_db_queries_total Sentencias SQL ejecutadas",
+                  "# TYPE aquagest_db_queries_total counter",
+                  f"aquagest_db_queries_total {self.db_queries['total']}",
+                  "# HELP aquagest_db_query_seconds_total Tiempo total en sentencias SQL",
+                  "# TYPE aquagest_db_query_seconds_total counter",
+                  f"aquagest_db_query_seconds_total {self.db_seconds['total']:.6f}",
+                  "# HELP aquagest_db_pool_wait_seconds Espera hasta obtener una conexión del pool",
+                  "# TYPE aquagest_db_pool_wait_seconds histogram"]
+        lines += self.pool_wait.render("aquagest_db_pool_wait_seconds", "")
+        status = self.pool_status()
+        for name in ("size", "checkedin", "checkedout", "overflow"):
+            valores = [(pool_name, value) for (metric, pool_name), value in status.items() if metric == name]
+            if valores:
+                lines.append(f"# TYPE aquagest_db_pool_{name} gauge")
+                lines += [f'aquagest_db_pool_{name}{{pool="{pool_name}"}} {value}' for pool_name, value in valores]
+        return "\n".join(lines) + "\n"
+
+class MetricsMiddleware:
+    """Middleware ASGI: mide cada petición y, si se pide, añade la cabecera Server-Timing."""
+    
+    def __init__(self, app, registry: MetricsRegistry, server_timing: bool = False):
+        self.app = app
+        self.registry = registry
+        self.server_timing = server_timing
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        stats = RequestStats()
+        token = current_request_stats.set(stats)
+        start = time.perf_counter()
+        status = 500
+        
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if self.server_timing:
+                    total_ms = (time.perf_counter() - start) * 1000
+                    header = (f'db;dur={stats.db_seconds * 1000:.1f};desc="{stats.queries} consultas", '
+                              f"app;dur={total_ms:.1f}")
+                    message["headers"] = list(message.get("headers", [])) + [(b"server-timing", header.encode())]
+            await send(message)
+        
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            current_request_stats.reset(token)
+            route = getattr(scope.get("route"), "path", None) or "sin_ruta"
+            self.registry.observe_request(scope["method"], route, status, time.perf_counter() - start, stats)
+
+# Control de admisión: límite por cliente y concurrencia por clase de ruta
+class TokenBucketLimiter:
+    """Un cubo de `burst` fichas por cliente que se rellena a `rate` fichas/segundo.
+    
+    Los clientes se guardan en LRU (`max_keys`); rate <= 0 desactiva el límite.
+    """
+    
+    def __init__(self, rate: float, burst: float, max_keys: int = 50000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = collections.OrderedDict()
+    
+    def acquire(self, key: str, cost: float = 1.0):
+        """Consume `cost` fichas y devuelve 0, o los segundos que faltan para tenerlas sin consumir nada."""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        tokens, last = self._buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        wait = 0.0
+        if tokens >= cost:
+            tokens -= cost
+        else:
+            wait = (min(cost, self.burst) - tokens) / self.rate
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return wait
+
+class AdmissionController:
+    """Decide antes de abrir una sesión de base de datos si una petición entra.
+    
+    Clases: "lecturas" (GET), "escrituras" (resto de métodos) y "reportes" (generación de reportes y
+    asignación en lote). Cada clase tiene un coste en fichas del cubo del cliente y un máximo de
+    peticiones en curso en el worker; 0 = sin límite. Las rutas sin base de datos quedan fuera.
+    """
+    
+    EXENTAS = {"/", "/metrics", "/eventos/stream", "/notificaciones/estado", "/docs", "/redoc", "/openapi.json"}
+    
+    def __init__(self, limiter: TokenBucketLimiter, limites: dict, costes: dict):
+        self.limiter = limiter
+        self.limites = limites
+        self.costes = costes
+        self.en_curso = collections.Counter()
+        self.admitidas = collections.Counter()
+        self.rechazadas = collections.Counter()
+    
+    @classmethod
+    def clasificar(cls, method: str, path: str):
+        if method == "OPTIONS" or path in cls.EXENTAS:
+            return None
+        if method in ("GET", "HEAD"):
+            return "lecturas"
+        if path.startswith("/reportes/") or path == "/solicitudes/asignacion":
+            return "reportes"
+        return "escrituras"
+    
+    @staticmethod
+    def cliente(scope):
+        for name, value in scope.get("headers", ()):
+            if name == b"authorization":
+                user_id = _token_user_id(value.decode("latin-1"))
+                if user_id is not None:
+                    return f"usuario:{user_id}"
+                break
+        client = scope.get("client")
+        return f"ip:{client[0] if client else 'desconocida'}"
+    
+    def admitir(self, clase: str, cliente: str):
+        """Devuelve None si la petición entra (y ocupa un hueco de su clase) o (status, motivo, retry_after).
+        
+        La saturación se comprueba primero para no gastar fichas del cliente en peticiones que no entran."""
+        limite = self.limites.get(clase, 0)
+        if limite and self.en_curso[clase] >= limite:
+            self.rechazadas[(clase, "saturacion")] += 1
+            return 503, "⏳ Servicio saturado, reintente en unos segundos", 1
+        wait = self.limiter.acquire(cliente, self.costes.get(clase, 1))
+        if wait:
+            self.rechazadas[(clase, "limite_cliente")] += 1
+            return 429, "⏳ Demasiadas peticiones, espere antes de reintentar", max(1, math.ceil(wait))
+        self.en_curso[clase] += 1
+        self.admitidas[clase] += 1
+        return None
+    
+    def liberar(self, clase: str):
+        self.en_curso[clase] -= 1
+    
+    def render(self):
+        lines = ["# TYPE aquagest_admission_admitted_total counter"]
+        lines += [f'aquagest_admission_admitted_total{{clase="{clase}"}} {n}' for clase, n in sorted(self.admitidas.items())]
+        lines.append("# TYPE aquagest_admission_rejected_total counter")
+        lines += [
+            f'aquagest_admission_rejected_total{{clase="{clase}",motivo="{motivo}"}} {n}'
+            for (clase, motivo), n in sorted(self.rechazadas.items())
+        ]
+        lines.append("# TYPE aquagest_admission_in_flight gauge")
+        lines += [f'aquagest_admission_in_flight{{clase="{clase}"}} {self.en_curso[clase]}' for clase in sorted(self.limites)]
+        return "\n".join(lines) + "\n"
+
+class AdmissionControlMiddleware:
+    """Middleware ASGI: rechaza con 429/503 y Retry-After antes de llegar a la ruta (y a get_db)."""
+    
+    def __init__(self, app, controller: AdmissionController):
+        self.app = app
+        self.controller = controller
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        clase = self.controller.clasificar(scope["method"], scope["path"])
+        if clase is None:
+            await self.app(scope, receive, send)
+            return
+        
+        rechazo = self.controller.admitir(clase, self.controller.cliente(scope))
+        if rechazo is not None:
+            status, detail, retry_after = rechazo
+            body = json.dumps({"detail": detail}, ensure_ascii=False).encode()
+            await send({
+                "type": "http.response.start",
+                "status": status,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode()),
+                    (b"retry-after", str(retry_after).encode())
+                ]
+            })
+            await send({"type": "http.response.body", "body": body})
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.controller.liberar(clase)
+
+# Patrón 7: Tokens firmados (HMAC-SHA256) para sesiones sin estado en el servidor
+class TokenService:
+    """Emite y verifica tokens `payload.firma` con claims user_id, email, tipo_usuario, exp y jti.
+    
+    La firma se comprueba sin consultar la base de datos, así que cualquier worker puede validar el token.
+    Las revocaciones (logout) se guardan en tokens_revocados para que las vean todos los workers.
+    `authenticate` las comprueba contra un conjunto en memoria; solo si tiene más de `revocation_refresh`
+    segundos se leen de la tabla las revocaciones nuevas (desde la mayor revocado_en conocida), así que
+    un logout en otro worker tarda como mucho ese tiempo en valer aquí.
+    """
+    
+    # Margen al leer revocaciones nuevas: cubre commits que terminan fuera de orden
+    REVOCATION_OVERLAP = 5
+    
+    def __init__(self, secret_key: str, ttl_seconds: int = 8 * 3600, cache_size: int = 10000,
+                 revocation_refresh: float = 2.0):
+        self.secret_key = secret_key.encode()
+        self.ttl_seconds = ttl_seconds
+        self.cache_size = cache_size
+        self.revocation_refresh = revocation_refresh
+        self._verified = collections.OrderedDict()
+        self._revoked = {}
+        self._revoked_until = 0
+        self._revoked_synced_at = None
+        self._refresh_task = None
+    
+    @staticmethod
+    def _b64encode(raw: bytes) -> str:
+        return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+    
+    @staticmethod
+    def _b64decode(value: str) -> bytes:
+        return base64.urlsafe_b64decode(value + "=" * (-len(value) % 4))
+    
+    def _sign(self, payload: str) -> str:
+        return self._b64encode(hmac.new(self.secret_key, payload.encode(), hashlib.sha256).digest())
+    
+    def issue(self, user_id: int, email: str, tipo_usuario: str):
+        now = int(time.time())
+        claims = {
+            "user_id": user_id,
+            "email": email,
+            "tipo_usuario": tipo_usuario,
+            "iat": now,
+            "exp": now + self.ttl_seconds,
+            "jti": secrets.token_urlsafe(12)
+        }
+        payload = self._b64encode(json.dumps(claims, separators=(",", ":")).encode())
+        return f"{payload}.{self._sign(payload)}", claims
+    
+    def verify(self, token: str):
+        """Devuelve los claims del token o lanza ValueError si es inválido, expiró o fue revocado."""
+        now = time.time()
+        claims = self._verified.get(token)
+        if claims is not None:
+            self._verified.move_to_end(token)
+        else:
+            try:
+                payload, signature = token.split(".")
+                claims = json.loads(self._b64decode(payload))
+            except Exception:
+                raise ValueError("Token inválido")
+            if not hmac.compare_digest(signature, self._sign(payload)):
+                raise ValueError("Token inválido")
+            self._verified[token] = claims
+            if len(self._verified) > self.cache_size:
+                self._verified.popitem(last=False)
+        
+        if claims["exp"] <= now:
+            self._verified.pop(token, None)
+            raise ValueError("Token expirado")
+        if claims["jti"] in self._revoked:
+            raise ValueError("Token revocado")
+        return claims
     
-    def get_by_user(self, user_id: int):
-        return self.db.query(Solicitud).filter(Solicitud.id_usuario_solicitante == user_id).all()
+    def _purge_revoked(self, now: float):
+        # Las revocaciones solo se guardan hasta que el token habría expirado de todos modos
+        for jti in [jti for jti, exp in self._revoked.items() if exp <= now]:
+            del self._revoked[jti]
+    
+    async def refresh_revocations(self):
+        now = time.time()
+        async with database.session_local() as db:
+            rows = (await db.execute(
+                select(TokenRevocado.jti, TokenRevocado.exp, TokenRevocado.revocado_en).where(
+                    TokenRevocado.revocado_en >= self._revoked_until - self.REVOCATION_OVERLAP,
+                    TokenRevocado.exp > now
+                )
+            )).all()
+        self._purge_revoked(now)
+        for jti, exp, revocado_en in rows:
+            self._revoked[jti] = exp
+            self._revoked_until = max(self._revoked_until, revocado_en)
+        self._revoked_synced_at = time.monotonic()
+    
+    async def is_revoked(self, claims: dict) -> bool:
+        if claims["jti"] in self._revoked:
+            return True
+        if self._revoked_synced_at is None or time.monotonic() - self._revoked_synced_at >= self.revocation_refresh:
+            # Las peticiones concurrentes esperan a la misma lectura
+            if self._refresh_task is None or self._refresh_task.done():
+                self._refresh_task = asyncio.ensure_future(self.refresh_revocations())
+            await asyncio.shield(self._refresh_task)
+        return claims["jti"] in self._revoked
+    
+    async def authenticate(self, token: str):
+        """Como verify, pero también rechaza los tokens revocados desde cualquier worker."""
+        claims = self.verify(token)
+        if await self.is_revoked(claims):
+            raise ValueError("Token revocado")
+        return claims
+    
+    async def revoke(self, claims: dict):
+        now = time.time()
+        self._revoked[claims["jti"]] = claims["exp"]
+        self._purge_revoked(now)
+        async with database.session_local() as db:
+            await db.execute(delete(TokenRevocado).where(TokenRevocado.exp <= int(now)))
+            db.add(TokenRevocado(jti=claims["jti"], exp=claims["exp"], revocado_en=int(now)))
+            try:
+                await db.commit()
+            except IntegrityError:
+                # Logout repetido con el mismo token
+                await db.rollback()
+
+# Hash de contraseñas con scrypt, calculado en un pool de hilos acotado
+class PasswordHasher:
+    """Formato almacenado: `scrypt$n$r$p$salt$hash` (base64 sin relleno).
+    
+    hashlib.scrypt libera el GIL, así que el pool de hilos ejecuta los hashes en paralelo
+    sin bloquear el event loop. Las filas antiguas en texto plano se aceptan y se marcan para rehash.
+    """
+    
+    PREFIX = "scrypt"
+    
+    def __init__(self, n: int = 16384, r: int = 8, p: int = 1, workers: Optional[int] = None):
+        self.n, self.r, self.p = n, r, p
+        self.workers = workers or os.cpu_count() or 1
+        self._executor = None
+    
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="password-hash")
+        return self._executor
+    
+    def _derive(self, password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+        return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r, dklen=32)
+    
+    def hash_sync(self, password: str) -> str:
+        salt = os.urandom(16)
+        digest = self._derive(password, salt, self.n, self.r, self.p)
+        return "$".join([
+            self.PREFIX, str(self.n), str(self.r), str(self.p),
+            TokenService._b64encode(salt), TokenService._b64encode(digest)
+        ])
+    
+    def verify_sync(self, password: str, stored: str):
+        """Devuelve (válida, necesita_rehash)."""
+        parts = stored.split("$")
+        if len(parts) != 6 or parts[0] != self.PREFIX:
+            # Contraseña heredada en texto plano
+            return hmac.compare_digest(password.encode(), stored.encode()), True
+        n, r, p = int(parts[1]), int(parts[2]), int(parts[3])
+        digest = self._derive(password, TokenService._b64decode(parts[4]), n, r, p)
+        valid = hmac.compare_digest(digest, TokenService._b64decode(parts[5]))
+        return valid, (n, r, p) != (self.n, self.r, self.p)
+    
+    async def hash(self, password: str) -> str:
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.hash_sync, password)
+    
+    async def hash_many(self, passwords: List[str]) -> List[str]:
+        return await asyncio.gather(*(self.hash(password) for password in passwords))
+    
+    async def verify(self, password: str, stored: str):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.verify_sync, password, stored)
+    
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
 
 # === MODELOS DE BASE DE DATOS ===
 
@@ -182,48 +2375,113 @@ class Usuario(Base):
 
 class Solicitud(Base):
     __tablename__ = "solicitudes"
+    __table_args__ = (
+        # Listado por usuario y listado general paginados por (fecha_solicitud, id_solicitud)
+        Index("ix_solicitudes_usuario_fecha", "id_usuario_solicitante", "fecha_solicitud", "id_solicitud"),
+        Index("ix_solicitudes_fecha", "fecha_solicitud", "id_solicitud"),
+        Index("ix_solicitudes_estado_fecha", "estado", "fecha_solicitud"),
+        Index("ix_solicitudes_asesor", "id_asesor"),
+    )
     
     id_solicitud = Column(Integer, primary_key=True, index=True)
     codigo_solicitud = Column(String(50), unique=True, nullable=False, index=True)
     tipo_solicitud = Column(String(100), nullable=False)
-    id_usuario_solicitante = Column(Integer, nullable=False)
+    id_usuario_solicitante = Column(Integer, ForeignKey("usuarios.id_usuario", name="fk_solicitudes_usuario"), nullable=False)
     fecha_solicitud = Column(DateTime, default=datetime.utcnow)
-    id_asesor = Column(Integer)
+    id_asesor = Column(Integer, ForeignKey("usuarios.id_usuario", name="fk_solicitudes_asesor"))
+    estado = Column(String(50), nullable=False, default="PENDIENTE")
 
 class DetalleSolicitud(Base):
     __tablename__ = "detalle_solicitudes"
+    __table_args__ = (
+        Index("ix_detalle_solicitudes_solicitud", "id_solicitud"),
+        Index("ix_detalle_solicitudes_punto", "id_punto"),
+    )
     
     id_detalle = Column(Integer, primary_key=True, index=True)
-    id_solicitud = Column(Integer, nullable=False)
-    id_punto = Column(Integer, nullable=False)
+    id_solicitud = Column(Integer, ForeignKey("solicitudes.id_solicitud", name="fk_detalle_solicitud"), nullable=False)
+    id_punto = Column(Integer, ForeignKey("puntos_suministro.id_punto", name="fk_detalle_punto"), nullable=False)
     cantidad_solicitada = Column(Numeric(10, 2), nullable=False)
+    cantidad_reservada = Column(Numeric(10, 2), nullable=False, default=0)
 
 class PuntoSuministro(Base):
     __tablename__ = "puntos_suministro"
+    __table_args__ = (
+        Index("ix_puntos_suministro_estado", "estado", "id_punto"),
+    )
     
     id_punto = Column(Integer, primary_key=True, index=True)
     codigo_punto = Column(String(50), unique=True, nullable=False, index=True)
     estado = Column(String(50), nullable=False, default="ACTIVO")
     direccion = Column(String(200), nullable=False)
-    capacidad = Column(Numeric(10, 8), nullable=False)
+    capacidad = Column(Numeric(12, 2), nullable=False)
+    latitud = Column(Numeric(9, 6), nullable=True)
+    longitud = Column(Numeric(9, 6), nullable=True)
 
 class Disponibilidad(Base):
     __tablename__ = "disponibilidad"
+    __table_args__ = (
+        # Una fila de disponibilidad por punto: las reservas se apoyan en esta unicidad
+        Index("ux_disponibilidad_punto", "id_punto", unique=True),
+    )
     
     id_disponibilidad = Column(Integer, primary_key=True, index=True)
-    id_punto = Column(Integer, nullable=False)
+    id_punto = Column(Integer, ForeignKey("puntos_suministro.id_punto", name="fk_disponibilidad_punto"), nullable=False)
     estado_disponibilidad = Column(String(50), nullable=False, default="DISPONIBLE")
     cantidad_disponible = Column(Numeric(10, 2), nullable=False)
 
 class Consulta(Base):
     __tablename__ = "consultas"
+    __table_args__ = (
+        Index("ix_consultas_estado", "estado_consulta", "fecha_consulta"),
+        Index("ix_consultas_usuario", "usuarios_id_usuario"),
+    )
     
     id_consulta = Column(Integer, primary_key=True, index=True)
     descripcion_consulta = Column(String(100), nullable=False)
     estado_consulta = Column(String(50), nullable=False, default="PENDIENTE")
     fecha_consulta = Column(DateTime, default=datetime.utcnow)
     respuesta = Column(Text)
-    usuarios_id_usuario = Column(Integer, nullable=False)
+    usuarios_id_usuario = Column(Integer, ForeignKey("usuarios.id_usuario", name="fk_consultas_usuario"), nullable=False)
+
+class ConsumoDiario(Base):
+    __tablename__ = "consumo_diario"
+    __table_args__ = (
+        # Una fila por punto y día: es la clave de los upserts incrementales
+        Index("ux_consumo_diario_punto_fecha", "id_punto", "fecha", unique=True),
+        Index("ix_consumo_diario_fecha", "fecha"),
+    )
+    
+    id_consumo = Column(Integer, primary_key=True)
+    id_punto = Column(Integer, ForeignKey("puntos_suministro.id_punto", name="fk_consumo_diario_punto"), nullable=False)
+    fecha = Column(Date, nullable=False)
+    litros_solicitados = Column(Numeric(14, 2), nullable=False, default=0)
+    litros_reservados = Column(Numeric(14, 2), nullable=False, default=0)
+    solicitudes = Column(Integer, nullable=False, default=0)
+
+class BusquedaTermino(Base):
+    __tablename__ = "busqueda_terminos"
+    __table_args__ = (
+        # Búsqueda por prefijo: rango sobre termino y el resto de columnas sin ir a la tabla
+        Index("ix_busqueda_termino", "termino", "tipo", "id_entidad", "peso"),
+        # Reindexar una entidad borra sus términos. id_entidad va primero: con (tipo, id_entidad) el
+        # planificador lo prefiere para el GROUP BY de la búsqueda y recorre todo el índice
+        Index("ix_busqueda_entidad", "id_entidad", "tipo"),
+    )
+    
+    id_termino = Column(Integer, primary_key=True)
+    termino = Column(String(64), nullable=False)
+    tipo = Column(String(20), nullable=False)
+    id_entidad = Column(Integer, nullable=False)
+    peso = Column(Integer, nullable=False, default=1)
+
+class TokenRevocado(Base):
+    __tablename__ = "tokens_revocados"
+    
+    jti = Column(String(32), primary_key=True)
+    exp = Column(Integer, nullable=False, index=True)
+    # Epoch en segundos: los workers leen solo las revocaciones posteriores a la última conocida
+    revocado_en = Column(Integer, nullable=False, default=0, index=True)
 
 # === MODELOS PYDANTIC ===
 
@@ -232,100 +2490,824 @@ class UsuarioCreate(BaseModel):
     apellidos: str = ""
     email: str
     telefono: Optional[str] = None
-    tipo_usuario: str = "USUARIO"
     password: str
 
 class SolicitudCreate(BaseModel):
     codigo_solicitud: str
     tipo_solicitud: str
     detalles: List[dict]
+    permitir_parcial: bool = False
+
+class SolicitudBatchCreate(BaseModel):
+    solicitudes: List[SolicitudCreate]
+
+# Modelos de respuesta: fijan qué columnas se cargan y se serializan (nunca la contraseña)
+class SolicitudOut(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+    
+    id_solicitud: int
+    codigo_solicitud: str
+    tipo_solicitud: str
+    id_usuario_solicitante: int
+    fecha_solicitud: Optional[datetime] = None
+    id_asesor: Optional[int] = None
+    estado: str
+
+class SolicitudPage(BaseModel):
+    items: List[SolicitudOut]
+    next_cursor: Optional[str] = None
+
+class PuntoSuministroOut(BaseModel):
+    id_punto: int
+    codigo_punto: str
+    estado: str
+    direccion: str
+    capacidad: float
+    latitud: Optional[float] = None
+    longitud: Optional[float] = None
+    cantidad_disponible: Optional[float] = None
+    estado_disponibilidad: Optional[str] = None
+
+class PuntoSuministroPage(BaseModel):
+    items: List[PuntoSuministroOut]
+    next_cursor: Optional[str] = None
+
+class PuntoCercanoOut(BaseModel):
+    id_punto: int
+    codigo_punto: str
+    direccion: str
+    latitud: float
+    longitud: float
+    cantidad_disponible: float
+    distancia_km: float
+
+class PuntosCercanosResponse(BaseModel):
+    items: List[PuntoCercanoOut]
+    puntos_indexados: int
+
+class DashboardStats(BaseModel):
+    total_usuarios: int
+    total_solicitudes: int
+    total_puntos: int
+    total_consultas: int
+    puntos_activos: int
+    solicitudes_hoy: int
+
+class ConsumoPeriodo(BaseModel):
+    id_punto: int
+    codigo_punto: str
+    periodo: date
+    dias: int
+    litros_solicitados: float
+    litros_reservados: float
+    solicitudes: int
+    # litros reservados / (capacidad × días del periodo dentro del rango)
+    utilizacion: Optional[float] = None
+
+class ConsumoResponse(BaseModel):
+    desde: date
+    hasta: date
+    granularidad: str
+    items: List[ConsumoPeriodo]
+
+class BusquedaResultado(BaseModel):
+    tipo: str
+    id: int
+    titulo: str
+    detalle: Optional[str] = None
+    puntuacion: int
+
+class BusquedaResponse(BaseModel):
+    q: str
+    terminos: List[str]
+    items: List[BusquedaResultado]
+
+class CurrentUser(BaseModel):
+    logged_in: bool
+    user_id: Optional[int] = None
+    email: Optional[str] = None
+    tipo_usuario: Optional[str] = None
+
+SOLICITUD_COLUMNAS = [getattr(Solicitud, field) for field in SolicitudOut.model_fields]
+
+# === DEPENDENCIAS ===
+
+def _token_user_id(authorization: Optional[str]):
+    # Solo identifica al cliente (control de admisión); la autenticación la hace get_optional_user
+    token = _bearer_token(authorization)
+    if not token:
+        return None
+    try:
+        return token_service.verify(token)["user_id"]
+    except ValueError:
+        return None
+
+async def get_db():
+    """Sesión sobre la primaria (escrituras y lecturas que deben ver lo último)."""
+    async with database.session_local() as db:
+        yield db
+
+def _ultima_escritura(request: Request) -> Optional[float]:
+    valores = []
+    for valor in (request.headers.get(ULTIMA_ESCRITURA_HEADER), request.cookies.get(ULTIMA_ESCRITURA_COOKIE)):
+        try:
+            valores.append(float(valor))
+        except (TypeError, ValueError):
+            pass
+    return max(valores, default=None)
+
+async def get_read_db(request: Request):
+    """Sesión de solo lectura: réplica, salvo que el cliente haya escrito hace poco
+    (cabecera X-Ultima-Escritura o cookie ultima_escritura)."""
+    async with database.read_session(ultima_escritura=_ultima_escritura(request)) as db:
+        yield db
+
+async def get_dashboard_db():
+    # Si acaban de cambiar los conteos, la caché se recalcula en la primaria y no con una réplica atrasada
+    async with database.read_session("dashboard") as db:
+        yield db
+
+# Sesiones con tokens firmados: la clave debe ser la misma en todos los workers
+AUTH_SECRET_KEY = os.getenv('AUTH_SECRET_KEY')
+if not AUTH_SECRET_KEY:
+    AUTH_SECRET_KEY = secrets.token_urlsafe(32)
+    print("⚠️ AUTH_SECRET_KEY no definida: se usa una clave temporal (solo válida para un proceso)")
+
+token_service = TokenService(
+    AUTH_SECRET_KEY,
+    ttl_seconds=int(os.getenv('AUTH_TOKEN_TTL', str(8 * 3600))),
+    revocation_refresh=float(os.getenv('AUTH_REVOCATION_REFRESH', '2'))
+)
+
+def _bearer_token(authorization: Optional[str]):
+    if authorization and authorization.lower().startswith("bearer "):
+        return authorization[7:].strip()
+    return None
+
+# Coste del hash de contraseñas (scrypt) y tamaño del pool que lo ejecuta
+password_hasher = PasswordHasher(
+    n=int(os.getenv('PASSWORD_SCRYPT_N', '16384')),
+    r=int(os.getenv('PASSWORD_SCRYPT_R', '8')),
+    p=int(os.getenv('PASSWORD_SCRYPT_P', '1')),
+    workers=int(os.getenv('PASSWORD_HASH_WORKERS', '0')) or None
+)
+
+async def get_optional_user(authorization: Optional[str] = Header(None)):
+    token = _bearer_token(authorization)
+    if not token:
+        return None
+    try:
+        return await token_service.authenticate(token)
+    except ValueError as e:
+        raise HTTPException(status_code=401, detail=f"❌ {e}", headers={"WWW-Authenticate": "Bearer"})
+
+async def get_current_claims(claims: Optional[dict] = Depends(get_optional_user)):
+    if claims is None:
+        raise HTTPException(status_code=401, detail="❌ Debe iniciar sesión primero", headers={"WWW-Authenticate": "Bearer"})
+    return claims
+
+# === FUNCIONES AUXILIARES ===
+
+# === MIGRACIONES ===
+# Cada migración se aplica una sola vez y queda registrada en schema_migrations.
+# Las funciones reciben una conexión síncrona (run_sync) y comprueban el estado real
+# del esquema, de modo que también son seguras sobre bases creadas con create_all.
+
+migrations_metadata = MetaData()
+schema_migrations = Table(
+    "schema_migrations", migrations_metadata,
+    Column("version", Integer, primary_key=True),
+    Column("descripcion", String(200), nullable=False),
+    Column("aplicada_en", DateTime, nullable=False)
+)
+
+def _migracion_esquema_inicial(conn):
+    Base.metadata.create_all(conn)
+
+def _migracion_estado_y_reservas(conn):
+    columnas = {
+        "solicitudes": [c["name"] for c in sql_inspect(conn).get_columns("solicitudes")],
+        "detalle_solicitudes": [c["name"] for c in sql_inspect(conn).get_columns("detalle_solicitudes")]
+    }
+    if "estado" not in columnas["solicitudes"]:
+        conn.execute(text("ALTER TABLE solicitudes ADD COLUMN estado VARCHAR(50) NOT NULL DEFAULT 'PENDIENTE'"))
+    if "cantidad_reservada" not in columnas["detalle_solicitudes"]:
+        conn.execute(text("ALTER TABLE detalle_solicitudes ADD COLUMN cantidad_reservada NUMERIC(10, 2) NOT NULL DEFAULT 0"))
+    if conn.dialect.name == "mysql":
+        # NUMERIC(10, 8) no admite capacidades mayores que 99.99999999
+        conn.execute(text("ALTER TABLE puntos_suministro MODIFY capacidad NUMERIC(12, 2) NOT NULL"))
+
+INDICES_CONSULTAS = [
+    ("solicitudes", "ix_solicitudes_usuario_fecha", ["id_usuario_solicitante", "fecha_solicitud", "id_solicitud"], False),
+    ("solicitudes", "ix_solicitudes_fecha", ["fecha_solicitud", "id_solicitud"], False),
+    ("solicitudes", "ix_solicitudes_estado_fecha", ["estado", "fecha_solicitud"], False),
+    ("solicitudes", "ix_solicitudes_asesor", ["id_asesor"], False),
+    ("detalle_solicitudes", "ix_detalle_solicitudes_solicitud", ["id_solicitud"], False),
+    ("detalle_solicitudes", "ix_detalle_solicitudes_punto", ["id_punto"], False),
+    ("puntos_suministro", "ix_puntos_suministro_estado", ["estado", "id_punto"], False),
+    ("disponibilidad", "ux_disponibilidad_punto", ["id_punto"], True),
+    ("consultas", "ix_consultas_estado", ["estado_consulta", "fecha_consulta"], False),
+    ("consultas", "ix_consultas_usuario", ["usuarios_id_usuario"], False),
+]
+
+def _migracion_indices_consultas(conn):
+    for tabla, nombre, columnas, unico in INDICES_CONSULTAS:
+        existentes = {ix["name"] for ix in sql_inspect(conn).get_indexes(tabla)}
+        if nombre not in existentes:
+            conn.execute(text(
+                f"CREATE {'UNIQUE ' if unico else ''}INDEX {nombre} ON {tabla} ({', '.join(columnas)})"
+            ))
+
+CLAVES_FORANEAS = [
+    ("solicitudes", "fk_solicitudes_usuario", "id_usuario_solicitante", "usuarios", "id_usuario"),
+    ("solicitudes", "fk_solicitudes_asesor", "id_asesor", "usuarios", "id_usuario"),
+    ("detalle_solicitudes", "fk_detalle_solicitud", "id_solicitud", "solicitudes", "id_solicitud"),
+    ("detalle_solicitudes", "fk_detalle_punto", "id_punto", "puntos_suministro", "id_punto"),
+    ("disponibilidad", "fk_disponibilidad_punto", "id_punto", "puntos_suministro", "id_punto"),
+    ("consultas", "fk_consultas_usuario", "usuarios_id_usuario", "usuarios", "id_usuario"),
+]
+
+def _migracion_claves_foraneas(conn):
+    # SQLite no permite añadir claves foráneas a tablas existentes (solo las crea create_all)
+    if conn.dialect.name != "mysql":
+        return
+    for tabla, nombre, columna, referida, columna_referida in CLAVES_FORANEAS:
+        existentes = {fk["name"] for fk in sql_inspect(conn).get_foreign_keys(tabla)}
+        if nombre not in existentes:
+            conn.execute(text(
+                f"ALTER TABLE {tabla} ADD CONSTRAINT {nombre} "
+                f"FOREIGN KEY ({columna}) REFERENCES {referida} ({columna_referida})"
+            ))
+
+def _migracion_consumo_diario(conn):
+    ConsumoDiario.__table__.create(conn, checkfirst=True)
+    for statement in ConsumoRepository.rebuild_statements():
+        conn.execute(statement)
+
+def _migracion_coordenadas_puntos(conn):
+    columnas = [c["name"] for c in sql_inspect(conn).get_columns("puntos_suministro")]
+    for columna in ("latitud", "longitud"):
+        if columna not in columnas:
+            conn.execute(text(f"ALTER TABLE puntos_suministro ADD COLUMN {columna} NUMERIC(9, 6) NULL"))
+
+def _migracion_busqueda(conn):
+    BusquedaTermino.__table__.create(conn, checkfirst=True)
+    for tipo in BusquedaRepository.fuentes():
+        BusquedaRepository.reindexar_sync(conn, tipo)
+
+def _migracion_emails_minusculas(conn):
+    # Solo se normalizan los emails cuya forma en minúsculas no choca con otro usuario
+    filas = conn.execute(select(Usuario.id_usuario, Usuario.email)).all()
+    ocupados = {}
+    for id_usuario, email in filas:
+        ocupados.setdefault(UsuarioRepository.normalize_email(email), []).append((id_usuario, email))
+    for normalizado, usuarios in ocupados.items():
+        if len(usuarios) > 1:
+            print(f"⚠️ Emails que solo difieren en mayúsculas, se dejan sin normalizar: {[e for _, e in usuarios]}")
+            continue
+        id_usuario, email = usuarios[0]
+        if email != normalizado:
+            conn.execute(update(Usuario).where(Usuario.id_usuario == id_usuario).values(email=normalizado))
 
-# === DEPENDENCIAS ===
+def _migracion_tokens_revocados(conn):
+    TokenRevocado.__table__.create(conn, checkfirst=True)
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+def _migracion_revocado_en(conn):
+    columnas = [c["name"] for c in sql_inspect(conn).get_columns("tokens_revocados")]
+    if "revocado_en" not in columnas:
+        conn.execute(text("ALTER TABLE tokens_revocados ADD COLUMN revocado_en INTEGER NOT NULL DEFAULT 0"))
+        conn.execute(text("CREATE INDEX ix_tokens_revocados_revocado_en ON tokens_revocados (revocado_en)"))
 
-# Estado para sesión actual (simplificado)
-current_session = {"user_id": None, "email": None, "tipo": None}
+MIGRATIONS = [
+    (1, "Esquema inicial", _migracion_esquema_inicial),
+    (2, "Estado de solicitudes, cantidad reservada y capacidad NUMERIC(12, 2)", _migracion_estado_y_reservas),
+    (3, "Índices para las consultas frecuentes", _migracion_indices_consultas),
+    (4, "Claves foráneas", _migracion_claves_foraneas),
+    (5, "Acumulado diario de consumo por punto", _migracion_consumo_diario),
+    (6, "Coordenadas de los puntos de suministro", _migracion_coordenadas_puntos),
+    (7, "Índice de búsqueda de texto", _migracion_busqueda),
+    (8, "Emails de usuario en minúsculas", _migracion_emails_minusculas),
+    (9, "Tokens revocados compartidos entre workers", _migracion_tokens_revocados),
+    (10, "Momento de cada revocación (lectura incremental)", _migracion_revocado_en),
+]
 
-# === FUNCIONES AUXILIARES ===
+def _apply_migrations(conn):
+    migrations_metadata.create_all(conn)
+    aplicadas = set(conn.execute(select(schema_migrations.c.version)).scalars().all())
+    nuevas = []
+    for version, descripcion, migracion in MIGRATIONS:
+        if version in aplicadas:
+            continue
+        migracion(conn)
+        conn.execute(insert(schema_migrations).values(
+            version=version, descripcion=descripcion, aplicada_en=datetime.utcnow()
+        ))
+        conn.commit()
+        nuevas.append(version)
+    return nuevas
+
+async def run_migrations():
+    async with database.engine.connect() as conn:
+        nuevas = await conn.run_sync(_apply_migrations)
+    for version in nuevas:
+        print(f"🗂️ Migración {version} aplicada")
+    return nuevas
 
-def create_tables():
+async def create_tables():
     try:
-        Base.metadata.create_all(bind=engine)
+        await run_migrations()
         print("✅ Tablas creadas/verificadas exitosamente")
         return True
     except Exception as e:
         print(f"❌ Error creando tablas: {e}")
         return False
 
-def create_sample_data(db: Session):
+async def create_sample_data(db: AsyncSession):
     try:
         # Crear puntos de suministro de ejemplo si no existen
-        if db.query(PuntoSuministro).count() == 0:
+        if await db.scalar(select(func.count()).select_from(PuntoSuministro)) == 0:
             puntos_ejemplo = [
                 PuntoSuministro(
                     codigo_punto="PUNTO-001",
                     estado="ACTIVO",
                     direccion="Plaza Principal - Centro Ciudad",
-                    capacidad=1000.00
+                    capacidad=1000.00,
+                    latitud=40.416775,
+                    longitud=-3.703790
                 ),
                 PuntoSuministro(
                     codigo_punto="PUNTO-002",
                     estado="ACTIVO", 
                     direccion="Parque Norte - Zona Residencial",
-                    capacidad=750.00
+                    capacidad=750.00,
+                    latitud=40.465420,
+                    longitud=-3.689620
                 ),
                 PuntoSuministro(
                     codigo_punto="PUNTO-003",
                     estado="ACTIVO",
                     direccion="Centro Comercial Sur",
-                    capacidad=500.00
+                    capacidad=500.00,
+                    latitud=40.373010,
+                    longitud=-3.713450
                 )
             ]
             
             for punto in puntos_ejemplo:
                 db.add(punto)
-            db.commit()
+            await db.commit()
             
             # Crear datos de disponibilidad
-            for i, punto in enumerate(puntos_ejemplo, 1):
+            for punto in puntos_ejemplo:
                 disponibilidad = Disponibilidad(
-                    id_punto=i,
+                    id_punto=punto.id_punto,
                     estado_disponibilidad="DISPONIBLE",
                     cantidad_disponible=float(punto.capacidad) * 0.8
                 )
                 db.add(disponibilidad)
-            db.commit()
+            await BusquedaRepository(db).indexar("puntos", [punto.id_punto for punto in puntos_ejemplo])
+            await db.commit()
             
             print("✅ Datos de ejemplo creados")
             
     except Exception as e:
         print(f"⚠️ Error creando datos de ejemplo: {e}")
 
-# === INICIALIZACIÓN DE LA APLICACIÓN ===
+SOLICITUD_BATCH_MAX = int(os.getenv('SOLICITUD_BATCH_MAX', '10000'))
 
-app = FastAPI(
-    title="🚰 AquaGest - Sistema de Gestión de Agua",
-    version="1.0.0",
-    description="Sistema completo para gestión de solicitudes y distribución de agua"
-)
+def parse_detalles(detalles: List[dict]):
+    try:
+        parsed = [
+            {
+                "id_punto": int(detalle["id_punto"]),
+                "cantidad_solicitada": Decimal(str(detalle["cantidad_solicitada"])).quantize(Decimal("0.01"))
+            } for detalle in detalles
+        ]
+    except (KeyError, TypeError, ValueError, InvalidOperation):
+        raise ValueError("Detalle inválido: se requiere id_punto y cantidad_solicitada")
+    if any(detalle["cantidad_solicitada"] <= 0 for detalle in parsed):
+        raise ValueError("Detalle inválido: la cantidad solicitada debe ser positiva")
+    return parsed
 
-# Configurar CORS para permitir conexiones desde el frontend
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["http://localhost:3000", "http://127.0.0.1:3000"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+IMPORT_CHUNK_SIZE = 1000
+IMPORT_MAX_ERRORS = 1000
+USUARIO_IMPORT_FIELDS = ("nombre", "apellidos", "email", "telefono", "tipo_usuario", "password")
+
+async def iter_import_rows(request: Request, formato: str):
+    """Lee el cuerpo por partes y produce (número de línea, fila) sin cargar el archivo completo.
+    
+    Cada registro debe ocupar una línea (CSV sin saltos de línea dentro de campos entrecomillados).
+    """
+    pending = b""
+    line_no = 0
+    columns = None
+    
+    async def lines():
+        nonlocal pending
+        async for chunk in request.stream():
+            pending += chunk
+            *complete, pending = pending.split(b"\n")
+            for line in complete:
+                yield line
+        if pending:
+            yield pending
+    
+    async for raw in lines():
+        line_no += 1
+        line = raw.decode("utf-8-sig" if line_no == 1 else "utf-8", errors="replace").strip("\r")
+        if not line.strip():
+            continue
+        if formato == "csv":
+            values = next(csv.reader([line]))
+            if columns is None:
+                columns = [c.strip() for c in values]
+                continue
+            yield line_no, dict(zip(columns, values))
+        else:
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield line_no, row if isinstance(row, dict) else None
+
+async def calcular_estadisticas_dashboard(db: AsyncSession):
+    # Todas las métricas en una sola sentencia (un único viaje a la base de datos)
+    def count(model, *conditions):
+        return select(func.count()).select_from(model).where(*conditions).scalar_subquery()
+    
+    row = (await db.execute(select(
+        count(Usuario).label("total_usuarios"),
+        count(Solicitud).label("total_solicitudes"),
+        count(PuntoSuministro).label("total_puntos"),
+        count(Consulta).label("total_consultas"),
+        count(PuntoSuministro, PuntoSuministro.estado == "ACTIVO").label("puntos_activos"),
+        count(Solicitud, Solicitud.fecha_solicitud >= datetime.now().date()).label("solicitudes_hoy")
+    ))).one()
+    return dict(row._mapping)
+
+# Fuentes de datos de cada reporte: modelo, orden estable y conversión de fila a dict
+REPORT_SOURCES = {
+    "solicitudes": (
+        Solicitud,
+        Solicitud.id_solicitud,
+        lambda s: {
+            "id": s.id_solicitud,
+            "codigo": s.codigo_solicitud,
+            "tipo": s.tipo_solicitud,
+            "fecha": s.fecha_solicitud.strftime("%Y-%m-%d %H:%M") if s.fecha_solicitud else "",
+            "usuario_id": s.id_usuario_solicitante
+        }
+    ),
+    "usuarios": (
+        Usuario,
+        Usuario.id_usuario,
+        lambda u: {
+            "id": u.id_usuario,
+            "nombre": f"{u.nombre} {u.apellidos or ''}".strip(),
+            "email": u.email,
+            "tipo": u.tipo_usuario,
+            "telefono": u.telefono or "No proporcionado"
+        }
+    ),
+    "puntos": (
+        PuntoSuministro,
+        PuntoSuministro.id_punto,
+        lambda p: {
+            "id": p.id_punto,
+            "codigo": p.codigo_punto,
+            "direccion": p.direccion,
+            "estado": p.estado,
+            "capacidad": float(p.capacidad)
+        }
+    )
+}
+
+REPORT_CHUNK_SIZE = 500
+
+ANALYTICS_MAX_DIAS = int(os.getenv('ANALYTICS_MAX_DIAS', '400'))
+
+def agrupar_consumo(rows, desde: date, hasta: date, granularidad: str):
+    """Agrupa las filas diarias del acumulado por día o por semana (lunes) y calcula la utilización."""
+    periodos = {}
+    for id_punto, codigo_punto, capacidad, dia, solicitado, reservado, n in rows:
+        if isinstance(dia, str):
+            dia = date.fromisoformat(dia)
+        inicio = dia - timedelta(days=dia.weekday()) if granularidad == "semana" else dia
+        key = (id_punto, inicio)
+        if key not in periodos:
+            fin = inicio + timedelta(days=6) if granularidad == "semana" else inicio
+            periodos[key] = {
+                "id_punto": id_punto,
+                "codigo_punto": codigo_punto,
+                "periodo": inicio,
+                "dias": (min(fin, hasta) - max(inicio, desde)).days + 1,
+                "capacidad": Decimal(capacidad),
+                "litros_solicitados": Decimal(0),
+                "litros_reservados": Decimal(0),
+                "solicitudes": 0
+            }
+        periodo = periodos[key]
+        periodo["litros_solicitados"] += Decimal(solicitado)
+        periodo["litros_reservados"] += Decimal(reservado)
+        periodo["solicitudes"] += n
+    
+    items = []
+    for periodo in periodos.values():
+        capacidad = periodo.pop("capacidad")
+        if capacidad > 0:
+            periodo["utilizacion"] = round(float(periodo["litros_reservados"] / (capacidad * periodo["dias"])), 4)
+        items.append(periodo)
+    return items
+
+async def stream_report_rows(tipo_reporte: str, counter: dict):
+    """Lee las filas del reporte con un cursor del servidor, REPORT_CHUNK_SIZE filas cada vez."""
+    model, order_column, to_dict = REPORT_SOURCES[tipo_reporte]
+    # La sesión vive mientras dure la respuesta, no la del request (get_read_db ya se habría cerrado)
+    async with database.read_session() as db:
+        result = await db.stream(
+            select(model).order_by(order_column).execution_options(yield_per=REPORT_CHUNK_SIZE)
+        )
+        async for item in result.scalars():
+            counter["registros"] += 1
+            yield to_dict(item)
+
+# === REPORTES EN SEGUNDO PLANO ===
+# Los trabajos se ejecutan en un pool de procesos y dejan el estado (JSON) y el resultado (gzip) en
+# REPORT_JOBS_DIR, así que cualquier worker que comparta el directorio puede consultarlos.
+# Los resultados contienen datos personales: el directorio es privado (0700) del usuario del servicio.
+
+REPORT_JOBS_DIR = os.getenv('REPORT_JOBS_DIR', os.path.join(
+    os.getenv('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'aquagest', 'reportes'
+))
+REPORT_JOB_WORKERS = int(os.getenv('REPORT_JOB_WORKERS', '2'))
+REPORT_CACHE_TTL = float(os.getenv('REPORT_CACHE_TTL', '300'))
+# Trabajos y resultados más antiguos se borran del directorio (nunca menos que REPORT_CACHE_TTL)
+REPORT_JOBS_RETENTION = float(os.getenv('REPORT_JOBS_RETENTION', '3600'))
+REPORT_FORMATOS = {"json": "application/json", "ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+def _write_json_atomic(path: str, data: dict):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+def _read_json(path: str):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def run_report_job(job_path: str, result_path: str, tipo_reporte: str, formato: str):
+    """Punto de entrada en el proceso del pool: abre su propio engine, lee las filas por lotes y
+    escribe el resultado comprimido. Devuelve el número de registros."""
+    return asyncio.run(_run_report_job(job_path, result_path, tipo_reporte, formato))
+
+async def _run_report_job(job_path: str, result_path: str, tipo_reporte: str, formato: str):
+    job = _read_json(job_path) or {}
+    job.update(estado="EN_CURSO", iniciado=datetime.now().isoformat(timespec="seconds"))
+    _write_json_atomic(job_path, job)
+    counter = {"registros": 0}
+    
+    def progreso():
+        job["progreso"] = counter["registros"]
+        _write_json_atomic(job_path, job)
+    
+    tmp = f"{result_path}.{os.getpid()}.tmp"
+    try:
+        with gzip.open(tmp, "wt", encoding="utf-8", compresslevel=6) as out:
+            if formato == "json":
+                data = []
+                async for row in stream_report_rows(tipo_reporte, counter):
+                    data.append(row)
+                    if len(data) % REPORT_CHUNK_SIZE == 0:
+                        progreso()
+                json.dump(ReportFactory.create_report(tipo_reporte, data), out, ensure_ascii=False)
+            else:
+                async for chunk in ReportFactory.stream_report(
+                    tipo_reporte, stream_report_rows(tipo_reporte, counter), formato, REPORT_CHUNK_SIZE
+                ):
+                    out.write(chunk)
+                    progreso()
+        os.replace(tmp, result_path)
+        return counter["registros"]
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        await database.dispose()
+
+class ReportJobManager:
+    """Lanza trabajos de reporte y reutiliza resultados ya generados.
+    
+    Caché en dos niveles: en memoria, mientras la tabla del reporte no tenga commits en este proceso;
+    y en disco, por (tipo, formato, count, max id). Un UPDATE no cambia esa marca de agua, así que un
+    resultado solo se reutiliza si empezó a generarse después del último commit en la tabla visto por
+    este proceso; las escrituras de otros workers se ven como mucho `cache_ttl` segundos después.
+    
+    El id del trabajo es aleatorio y la clave de caché no sale de la API: indice_<clave>.json apunta al
+    último trabajo de esa clave, así que un acierto de caché devuelve el trabajo existente sin escribir
+    nada. Los trabajos y resultados de más de `retention` segundos se borran (cleanup).
+    """
+    
+    JOB_ID = re.compile(r"^[A-Za-z0-9_-]{16}$")
+    INTERNOS = ("clave", "generado_desde")
+    CLEANUP_INTERVAL = 60.0
+    
+    def __init__(self, directory: str, workers: int = 2, cache_ttl: float = 300.0, retention: float = 3600.0):
+        self.directory = directory
+        self.workers = workers
+        self.cache_ttl = cache_ttl
+        self.retention = max(retention, cache_ttl)
+        self._executor = None
+        self._tasks = set()
+        self._recent = {}
+        self._inflight = {}
+        self._modificadas = {}
+        self._ultima_limpieza = 0.0
+        self._directorio_listo = False
+    
+    @property
+    def executor(self):
+        # spawn: el hijo no hereda el engine ni los sockets del worker
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._executor
+    
+    def job_path(self, job_id: str):
+        return os.path.join(self.directory, f"job_{job_id}.json")
+    
+    def result_path(self, key: str, formato: str):
+        return os.path.join(self.directory, f"reporte_{key}.{formato}.gz")
+    
+    def index_path(self, key: str):
+        return os.path.join(self.directory, f"indice_{key}.json")
+    
+    def ensure_directory(self):
+        if not self._directorio_listo:
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            # makedirs aplica la umask y no toca un directorio ya existente
+            os.chmod(self.directory, 0o700)
+            self._directorio_listo = True
+    
+    def load(self, job_id: str):
+        if not self.JOB_ID.match(job_id):
+            return None
+        return _read_json(self.job_path(job_id))
+    
+    def load_by_key(self, key: str):
+        indice = _read_json(self.index_path(key))
+        return self.load(indice["job_id"]) if indice else None
+    
+    @classmethod
+    def publico(cls, job: dict):
+        return {k: v for k, v in job.items() if k not in cls.INTERNOS}
+    
+    def _new_job(self, tipo_reporte: str, formato: str, key: str, total: int):
+        job = {
+            "job_id": secrets.token_urlsafe(12),
+            "tipo_reporte": tipo_reporte,
+            "formato": formato,
+            "estado": "PENDIENTE",
+            "progreso": 0,
+            "total": total,
+            "cache": None,
+            "clave": key,
+            "creado": datetime.now().isoformat(timespec="seconds"),
+            # Las filas se leen después de este instante: sirve para comparar con los commits
+            "generado_desde": time.time()
+        }
+        _write_json_atomic(self.job_path(job["job_id"]), job)
+        _write_json_atomic(self.index_path(key), {"job_id": job["job_id"]})
+        return job
+    
+    def on_commit(self, tables):
+        now = time.time()
+        for table in tables:
+            self._modificadas[table] = now
+    
+    def vigente(self, job: Optional[dict], table: str):
+        if not job or job["estado"] != "COMPLETADO":
+            return False
+        desde = job.get("generado_desde", 0)
+        return (desde > self._modificadas.get(table, 0) and time.time() - desde < self.cache_ttl
+                and os.path.exists(self.result_path(job["clave"], job["formato"])))
+    
+    def cleanup(self):
+        """Borra los trabajos y resultados (y temporales huérfanos) de más de `retention` segundos."""
+        limite = time.time() - self.retention
+        en_curso = tuple(self._inflight) + tuple(self._inflight.values())
+        borrados = 0
+        try:
+            entries = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return 0
+        for entry in entries:
+            if not entry.name.startswith(("job_", "reporte_", "indice_")):
+                continue
+            if any(nombre in entry.name for nombre in en_curso):
+                continue
+            try:
+                if entry.stat().st_mtime < limite:
+                    os.remove(entry.path)
+                    borrados += 1
+            except FileNotFoundError:
+                pass
+        return borrados
+    
+    def _maybe_cleanup(self):
+        now = time.monotonic()
+        if now - self._ultima_limpieza < self.CLEANUP_INTERVAL:
+            return
+        self._ultima_limpieza = now
+        task = asyncio.create_task(asyncio.to_thread(self.cleanup))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def watermark(self, tipo_reporte: str):
+        model, order_column, _ = REPORT_SOURCES[tipo_reporte]
+        async with database.read_session() as db:
+            total, ultimo = (await db.execute(select(func.count(), func.max(order_column)).select_from(model))).one()
+        return total, ultimo
+    
+    async def submit(self, tipo_reporte: str, formato: str):
+        self.ensure_directory()
+        self._maybe_cleanup()
+        table = REPORT_SOURCES[tipo_reporte][0].__tablename__
+        
+        # Sin commits en la tabla desde el último resultado: se devuelve sin consultar la base
+        recent = self._recent.get((tipo_reporte, formato))
+        if recent and recent["version"] == change_tracker.versions[table] and recent["expira"] > time.monotonic():
+            job = self.load(recent["job_id"])
+            if job and os.path.exists(self.result_path(job["clave"], formato)):
+                return self.publico({**job, "cache": "memoria"})
+        
+        total, ultimo = await self.watermark(tipo_reporte)
+        key = hashlib.sha1(f"{tipo_reporte}:{formato}:{total}:{ultimo}".encode()).hexdigest()[:20]
+        version = change_tracker.versions[table]
+        job = self.load_by_key(key)
+        if self.vigente(job, table):
+            self._remember(tipo_reporte, formato, job["job_id"], version)
+            return self.publico({**job, "cache": "disco"})
+        if key in self._inflight:
+            job = self.load(self._inflight[key])
+            if job:
+                return self.publico(job)
+        
+        job = self._new_job(tipo_reporte, formato, key, total)
+        self._inflight[key] = job["job_id"]
+        task = asyncio.create_task(self._run(job, version))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return self.publico(job)
+    
+    def _remember(self, tipo_reporte: str, formato: str, job_id: str, version: int):
+        self._recent[(tipo_reporte, formato)] = {
+            "job_id": job_id, "version": version, "expira": time.monotonic() + self.cache_ttl
+        }
+    
+    async def _run(self, job: dict, version: int):
+        job_id, key = job["job_id"], job["clave"]
+        start = time.perf_counter()
+        try:
+            registros = await asyncio.get_running_loop().run_in_executor(
+                self.executor, run_report_job,
+                self.job_path(job_id), self.result_path(key, job["formato"]), job["tipo_reporte"], job["formato"]
+            )
+            job = self.load(job_id) or job
+            job.update(
+                estado="COMPLETADO", progreso=registros, total=registros,
+                duracion_s=round(time.perf_counter() - start, 3),
+                bytes=os.path.getsize(self.result_path(key, job["formato"]))
+            )
+            _write_json_atomic(self.job_path(job_id), job)
+            self._remember(job["tipo_reporte"], job["formato"], job_id, version)
+            notification_manager.notify("report_generated", {"tipo": job["tipo_reporte"], "registros": registros})
+        except Exception as e:
+            print(f"❌ Error en el trabajo de reporte {job_id}: {e}")
+            job = self.load(job_id) or job
+            job.update(estado="ERROR", error=str(e))
+            _write_json_atomic(self.job_path(job_id), job)
+        finally:
+            self._inflight.pop(key, None)
+    
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+# === INICIALIZACIÓN DE LA APLICACIÓN ===
+
+# Las rutas se registran en el router; create_app() las monta en la aplicación
+router = APIRouter()
 
 # Inicializar sistema de notificaciones
-notification_manager = NotificationManager()
+notification_manager = NotificationManager(
+    max_notifications=int(os.getenv('NOTIFICATION_HISTORY', '1000')),
+    queue_size=int(os.getenv('NOTIFICATION_QUEUE_SIZE', '10000')),
+    drop_policy=os.getenv('NOTIFICATION_DROP_POLICY', 'drop_oldest')
+)
 
 # Función observadora para notificaciones
 def log_notification(event_type: str, data: dict):
@@ -333,9 +3315,67 @@ def log_notification(event_type: str, data: dict):
 
 notification_manager.add_observer(log_notification)
 
+# Caché de estadísticas del dashboard, invalidada por los eventos que cambian los conteos
+DASHBOARD_CACHE_TTL = float(os.getenv('DASHBOARD_CACHE_TTL', '30'))
+dashboard_cache = TTLCache(DASHBOARD_CACHE_TTL)
+
+def invalidate_dashboard_cache(event_type: str, data: dict):
+    if event_type in ("user_registered", "users_imported", "new_solicitud", "new_solicitud_batch"):
+        dashboard_cache.invalidate()
+
+notification_manager.add_observer(invalidate_dashboard_cache, inline=True)
+
+# Métricas: latencia por ruta, consultas SQL por petición y pool de conexiones (GET /metrics)
+metrics_registry = MetricsRegistry(n_plus_one_threshold=int(os.getenv('METRICS_N_PLUS_ONE_THRESHOLD', '20')))
+metrics_registry.install(Session)
+
+# Escrituras confirmadas por tabla (invalidan cachés e índices en memoria)
+change_tracker = ChangeTracker()
+change_tracker.install(Session)
+change_tracker.add_commit_hook(lambda session, tables: database.replicas.mark_client_write())
+change_tracker.add_listener(
+    {"usuarios", "solicitudes", "puntos_suministro", "consultas"},
+    lambda tables: database.replicas.mark_write("dashboard")
+)
+
+# Caché del listado de puntos de suministro (con su disponibilidad)
+PUNTOS_CACHE_TTL = float(os.getenv('PUNTOS_CACHE_TTL', '60'))
+puntos_cache = ResponseCache(PUNTOS_CACHE_TTL)
+change_tracker.add_listener({"puntos_suministro", "disponibilidad"}, lambda tables: puntos_cache.invalidate())
+
+# Índice espacial para /puntos-suministro/cercanos
+PUNTOS_GRID_CELL_DEG = float(os.getenv('PUNTOS_GRID_CELL_DEG', '0.05'))
+PUNTOS_INDEX_MAX_AGE = float(os.getenv('PUNTOS_INDEX_MAX_AGE', '60'))
+puntos_index = PuntosCercanosIndex(PUNTOS_GRID_CELL_DEG, PUNTOS_INDEX_MAX_AGE)
+puntos_index.install(Session)
+change_tracker.add_commit_hook(puntos_index.on_commit)
+
+# Control de admisión: los huecos por clase se reparten a partir del pool de conexiones del worker
+_pool_worker = pool_settings()["pool_size"] + pool_settings()["max_overflow"]
+admission_control = AdmissionController(
+    TokenBucketLimiter(
+        rate=float(os.getenv('RATE_LIMIT_RATE', '20')),
+        burst=float(os.getenv('RATE_LIMIT_BURST', '40'))
+    ),
+    limites={
+        "lecturas": int(os.getenv('ADMISSION_MAX_LECTURAS', str(_pool_worker))),
+        "escrituras": int(os.getenv('ADMISSION_MAX_ESCRITURAS', str(max(1, _pool_worker // 2)))),
+        "reportes": int(os.getenv('ADMISSION_MAX_REPORTES', str(max(1, _pool_worker // 10))))
+    },
+    costes={"lecturas": 1, "escrituras": 2, "reportes": 10}
+)
+
+# Trabajos de reporte en segundo plano (POST /reportes/jobs)
+report_jobs = ReportJobManager(REPORT_JOBS_DIR, REPORT_JOB_WORKERS, REPORT_CACHE_TTL, REPORT_JOBS_RETENTION)
+change_tracker.add_listener({model.__tablename__ for model, _, _ in REPORT_SOURCES.values()}, report_jobs.on_commit)
+
+# Stream de eventos en vivo para el frontend
+event_broadcaster = EventBroadcaster(notification_manager)
+notification_manager.add_observer(event_broadcaster)
+
 # === RUTAS DE LA API ===
 
-@app.get("/")
+@router.get("/")
 async def root():
     return {
         "message": "🚰 AquaGest - Sistema de Gestión de Agua",
@@ -350,34 +3390,28 @@ async def root():
             "✅ Repository - Acceso a datos"
         ]
     }
-@app.get("/test-db")
+@router.get("/test-db")
 async def test_database():
     try:
-        db = SessionLocal()
-        
-        # Importar text para MySQL 9.3
-        from sqlalchemy import text
-        
-        # Usar text() como requiere MySQL 9.3
-        result = db.execute(text("SELECT 1")).fetchone()
-        
-        # Contar registros de forma segura
-        try:
-            usuarios_count = db.query(Usuario).count()
-        except:
-            usuarios_count = 0
-            
-        try:
-            solicitudes_count = db.query(Solicitud).count()
-        except:
-            solicitudes_count = 0
+        async with database.session_local() as db:
+            # Usar text() como requiere MySQL 9.3
+            result = (await db.execute(text("SELECT 1"))).fetchone()
             
-        try:
-            puntos_count = db.query(PuntoSuministro).count()
-        except:
-            puntos_count = 0
-        
-        db.close()
+            # Contar registros de forma segura
+            try:
+                usuarios_count = await db.scalar(select(func.count()).select_from(Usuario))
+            except:
+                usuarios_count = 0
+                
+            try:
+                solicitudes_count = await db.scalar(select(func.count()).select_from(Solicitud))
+            except:
+                solicitudes_count = 0
+                
+            try:
+                puntos_count = await db.scalar(select(func.count()).select_from(PuntoSuministro))
+            except:
+                puntos_count = 0
         
         return {
             "status": "✅ Conexión a base de datos exitosa",
@@ -398,8 +3432,8 @@ async def test_database():
             "help": "Error específico de MySQL 9.3",
             "database_exists": True
         }
-@app.post("/usuarios/registro")
-async def registrar_usuario(usuario: UsuarioCreate, db: Session = Depends(get_db)):
+@router.post("/usuarios/registro")
+async def registrar_usuario(usuario: UsuarioCreate, db: AsyncSession = Depends(get_db)):
     try:
         # Validar usando patrón Strategy
         is_valid, message = ValidationStrategy.validate_user(usuario.dict())
@@ -408,34 +3442,36 @@ async def registrar_usuario(usuario: UsuarioCreate, db: Session = Depends(get_db
         
         # Usar patrón Repository
         usuario_repo = UsuarioRepository(db)
+        usuario.email = UsuarioRepository.normalize_email(usuario.email)
         
         # Verificar email único
-        existing_user = usuario_repo.get_by_email(usuario.email)
+        existing_user = await usuario_repo.get_by_email(usuario.email)
         if existing_user:
             raise HTTPException(status_code=400, detail="❌ El email ya está registrado")
         
-        # Crear usuario
-        db_usuario = usuario_repo.create({
+        # Crear usuario: el autorregistro siempre es USUARIO; los roles de personal los asigna
+        # el personal (POST /usuarios/import) o el comando promover-usuario
+        db_usuario = await usuario_repo.create({
             "nombre": usuario.nombre,
             "apellidos": usuario.apellidos,
             "email": usuario.email,
             "telefono": usuario.telefono,
-            "tipo_usuario": usuario.tipo_usuario,
-            "password": usuario.password  # En producción se encriptaría
+            "tipo_usuario": "USUARIO",
+            "password": await password_hasher.hash(usuario.password)
         })
         
         # Notificar usando patrón Observer
         notification_manager.notify("user_registered", {
             "user_id": db_usuario.id_usuario,
             "email": usuario.email,
-            "tipo": usuario.tipo_usuario
+            "tipo": db_usuario.tipo_usuario
         })
         
         return {
             "message": "✅ Usuario registrado exitosamente",
             "user_id": db_usuario.id_usuario,
             "email": usuario.email,
-            "tipo_usuario": usuario.tipo_usuario
+            "tipo_usuario": db_usuario.tipo_usuario
         }
         
     except HTTPException:
@@ -444,28 +3480,115 @@ async def registrar_usuario(usuario: UsuarioCreate, db: Session = Depends(get_db
         print(f"❌ Error en registro: {e}")
         raise HTTPException(status_code=500, detail=f"Error interno: {str(e)}")
 
-@app.post("/auth/login")
-async def login(email: str = Form(...), password: str = Form(...), db: Session = Depends(get_db)):
+@router.post("/usuarios/import")
+async def importar_usuarios(request: Request, formato: Optional[str] = None,
+                            claims: dict = Depends(get_current_claims), db: AsyncSession = Depends(get_db)):
+    try:
+        # Las filas pueden fijar tipo_usuario: solo el personal puede importar
+        if claims["tipo_usuario"] == "USUARIO":
+            raise HTTPException(status_code=403, detail="❌ Solo el personal puede importar usuarios")
+        if formato is None:
+            formato = "csv" if "csv" in request.headers.get("content-type", "") else "ndjson"
+        if formato not in ("csv", "ndjson"):
+            raise HTTPException(status_code=400, detail="Formato no válido (csv o ndjson)")
+        
+        usuario_repo = UsuarioRepository(db)
+        vistos = set()
+        totales = {"filas": 0, "creados": 0, "duplicados": 0, "invalidos": 0}
+        errores = []
+        
+        def registrar_error(linea, email, motivo, tipo):
+            totales[tipo] += 1
+            if len(errores) < IMPORT_MAX_ERRORS:
+                errores.append({"linea": linea, "email": email, "error": motivo})
+        
+        async def procesar(lote):
+            existentes = await usuario_repo.existing_emails([u["email"] for _, u in lote])
+            nuevos = []
+            for linea, usuario in lote:
+                if usuario["email"] in existentes:
+                    registrar_error(linea, usuario["email"], "❌ El email ya está registrado", "duplicados")
+                else:
+                    nuevos.append((linea, usuario))
+            if nuevos:
+                hashes = await password_hasher.hash_many([u["password"] for _, u in nuevos])
+                for (_, usuario), password_hash in zip(nuevos, hashes):
+                    usuario["password"] = password_hash
+                creados, duplicados = await usuario_repo.create_many([u for _, u in nuevos])
+                totales["creados"] += creados
+                for linea, usuario in nuevos:
+                    if usuario["email"] in duplicados:
+                        registrar_error(linea, usuario["email"], "❌ El email ya está registrado", "duplicados")
+        
+        lote = []
+        async for linea, row in iter_import_rows(request, formato):
+            totales["filas"] += 1
+            if row is None:
+                registrar_error(linea, None, "Fila con formato inválido", "invalidos")
+                continue
+            
+            usuario = {field: row.get(field) for field in USUARIO_IMPORT_FIELDS}
+            usuario["email"] = UsuarioRepository.normalize_email(usuario["email"])
+            usuario["apellidos"] = usuario["apellidos"] or ""
+            usuario["telefono"] = usuario["telefono"] or None
+            usuario["tipo_usuario"] = usuario["tipo_usuario"] or "USUARIO"
+            
+            # Validar usando patrón Strategy
+            is_valid, message = ValidationStrategy.validate_user(usuario)
+            if not is_valid:
+                registrar_error(linea, usuario["email"], message, "invalidos")
+                continue
+            if usuario["email"] in vistos:
+                registrar_error(linea, usuario["email"], "Email repetido en el archivo", "duplicados")
+                continue
+            vistos.add(usuario["email"])
+            
+            lote.append((linea, usuario))
+            if len(lote) >= IMPORT_CHUNK_SIZE:
+                await procesar(lote)
+                lote = []
+        if lote:
+            await procesar(lote)
+        
+        if totales["creados"]:
+            notification_manager.notify("users_imported", {"creados": totales["creados"]})
+        
+        return {
+            "message": f"✅ {totales['creados']} usuarios importados",
+            **totales,
+            "errores": errores,
+            "errores_omitidos": max(0, totales["duplicados"] + totales["invalidos"] - len(errores))
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"❌ Error importando usuarios: {e}")
+        raise HTTPException(status_code=500, detail=f"Error interno: {str(e)}")
+
+@router.post("/auth/login")
+async def login(email: str = Form(...), password: str = Form(...), db: AsyncSession = Depends(get_db)):
     try:
         usuario_repo = UsuarioRepository(db)
-        user = usuario_repo.get_by_email(email)
+        user = await usuario_repo.get_by_email(email)
         
         if not user:
             raise HTTPException(status_code=401, detail="❌ Usuario no encontrado")
         
-        if user.password != password:
+        is_valid, needs_rehash = await password_hasher.verify(password, user.password)
+        if not is_valid:
             raise HTTPException(status_code=401, detail="❌ Contraseña incorrecta")
         
-        # Actualizar sesión global
-        current_session.update({
-            "user_id": user.id_usuario,
-            "email": email,
-            "tipo": user.tipo_usuario
-        })
+        # Migrar contraseñas en texto plano (o con parámetros antiguos) al hash actual
+        if needs_rehash:
+            await usuario_repo.update_password(user, await password_hasher.hash(password))
+        
+        # Emitir token firmado (sin estado en el servidor)
+        access_token, claims = token_service.issue(user.id_usuario, user.email, user.tipo_usuario)
         
         notification_manager.notify("user_login", {
             "user_id": user.id_usuario,
-            "email": email
+            "email": user.email
         })
         
         return {
@@ -473,7 +3596,10 @@ async def login(email: str = Form(...), password: str = Form(...), db: Session =
             "user_type": user.tipo_usuario,
             "user_name": user.nombre,
             "user_id": user.id_usuario,
-            "access_granted": True
+            "access_granted": True,
+            "access_token": access_token,
+            "token_type": "bearer",
+            "expires_in": token_service.ttl_seconds
         }
         
     except HTTPException:
@@ -482,56 +3608,76 @@ async def login(email: str = Form(...), password: str = Form(...), db: Session =
         print(f"❌ Error en login: {e}")
         raise HTTPException(status_code=500, detail="Error interno del servidor")
 
-@app.get("/auth/current-user")
-async def get_current_user():
-    if current_session["user_id"]:
+@router.post("/auth/logout")
+async def logout(claims: dict = Depends(get_current_claims)):
+    await token_service.revoke(claims)
+    return {"message": "👋 Sesión cerrada"}
+
+@router.get("/auth/current-user", response_model=CurrentUser, response_model_exclude_none=True)
+async def get_current_user(claims: Optional[dict] = Depends(get_optional_user)):
+    if claims:
         return {
             "logged_in": True,
-            "user_id": current_session["user_id"],
-            "email": current_session["email"],
-            "tipo_usuario": current_session["tipo"]
+            "user_id": claims["user_id"],
+            "email": claims["email"],
+            "tipo_usuario": claims["tipo_usuario"]
         }
     return {"logged_in": False}
 
-@app.post("/solicitudes")
-async def crear_solicitud(solicitud: SolicitudCreate, db: Session = Depends(get_db)):
+@router.post("/solicitudes")
+async def crear_solicitud(
+    solicitud: SolicitudCreate,
+    claims: dict = Depends(get_current_claims),
+    db: AsyncSession = Depends(get_db)
+):
     try:
-        if not current_session["user_id"]:
-            raise HTTPException(status_code=401, detail="❌ Debe iniciar sesión primero")
-        
         # Validar usando patrón Strategy
         is_valid, message = ValidationStrategy.validate_solicitud(solicitud.dict())
         if not is_valid:
             raise HTTPException(status_code=400, detail=message)
         
-        # Crear solicitud usando patrón Repository
-        solicitud_repo = SolicitudRepository(db)
-        db_solicitud = solicitud_repo.create({
-            "codigo_solicitud": solicitud.codigo_solicitud,
-            "tipo_solicitud": solicitud.tipo_solicitud,
-            "id_usuario_solicitante": current_session["user_id"],
-            "fecha_solicitud": datetime.utcnow()
-        })
+        try:
+            detalles = parse_detalles(solicitud.detalles)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
         
-        # Crear detalles de solicitud
-        for detalle in solicitud.detalles:
-            db_detalle = DetalleSolicitud(
-                id_solicitud=db_solicitud.id_solicitud,
-                id_punto=int(detalle["id_punto"]),
-                cantidad_solicitada=float(detalle["cantidad_solicitada"])
-            )
-            db.add(db_detalle)
-        db.commit()
+        faltan = await PuntoSuministroRepository(db).missing_ids({d["id_punto"] for d in detalles})
+        if faltan:
+            raise HTTPException(status_code=422, detail=f"❌ Punto de suministro no encontrado: {', '.join(map(str, faltan))}")
+        
+        # Crear solicitud y detalles en una sola transacción usando patrón Repository
+        solicitud_repo = SolicitudRepository(db)
+        try:
+            db_solicitud, reservas = await solicitud_repo.create_with_detalles({
+                "codigo_solicitud": solicitud.codigo_solicitud,
+                "tipo_solicitud": solicitud.tipo_solicitud,
+                "id_usuario_solicitante": claims["user_id"],
+                "fecha_solicitud": datetime.utcnow()
+            }, detalles, solicitud.permitir_parcial)
+        except IntegrityError:
+            if await solicitud_repo.existing_codigos([solicitud.codigo_solicitud]):
+                raise HTTPException(status_code=400, detail="❌ El código de solicitud ya existe")
+            raise
+        except DisponibilidadInsuficiente as e:
+            # detail es texto (el frontend lo muestra tal cual); lo que falta por punto va aparte
+            return JSONResponse(status_code=409, content={"detail": str(e), "faltantes": e.faltantes})
         
         notification_manager.notify("new_solicitud", {
             "solicitud_id": db_solicitud.id_solicitud,
-            "usuario_id": current_session["user_id"]
+            "usuario_id": claims["user_id"]
         })
         
         return {
             "message": "✅ Solicitud creada exitosamente",
             "solicitud_id": db_solicitud.id_solicitud,
-            "codigo": solicitud.codigo_solicitud
+            "codigo": solicitud.codigo_solicitud,
+            "detalles": [
+                {
+                    "id_punto": reserva["id_punto"],
+                    "cantidad_solicitada": float(reserva["cantidad_solicitada"]),
+                    "cantidad_reservada": float(reserva["cantidad_reservada"])
+                } for reserva in reservas
+            ]
         }
         
     except HTTPException:
@@ -540,46 +3686,228 @@ async def crear_solicitud(solicitud: SolicitudCreate, db: Session = Depends(get_
         print(f"❌ Error creando solicitud: {e}")
         raise HTTPException(status_code=500, detail=f"Error interno: {str(e)}")
 
-@app.get("/solicitudes")
-async def obtener_solicitudes(db: Session = Depends(get_db)):
+@router.post("/solicitudes/batch")
+async def crear_solicitudes_batch(
+    batch: SolicitudBatchCreate,
+    claims: dict = Depends(get_current_claims),
+    db: AsyncSession = Depends(get_db)
+):
     try:
+        if len(batch.solicitudes) > SOLICITUD_BATCH_MAX:
+            raise HTTPException(status_code=400, detail=f"Máximo {SOLICITUD_BATCH_MAX} solicitudes por lote")
+        
+        resultados = [None] * len(batch.solicitudes)
+        pendientes = []
+        vistos = set()
+        fecha = datetime.utcnow()
+        
+        # Validar todo el lote usando patrón Strategy antes de tocar la base de datos
+        for index, solicitud in enumerate(batch.solicitudes):
+            is_valid, message = ValidationStrategy.validate_solicitud(solicitud.dict())
+            if is_valid:
+                try:
+                    detalles = parse_detalles(solicitud.detalles)
+                except ValueError as e:
+                    is_valid, message = False, str(e)
+            if not is_valid:
+                resultados[index] = {"index": index, "codigo": solicitud.codigo_solicitud, "status": "invalida", "error": message}
+                continue
+            if solicitud.codigo_solicitud in vistos:
+                resultados[index] = {"index": index, "codigo": solicitud.codigo_solicitud, "status": "duplicada", "error": "Código repetido en el lote"}
+                continue
+            vistos.add(solicitud.codigo_solicitud)
+            pendientes.append((index, {
+                "codigo_solicitud": solicitud.codigo_solicitud,
+                "tipo_solicitud": solicitud.tipo_solicitud,
+                "id_usuario_solicitante": claims["user_id"],
+                "fecha_solicitud": fecha
+            }, detalles, solicitud.permitir_parcial))
+        
         solicitud_repo = SolicitudRepository(db)
+        existentes = await solicitud_repo.existing_codigos([data["codigo_solicitud"] for _, data, _, _ in pendientes])
+        faltan = set(await PuntoSuministroRepository(db).missing_ids(
+            {d["id_punto"] for _, _, detalles, _ in pendientes for d in detalles}
+        ))
+        for index, data, detalles, _ in pendientes:
+            ausentes = sorted({d["id_punto"] for d in detalles} & faltan)
+            if data["codigo_solicitud"] in existentes:
+                resultados[index] = {"index": index, "codigo": data["codigo_solicitud"], "status": "duplicada", "error": "❌ El código de solicitud ya existe"}
+            elif ausentes:
+                resultados[index] = {"index": index, "codigo": data["codigo_solicitud"], "status": "invalida", "error": f"❌ Punto de suministro no encontrado: {', '.join(map(str, ausentes))}"}
+        pendientes = [p for p in pendientes if resultados[p[0]] is None]
         
-        # Si es usuario normal, solo sus solicitudes
-        if current_session.get("tipo") == "USUARIO":
-            solicitudes = solicitud_repo.get_by_user(current_session["user_id"])
-        else:
-            # Asesores y residentes ven todas
-            solicitudes = solicitud_repo.get_all()
+        creadas, duplicadas, sin_disponibilidad = await solicitud_repo.create_many(
+            [(data, detalles, permitir_parcial) for _, data, detalles, permitir_parcial in pendientes]
+        )
+        for index, data, _, _ in pendientes:
+            codigo = data["codigo_solicitud"]
+            if codigo in duplicadas:
+                resultados[index] = {"index": index, "codigo": codigo, "status": "duplicada", "error": "❌ El código de solicitud ya existe"}
+            elif codigo in sin_disponibilidad:
+                resultados[index] = {"index": index, "codigo": codigo, "status": "sin_disponibilidad", "error": "❌ Disponibilidad insuficiente", "faltantes": sin_disponibilidad[codigo]}
+            else:
+                resultados[index] = {"index": index, "codigo": codigo, "status": "creada", "solicitud_id": creadas[codigo]}
+        
+        total_creadas = sum(1 for r in resultados if r["status"] == "creada")
+        if total_creadas:
+            notification_manager.notify("new_solicitud_batch", {
+                "creadas": total_creadas,
+                "usuario_id": claims["user_id"]
+            })
+        
+        return {
+            "message": f"✅ {total_creadas} de {len(resultados)} solicitudes creadas",
+            "creadas": total_creadas,
+            "errores": len(resultados) - total_creadas,
+            "resultados": resultados
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"❌ Error creando lote de solicitudes: {e}")
+        raise HTTPException(status_code=500, detail=f"Error interno: {str(e)}")
+
+@router.post("/solicitudes/asignacion")
+async def asignar_solicitudes_pendientes(
+    dry_run: bool = Query(False),
+    muestra: int = Query(0, ge=0, le=1000),
+    claims: dict = Depends(get_current_claims),
+    db: AsyncSession = Depends(get_db)
+):
+    """Reparte la disponibilidad de cada punto entre las líneas pendientes, de la más antigua a la más nueva.
+    Con dry_run=true solo calcula y devuelve el resultado sin escribir nada."""
+    try:
+        if claims["tipo_usuario"] == "USUARIO":
+            raise HTTPException(status_code=403, detail="❌ Solo los asesores pueden asignar solicitudes")
+        
+        start = time.perf_counter()
+        try:
+            resumen = await AsignacionRepository(db).asignar_pendientes(dry_run=dry_run, muestra=muestra)
+        except DisponibilidadInsuficiente as e:
+            raise HTTPException(status_code=409, detail=str(e))
+        
+        if not dry_run and resumen["lineas_asignadas"]:
+            notification_manager.notify("asignacion_lote", {
+                "lineas": resumen["lineas_asignadas"],
+                "litros": resumen["litros_asignados"],
+                "usuario_id": claims["user_id"]
+            })
+        
+        return {
+            "message": ("🔎 Simulación de asignación" if dry_run else "✅ Asignación aplicada"),
+            "dry_run": dry_run,
+            "duracion_ms": round((time.perf_counter() - start) * 1000, 1),
+            **resumen
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"❌ Error asignando solicitudes: {e}")
+        raise HTTPException(status_code=500, detail=f"Error interno: {str(e)}")
+
+@router.post("/solicitudes/{id_solicitud}/cancelar")
+async def cancelar_solicitud(
+    id_solicitud: int,
+    claims: dict = Depends(get_current_claims),
+    db: AsyncSession = Depends(get_db)
+):
+    try:
+        solicitud = await db.get(Solicitud, id_solicitud)
+        if not solicitud:
+            raise HTTPException(status_code=404, detail="❌ Solicitud no encontrada")
+        if claims["tipo_usuario"] == "USUARIO" and solicitud.id_usuario_solicitante != claims["user_id"]:
+            raise HTTPException(status_code=403, detail="❌ No puede cancelar solicitudes de otros usuarios")
         
-        return solicitudes
+        if not await SolicitudRepository(db).cancel(id_solicitud):
+            raise HTTPException(status_code=409, detail="❌ La solicitud ya estaba cancelada")
+        
+        notification_manager.notify("solicitud_cancelada", {
+            "solicitud_id": id_solicitud,
+            "usuario_id": claims["user_id"]
+        })
+        
+        return {"message": "✅ Solicitud cancelada", "solicitud_id": id_solicitud}
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"❌ Error cancelando solicitud: {e}")
+        raise HTTPException(status_code=500, detail=f"Error interno: {str(e)}")
+
+@router.get("/solicitudes", response_model=SolicitudPage)
+async def obtener_solicitudes(
+    limit: int = Query(50, ge=1, le=500),
+    cursor: Optional[str] = None,
+    tipo: Optional[str] = None,
+    desde: Optional[datetime] = None,
+    hasta: Optional[datetime] = None,
+    asesor: Optional[int] = None,
+    estado: Optional[str] = None,
+    claims: dict = Depends(get_current_claims),
+    db: AsyncSession = Depends(get_read_db)
+):
+    try:
+        solicitud_repo = SolicitudRepository(db)
+        
+        # Si es usuario normal, solo sus solicitudes; asesores y residentes ven todas
+        user_id = claims["user_id"] if claims["tipo_usuario"] == "USUARIO" else None
+        
+        solicitudes, next_cursor = await solicitud_repo.get_page(
+            limit, cursor=cursor, user_id=user_id, tipo=tipo,
+            desde=desde, hasta=hasta, id_asesor=asesor, estado=estado
+        )
+        return {"items": solicitudes, "next_cursor": next_cursor}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         print(f"❌ Error obteniendo solicitudes: {e}")
-        return []
+        raise HTTPException(status_code=500, detail=f"Error interno: {str(e)}")
 
-@app.get("/puntos-suministro")
-async def obtener_puntos_suministro(db: Session = Depends(get_db)):
+@router.get("/puntos-suministro", response_model=PuntoSuministroPage)
+async def obtener_puntos_suministro(
+    request: Request,
+    limit: int = Query(100, ge=1, le=500),
+    cursor: Optional[str] = None,
+    estado: Optional[str] = None,
+    db: AsyncSession = Depends(get_db)
+):
     try:
-        puntos = db.query(PuntoSuministro).all()
-        return puntos
+        # Con la caché vigente se responde (o se devuelve 304) sin consultar ni serializar
+        key = (limit, cursor, estado)
+        entry = puntos_cache.get(key)
+        if entry is None:
+            puntos, next_cursor = await PuntoSuministroRepository(db).get_page(limit, cursor=cursor, estado=estado)
+            body = PuntoSuministroPage(items=puntos, next_cursor=next_cursor).model_dump_json().encode()
+            entry = puntos_cache.put(key, body)
+        return ResponseCache.response(request, entry)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         print(f"❌ Error obteniendo puntos: {e}")
-        return []
+        raise HTTPException(status_code=500, detail=f"Error interno: {str(e)}")
+
+@router.get("/puntos-suministro/cercanos", response_model=PuntosCercanosResponse)
+async def obtener_puntos_cercanos(
+    lat: float = Query(..., ge=-90, le=90),
+    lon: float = Query(..., ge=-180, le=180),
+    cantidad: float = Query(0, ge=0),
+    k: int = Query(5, ge=1, le=50),
+    radio_km: Optional[float] = Query(None, gt=0)
+):
+    # Solo se consulta la base si hay cambios pendientes de aplicar al índice
+    await puntos_index.ensure_fresh()
+    cercanos = puntos_index.nearest(lat, lon, k=k, cantidad=cantidad, radio_km=radio_km)
+    return {
+        "items": [{**entry, "distancia_km": round(distancia, 3)} for distancia, entry in cercanos],
+        "puntos_indexados": len(puntos_index.puntos)
+    }
 
-@app.get("/dashboard/stats")
-async def obtener_estadisticas_dashboard(db: Session = Depends(get_db)):
+@router.get("/dashboard/stats", response_model=DashboardStats)
+async def obtener_estadisticas_dashboard(db: AsyncSession = Depends(get_dashboard_db)):
     try:
-        stats = {
-            "total_usuarios": db.query(Usuario).count(),
-            "total_solicitudes": db.query(Solicitud).count(),
-            "total_puntos": db.query(PuntoSuministro).count(),
-            "total_consultas": db.query(Consulta).count(),
-            "puntos_activos": db.query(PuntoSuministro).filter(PuntoSuministro.estado == "ACTIVO").count(),
-            "solicitudes_hoy": db.query(Solicitud).filter(
-                Solicitud.fecha_solicitud >= datetime.now().date()
-            ).count()
-        }
-        return stats
+        return await dashboard_cache.get_or_compute(lambda: calcular_estadisticas_dashboard(db))
     except Exception as e:
         print(f"❌ Error obteniendo estadísticas: {e}")
         return {
@@ -591,45 +3919,120 @@ async def obtener_estadisticas_dashboard(db: Session = Depends(get_db)):
             "solicitudes_hoy": 0
         }
 
-@app.post("/reportes/generar")
-async def generar_reporte(tipo_reporte: str = Form(...), db: Session = Depends(get_db)):
+@router.get("/analytics/consumo", response_model=ConsumoResponse)
+async def analytics_consumo(
+    desde: Optional[date] = None,
+    hasta: Optional[date] = None,
+    punto: Optional[int] = None,
+    granularidad: str = Query("dia", pattern="^(dia|semana)$"),
+    db: AsyncSession = Depends(get_read_db)
+):
+    # Se lee del acumulado consumo_diario: una fila por punto y día, sin recorrer detalle_solicitudes
+    hasta = hasta or datetime.utcnow().date()
+    desde = desde or hasta - timedelta(days=29)
+    if desde > hasta:
+        raise HTTPException(status_code=400, detail="❌ 'desde' debe ser anterior a 'hasta'")
+    if (hasta - desde).days + 1 > ANALYTICS_MAX_DIAS:
+        raise HTTPException(status_code=400, detail=f"❌ El rango no puede superar {ANALYTICS_MAX_DIAS} días")
+    
+    rows = await ConsumoRepository(db).get_range(desde, hasta, punto)
+    return {
+        "desde": desde,
+        "hasta": hasta,
+        "granularidad": granularidad,
+        "items": agrupar_consumo(rows, desde, hasta, granularidad)
+    }
+
+BUSQUEDA_TIPOS = ("solicitudes", "consultas", "puntos")
+
+@router.get("/buscar", response_model=BusquedaResponse)
+async def buscar(
+    q: str = Query(..., min_length=1, max_length=200),
+    tipos: Optional[str] = Query(None, description="solicitudes,consultas,puntos (por defecto todos)"),
+    limit: int = Query(20, ge=1, le=100),
+    claims: dict = Depends(get_current_claims),
+    db: AsyncSession = Depends(get_read_db)
+):
+    if claims["tipo_usuario"] == "USUARIO":
+        raise HTTPException(status_code=403, detail="❌ La búsqueda es solo para el personal de soporte")
+    seleccion = [t.strip() for t in tipos.split(",") if t.strip()] if tipos else list(BUSQUEDA_TIPOS)
+    if not seleccion or any(t not in BUSQUEDA_TIPOS for t in seleccion):
+        raise HTTPException(status_code=400, detail=f"Tipos válidos: {', '.join(BUSQUEDA_TIPOS)}")
     try:
-        # Usar patrón Factory para generar reportes
-        if tipo_reporte == "solicitudes":
-            data = db.query(Solicitud).all()
-            data = [
-                {
-                    "id": s.id_solicitud,
-                    "codigo": s.codigo_solicitud,
-                    "tipo": s.tipo_solicitud,
-                    "fecha": s.fecha_solicitud.strftime("%Y-%m-%d %H:%M") if s.fecha_solicitud else "",
-                    "usuario_id": s.id_usuario_solicitante
-                } for s in data
-            ]
-        elif tipo_reporte == "usuarios":
-            data = db.query(Usuario).all()
-            data = [
-                {
-                    "id": u.id_usuario,
-                    "nombre": f"{u.nombre} {u.apellidos or ''}".strip(),
-                    "email": u.email,
-                    "tipo": u.tipo_usuario,
-                    "telefono": u.telefono or "No proporcionado"
-                } for u in data
-            ]
-        elif tipo_reporte == "puntos":
-            data = db.query(PuntoSuministro).all()
-            data = [
-                {
-                    "id": p.id_punto,
-                    "codigo": p.codigo_punto,
-                    "direccion": p.direccion,
-                    "estado": p.estado,
-                    "capacidad": float(p.capacidad)
-                } for p in data
-            ]
-        else:
+        terminos, items = await BusquedaRepository(db).buscar(q, seleccion, limit)
+        return {"q": q, "terminos": terminos, "items": items}
+    except Exception as e:
+        print(f"❌ Error en la búsqueda: {e}")
+        raise HTTPException(status_code=500, detail=f"Error interno: {str(e)}")
+
+@router.get("/metrics")
+async def metrics():
+    body = metrics_registry.render() + admission_control.render()
+    if DATABASE_REPLICA_URLS:
+        body += "# TYPE aquagest_db_read_routing_total counter\n" + "".join(
+            f'aquagest_db_read_routing_total{{destino="{destino}"}} {count}\n'
+            for destino, count in sorted(database.replicas.stats.items())
+        )
+    return Response(content=body, media_type="text/plain; version=0.0.4")
+
+@router.get("/notificaciones/estado")
+async def estado_notificaciones():
+    return notification_manager.metrics()
+
+@router.get("/eventos/stream")
+async def stream_eventos(request: Request, tipos: Optional[str] = None, last_event_id: Optional[int] = None,
+                         token: Optional[str] = None, authorization: Optional[str] = Header(None)):
+    # EventSource no puede enviar cabeceras: el token llega también por ?token= o por la cookie access_token
+    token = _bearer_token(authorization) or token or request.cookies.get("access_token")
+    if not token:
+        raise HTTPException(status_code=401, detail="❌ Debe iniciar sesión primero", headers={"WWW-Authenticate": "Bearer"})
+    try:
+        claims = await token_service.authenticate(token)
+    except ValueError as e:
+        raise HTTPException(status_code=401, detail=f"❌ {e}", headers={"WWW-Authenticate": "Bearer"})
+    
+    # El navegador envía Last-Event-ID al reconectar; ?last_event_id= permite reanudar manualmente
+    header_id = request.headers.get("last-event-id")
+    if last_event_id is None and header_id:
+        try:
+            last_event_id = int(header_id)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Last-Event-ID inválido")
+    
+    filtro = {t.strip() for t in tipos.split(",") if t.strip()} if tipos else None
+    user_id = claims["user_id"] if claims["tipo_usuario"] == "USUARIO" else None
+    return StreamingResponse(
+        event_broadcaster.stream(filtro, user_id, last_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@router.post("/reportes/generar")
+async def generar_reporte(
+    tipo_reporte: str = Form(...),
+    formato: str = Form("json"),
+    claims: dict = Depends(get_current_claims),
+    db: AsyncSession = Depends(get_read_db)
+):
+    try:
+        if claims["tipo_usuario"] == "USUARIO":
+            raise HTTPException(status_code=403, detail="❌ Los reportes son solo para el personal")
+        if tipo_reporte not in REPORT_SOURCES:
             raise HTTPException(status_code=400, detail="Tipo de reporte no válido")
+        if formato not in ("json", "ndjson", "csv"):
+            raise HTTPException(status_code=400, detail="Formato no válido (json, ndjson o csv)")
+        
+        if formato != "json":
+            return StreamingResponse(
+                _stream_reporte(tipo_reporte, formato),
+                media_type="text/csv" if formato == "csv" else "application/x-ndjson",
+                headers={"Content-Disposition": f'attachment; filename="reporte_{tipo_reporte}.{formato}"'}
+            )
+        
+        # Usar patrón Factory para generar reportes
+        model, order_column, to_dict = REPORT_SOURCES[tipo_reporte]
+        data = (await db.execute(select(model).order_by(order_column))).scalars().all()
+        data = [to_dict(item) for item in data]
         
         report = ReportFactory.create_report(tipo_reporte, data)
         
@@ -646,20 +4049,147 @@ async def generar_reporte(tipo_reporte: str = Form(...), db: Session = Depends(g
         print(f"❌ Error generando reporte: {e}")
         raise HTTPException(status_code=500, detail="Error interno del servidor")
 
+@router.post("/reportes/jobs", status_code=202)
+async def crear_reporte_job(tipo_reporte: str = Form(...), formato: str = Form("csv"),
+                            claims: dict = Depends(get_current_claims)):
+    if claims["tipo_usuario"] == "USUARIO":
+        raise HTTPException(status_code=403, detail="❌ Los reportes son solo para el personal")
+    if tipo_reporte not in REPORT_SOURCES:
+        raise HTTPException(status_code=400, detail="Tipo de reporte no válido")
+    if formato not in REPORT_FORMATOS:
+        raise HTTPException(status_code=400, detail="Formato no válido (json, ndjson o csv)")
+    job = await report_jobs.submit(tipo_reporte, formato)
+    return {**job, "estado_url": f"/reportes/jobs/{job['job_id']}"}
+
+@router.get("/reportes/jobs/{job_id}")
+async def estado_reporte_job(job_id: str, claims: dict = Depends(get_current_claims)):
+    if claims["tipo_usuario"] == "USUARIO":
+        raise HTTPException(status_code=403, detail="❌ Los reportes son solo para el personal")
+    job = report_jobs.load(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="❌ Trabajo de reporte no encontrado")
+    job = report_jobs.publico(job)
+    if job["estado"] == "COMPLETADO":
+        job["resultado_url"] = f"/reportes/jobs/{job_id}/resultado"
+    return job
+
+@router.get("/reportes/jobs/{job_id}/resultado")
+async def resultado_reporte_job(job_id: str, request: Request, claims: dict = Depends(get_current_claims)):
+    if claims["tipo_usuario"] == "USUARIO":
+        raise HTTPException(status_code=403, detail="❌ Los reportes son solo para el personal")
+    job = report_jobs.load(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="❌ Trabajo de reporte no encontrado")
+    if job["estado"] != "COMPLETADO":
+        raise HTTPException(status_code=409, detail=f"⏳ El reporte aún no está listo ({job['estado']})")
+    path = report_jobs.result_path(job["clave"], job["formato"])
+    if not os.path.exists(path):
+        raise HTTPException(status_code=410, detail="❌ El resultado ya no está disponible, genere el reporte de nuevo")
+    headers = {"Content-Disposition": f'attachment; filename="reporte_{job["tipo_reporte"]}.{job["formato"]}"'}
+    media_type = REPORT_FORMATOS[job["formato"]]
+    
+    # Se envía tal cual está en disco si el cliente acepta gzip; si no, se descomprime por partes
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        return FileResponse(path, media_type=media_type, headers={**headers, "Content-Encoding": "gzip"})
+    
+    def descomprimir():
+        with gzip.open(path, "rb") as f:
+            while chunk := f.read(64 * 1024):
+                yield chunk
+    return StreamingResponse(descomprimir(), media_type=media_type, headers=headers)
+
+async def _stream_reporte(tipo_reporte: str, formato: str):
+    counter = {"registros": 0}
+    async for chunk in ReportFactory.stream_report(
+        tipo_reporte, stream_report_rows(tipo_reporte, counter), formato, REPORT_CHUNK_SIZE
+    ):
+        yield chunk
+    
+    notification_manager.notify("report_generated", {
+        "tipo": tipo_reporte,
+        "registros": counter["registros"]
+    })
+
 # === EVENTOS DE INICIO ===
 
-@app.on_event("startup")
-async def startup_event():
+async def init_db(seed: bool = True):
+    """Migraciones y datos de ejemplo. Se ejecuta una vez por despliegue (`python main.py init-db`),
+    no en cada arranque de worker."""
     print("🔧 Inicializando base de datos...")
-    if create_tables():
-        db = SessionLocal()
-        create_sample_data(db)
-        db.close()
-        print("✅ Sistema inicializado correctamente")
-    else:
+    if not await create_tables():
         print("⚠️ Problemas inicializando la base de datos")
+        return False
+    if seed:
+        async with database.session_local() as db:
+            await create_sample_data(db)
+    print("✅ Base de datos lista")
+    return True
 
-if __name__ == "__main__":
+replica_health_task = None
+
+async def startup_event():
+    global replica_health_task
+    await notification_manager.start()
+    if DATABASE_REPLICA_URLS and replica_health_task is None:
+        replica_health_task = asyncio.create_task(
+            database.replicas.run_health_checks(REPLICA_HEALTH_INTERVAL, REPLICA_HEALTH_TIMEOUT)
+        )
+    # Atajo para desarrollo local; en despliegues el esquema se prepara antes con init-db
+    if os.getenv('INIT_DB_ON_STARTUP', '0') == '1':
+        await init_db()
+
+async def shutdown_event():
+    global replica_health_task
+    if replica_health_task is not None:
+        replica_health_task.cancel()
+        replica_health_task = None
+    await notification_manager.stop()
+    password_hasher.shutdown()
+    report_jobs.shutdown()
+    await database.dispose()
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    await startup_event()
+    try:
+        yield
+    finally:
+        await shutdown_event()
+
+def create_app():
+    """Construye la aplicación sin tocar la base de datos (el engine se crea con la primera consulta)."""
+    app = FastAPI(
+        title="🚰 AquaGest - Sistema de Gestión de Agua",
+        version="1.0.0",
+        description="Sistema completo para gestión de solicitudes y distribución de agua",
+        lifespan=lifespan
+    )
+    
+    # Dentro de CORS, para que las respuestas 429/503 lleguen al navegador con sus cabeceras
+    app.add_middleware(AdmissionControlMiddleware, controller=admission_control)
+    if DATABASE_REPLICA_URLS:
+        app.add_middleware(ReadYourWritesMiddleware, sticky_seconds=REPLICA_STICKY_SECONDS)
+    # Configurar CORS para permitir conexiones desde el frontend
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["http://localhost:3000", "http://127.0.0.1:3000"],
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+        # El frontend lee la marca de la última escritura para reenviarla (lecturas en la primaria)
+        expose_headers=[ULTIMA_ESCRITURA_HEADER],
+    )
+    app.add_middleware(
+        MetricsMiddleware,
+        registry=metrics_registry,
+        server_timing=os.getenv('METRICS_SERVER_TIMING', '0') == '1'
+    )
+    app.include_router(router)
+    return app
+
+app = create_app()
+
+def serve():
     import uvicorn
     print("\n" + "="*60)
     print("🚀 INICIANDO AQUAGEST - SISTEMA DE GESTIÓN DE AGUA")
@@ -677,15 +4207,147 @@ if __name__ == "__main__":
     print("   • Repository: Acceso estructurado a datos")
     print("="*60)
     print("🎯 Para probar:")
+    print("   0. Prepara la base una vez: python main.py init-db")
     print("   1. Ve a http://localhost:8000")
     print("   2. Prueba http://localhost:8000/test-db")
     print("   3. Ve la documentación en http://localhost:8000/docs")
     print("="*60)
     
+    # reload necesita la app como texto importable para poder recargarla
     uvicorn.run(
-        app, 
+        "main:app", 
         host="0.0.0.0", 
         port=8000, 
         reload=True,
         log_level="info"
-    )
\ No newline at end of file
+    )
+
+# Ajustes del servidor de producción
+WEB_HOST = os.getenv('WEB_HOST', '0.0.0.0')
+WEB_PORT = int(os.getenv('WEB_PORT', '8000'))
+WEB_BACKLOG = int(os.getenv('WEB_BACKLOG', '2048'))
+WEB_KEEP_ALIVE = int(os.getenv('WEB_KEEP_ALIVE', '5'))
+WEB_GRACEFUL_TIMEOUT = int(os.getenv('WEB_GRACEFUL_TIMEOUT', '30'))
+WEB_LIMIT_CONCURRENCY = int(os.getenv('WEB_LIMIT_CONCURRENCY', '0')) or None
+
+def serve_production(workers: int, host: str, port: int):
+    """Varios procesos sin vigilancia de ficheros.
+    
+    Con SIGTERM/SIGINT uvicorn deja de aceptar conexiones, espera hasta WEB_GRACEFUL_TIMEOUT a que
+    terminen las peticiones en curso y después ejecuta el shutdown de cada worker, que vacía la cola
+    de notificaciones y cierra el engine. Los streams SSE no terminan solos: se cortan al agotar el
+    plazo y los clientes se reconectan con Last-Event-ID.
+    """
+    import uvicorn
+    # Los workers heredan el entorno: cada uno dimensiona su pool con el mismo reparto
+    os.environ['WEB_WORKERS'] = str(workers)
+    if not os.getenv('AUTH_SECRET_KEY'):
+        # Sin esto cada worker generaría su propia clave y rechazaría los tokens firmados por los demás
+        os.environ['AUTH_SECRET_KEY'] = AUTH_SECRET_KEY
+        print("⚠️ AUTH_SECRET_KEY no definida: los workers comparten una clave temporal; "
+              "los tokens dejan de valer al reiniciar")
+    pool = pool_settings(workers)
+    if DB_CONNECTION_BUDGET < workers:
+        print(f"⚠️ DB_CONNECTION_BUDGET={DB_CONNECTION_BUDGET} es menor que el número de workers ({workers})")
+    print(f"🚀 AquaGest en {host}:{port} con {workers} workers; pool por worker: "
+          f"{pool['pool_size']} + {pool['max_overflow']} overflow (presupuesto {DB_CONNECTION_BUDGET})")
+    
+    uvicorn.run(
+        "main:app",
+        host=host,
+        port=port,
+        workers=workers,
+        backlog=WEB_BACKLOG,
+        timeout_keep_alive=WEB_KEEP_ALIVE,
+        timeout_graceful_shutdown=WEB_GRACEFUL_TIMEOUT,
+        limit_concurrency=WEB_LIMIT_CONCURRENCY,
+        proxy_headers=True,
+        access_log=os.getenv('WEB_ACCESS_LOG', '0') == '1',
+        log_level="info"
+    )
+
+async def _run_init_db(seed: bool):
+    try:
+        return await init_db(seed=seed)
+    finally:
+        await database.dispose()
+
+async def _run_seed():
+    try:
+        async with database.session_local() as db:
+            await create_sample_data(db)
+    finally:
+        await database.dispose()
+
+async def _run_rebuild_consumo():
+    try:
+        async with database.session_local() as db:
+            await ConsumoRepository(db).rebuild()
+        print("✅ Acumulado de consumo recalculado")
+    finally:
+        await database.dispose()
+
+async def _run_rebuild_busqueda():
+    try:
+        async with database.session_local() as db:
+            await BusquedaRepository(db).rebuild()
+        print("✅ Índice de búsqueda reconstruido")
+    finally:
+        await database.dispose()
+
+TIPOS_USUARIO = ("USUARIO", "ASESOR", "RESIDENTE")
+
+async def _run_promover_usuario(email: str, tipo_usuario: str):
+    try:
+        async with database.session_local() as db:
+            result = await db.execute(
+                update(Usuario).where(Usuario.email == UsuarioRepository.normalize_email(email))
+                .values(tipo_usuario=tipo_usuario)
+            )
+            await db.commit()
+        if not result.rowcount:
+            print(f"❌ No existe ningún usuario con email {email}")
+            return False
+        print(f"✅ {email} ahora es {tipo_usuario} (vale desde su próximo login)")
+        return True
+    finally:
+        await database.dispose()
+
+def cli():
+    parser = argparse.ArgumentParser(description="🚰 AquaGest - backend")
+    comandos = parser.add_subparsers(dest="comando")
+    comandos.add_parser("serve", help="levanta la API en modo desarrollo, con recarga (comando por defecto)")
+    prod_parser = comandos.add_parser("prod", help="levanta la API en producción con varios workers")
+    prod_parser.add_argument("--workers", type=int, default=int(os.getenv('WEB_WORKERS', str(os.cpu_count() or 1))))
+    prod_parser.add_argument("--host", default=WEB_HOST)
+    prod_parser.add_argument("--port", type=int, default=WEB_PORT)
+    init_parser = comandos.add_parser("init-db", help="aplica las migraciones y crea los datos de ejemplo")
+    init_parser.add_argument("--sin-datos", action="store_true", help="solo migraciones, sin datos de ejemplo")
+    comandos.add_parser("seed", help="crea los datos de ejemplo si la base está vacía")
+    comandos.add_parser("rebuild-consumo", help="recalcula el acumulado diario de consumo desde las solicitudes")
+    comandos.add_parser("rebuild-busqueda", help="reconstruye el índice de /buscar (tras escrituras fuera de la API)")
+    promover_parser = comandos.add_parser("promover-usuario", help="cambia el rol de un usuario (p. ej. el primer RESIDENTE)")
+    promover_parser.add_argument("email")
+    promover_parser.add_argument("tipo_usuario", choices=TIPOS_USUARIO)
+    args = parser.parse_args()
+    
+    if args.comando == "init-db":
+        raise SystemExit(0 if asyncio.run(_run_init_db(seed=not args.sin_datos)) else 1)
+    if args.comando == "seed":
+        asyncio.run(_run_seed())
+        return
+    if args.comando == "rebuild-consumo":
+        asyncio.run(_run_rebuild_consumo())
+        return
+    if args.comando == "rebuild-busqueda":
+        asyncio.run(_run_rebuild_busqueda())
+        return
+    if args.comando == "promover-usuario":
+        raise SystemExit(0 if asyncio.run(_run_promover_usuario(args.email, args.tipo_usuario)) else 1)
+    if args.comando == "prod":
+        serve_production(max(1, args.workers), args.host, args.port)
+        return
+    serve()
+
+if __name__ == "__main__":
+    cli()
@@ -37,6 +37,9 @@ const AppContext = createContext();
 class APIService {
   constructor() {
     this.baseURL = "http://localhost:8000";
+    this.token = localStorage.getItem("accessToken");
+    // Marca de la última escritura: el backend manda a la primaria las lecturas que la reenvían
+    this.ultimaEscritura = null;
     console.log("🔗 API Service inicializado:", this.baseURL);
   }
 
@@ -48,10 +51,20 @@ class APIService {
       },
       ...options,
     };
+    if (this.token) {
+      config.headers = { ...config.headers, Authorization: `Bearer ${this.token}` };
+    }
+    if (this.ultimaEscritura) {
+      config.headers = { ...config.headers, "X-Ultima-Escritura": this.ultimaEscritura };
+    }
 
     try {
       console.log(`📡 API Request: ${config.method || "GET"} ${url}`);
       const response = await fetch(url, config);
+      const ultimaEscritura = response.headers.get("X-Ultima-Escritura");
+      if (ultimaEscritura) {
+        this.ultimaEscritura = ultimaEscritura;
+      }
       const data = await response.json();
 
       if (!response.ok) {
@@ -77,11 +90,23 @@ class APIService {
     formData.append("email", email);
     formData.append("password", password);
 
-    return this.request("/auth/login", {
+    const data = await this.request("/auth/login", {
       method: "POST",
       body: formData,
       headers: {}, // Remove Content-Type for FormData
     });
+    this.token = data.access_token;
+    localStorage.setItem("accessToken", this.token);
+    return data;
+  }
+
+  async logout() {
+    try {
+      await this.request("/auth/logout", { method: "POST" });
+    } finally {
+      this.token = null;
+      localStorage.removeItem("accessToken");
+    }
   }
 
   async register(userData) {
@@ -95,9 +120,22 @@ class APIService {
     return this.request("/auth/current-user");
   }
 
+  // Listados paginados por cursor: se siguen las páginas hasta que no hay next_cursor
+  async getAllPages(endpoint) {
+    const items = [];
+    let cursor = null;
+    do {
+      const query = cursor ? `?limit=500&cursor=${encodeURIComponent(cursor)}` : "?limit=500";
+      const page = await this.request(`${endpoint}${query}`);
+      items.push(...page.items);
+      cursor = page.next_cursor;
+    } while (cursor);
+    return items;
+  }
+
   // Solicitudes
   async getSolicitudes() {
-    return this.request("/solicitudes");
+    return this.getAllPages("/solicitudes");
   }
 
   async createSolicitud(solicitudData) {
@@ -109,7 +147,7 @@ class APIService {
 
   // Puntos de suministro
   async getPuntosSuministro() {
-    return this.request("/puntos-suministro");
+    return this.getAllPages("/puntos-suministro");
   }
 
   // Dashboard
@@ -141,7 +179,6 @@ const Login = ({ onLogin }) => {
     nombre: "",
     apellidos: "",
     telefono: "",
-    tipo_usuario: "USUARIO",
   });
   const [loading, setLoading] = useState(false);
   const [error, setError] = useState("");
@@ -179,7 +216,6 @@ const Login = ({ onLogin }) => {
           apellidos: formData.apellidos,
           email: formData.email,
           telefono: formData.telefono,
-          tipo_usuario: formData.tipo_usuario,
           password: formData.password,
         });
         console.log("✅ Registro exitoso:", response);
@@ -299,22 +335,6 @@ const Login = ({ onLogin }) => {
                   placeholder="Tu número de teléfono"
                 />
               </div>
-              <div>
-                <label className="block text-sm font-medium text-gray-700 mb-1">
-                  Tipo de cuenta
-                </label>
-                <select
-                  value={formData.tipo_usuario}
-                  onChange={(e) =>
-                    setFormData({ ...formData, tipo_usuario: e.target.value })
-                  }
-                  className="w-full px-4 py-3 border border-gray-300 rounded-lg focus:ring-2 focus:ring-blue-500 focus:border-transparent transition-colors"
-                >
-                  <option value="USUARIO">Usuario - Solicitar agua</option>
-                  <option value="ASESOR">Asesor - Gestionar solicitudes</option>
-                  <option value="RESIDENTE">Residente - Administrar</option>
-                </select>
-              </div>
             </>
           )}
 
@@ -1583,6 +1603,7 @@ export default function App() {
 
   const handleLogout = () => {
     console.log("👋 Usuario deslogueado");
+    apiService.logout().catch(() => {});
     setUser(null);
     setCurrentView("");
   };